@@ -5,10 +5,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import math
+import re
 
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 from transformers.pytorch_transformers.modeling_bert import (
     BertAttention,
@@ -23,13 +25,39 @@ from transformers.pytorch_transformers.modeling_bert import (
 logger = logging.getLogger(__name__)
 
 
+def require_torch(version, feature):
+    """ Raise early if the installed torch is older than `version` (major, minor) """
+    installed = tuple(int(part) for part in re.findall(r"\d+", torch.__version__)[:2])
+    if installed < version:
+        raise RuntimeError(
+            f"{feature} needs torch {version[0]}.{version[1]} or later, "
+            f"found {torch.__version__}"
+        )
+
+
+def sdpa_mask_dtype(hidden_states):
+    """ Dtype the attention queries will have, under autocast or not """
+    if hidden_states.device.type == "cuda" and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    if hidden_states.device.type == "cpu" and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return hidden_states.dtype
+
+
 class CaptionBertSelfAttention(BertSelfAttention):
     """
     Modified from BertSelfAttention to add support for output_hidden_states.
+    With config.attention_backend "sdpa" the attention runs in PyTorch's fused
+    scaled_dot_product_attention, unless attention probabilities are returned
+    or heads are masked.
     """
 
     def __init__(self, config):
         super(CaptionBertSelfAttention, self).__init__(config)
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+        if self.attention_backend == "sdpa":
+            # F.scaled_dot_product_attention
+            require_torch((2, 0), "attention_backend sdpa")
 
     def forward(
         self, hidden_states, attention_mask, head_mask=None, history_state=None
@@ -48,6 +76,23 @@ class CaptionBertSelfAttention(BertSelfAttention):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if (
+            self.attention_backend == "sdpa"
+            and not self.output_attentions
+            and head_mask is None
+        ):
+            # The additive mask is in the queries' dtype, see CaptionBertEncoder
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            return (context_layer.view(*new_context_layer_shape),)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -127,42 +172,103 @@ class CaptionBertLayer(BertLayer):
 class CaptionBertEncoder(BertEncoder):
     """
     Modified from BertEncoder to add support for output_hidden_states.
+    With config.activation_checkpointing k > 0, training forwards keep only
+    the inputs of every block of k layers and recompute the rest on backward.
     """
 
     def __init__(self, config):
         super(CaptionBertEncoder, self).__init__(config)
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+        self.activation_checkpointing = getattr(config, "activation_checkpointing", 0)
+        if self.activation_checkpointing > 0:
+            # checkpoint(..., use_reentrant=False)
+            require_torch((1, 11), "activation_checkpointing")
         self.layer = nn.ModuleList(
             [CaptionBertLayer(config) for _ in range(config.num_hidden_layers)]
         )
 
-    def forward(
-        self, hidden_states, attention_mask, head_mask=None, encoder_history_states=None
+    def _run_layers(
+        self,
+        start,
+        end,
+        hidden_states,
+        attention_mask,
+        head_mask,
+        encoder_history_states,
+        output_hidden_states,
     ):
         all_hidden_states = ()
         all_attentions = ()
-        for i, layer_module in enumerate(self.layer):
-            if self.output_hidden_states:
+        for i in range(start, end):
+            if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
             history_state = (
                 None if encoder_history_states is None else encoder_history_states[i]
             )
-            layer_outputs = layer_module(
+            layer_outputs = self.layer[i](
                 hidden_states, attention_mask, head_mask[i], history_state
             )
             hidden_states = layer_outputs[0]
 
             if self.output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
+        return hidden_states, all_hidden_states, all_attentions
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask,
+        head_mask=None,
+        encoder_history_states=None,
+        output_hidden_states=None,
+    ):
+        """ `output_hidden_states` overrides the config value for this call """
+        if output_hidden_states is None:
+            output_hidden_states = self.output_hidden_states
+        all_hidden_states = ()
+        all_attentions = ()
+        if self.attention_backend == "sdpa":
+            # Fused attention needs the additive mask in the dtype of the
+            # queries, convert it once here instead of in every layer
+            attention_mask = attention_mask.to(sdpa_mask_dtype(hidden_states))
+
+        checkpointing = (
+            self.activation_checkpointing > 0
+            and self.training
+            and torch.is_grad_enabled()
+        )
+        block = self.activation_checkpointing if checkpointing else len(self.layer)
+        for start in range(0, len(self.layer), block):
+            end = min(start + block, len(self.layer))
+            layer_args = (
+                start,
+                end,
+                hidden_states,
+                attention_mask,
+                head_mask,
+                encoder_history_states,
+                output_hidden_states,
+            )
+            if checkpointing:
+                # The RNG state is restored on recompute, dropout masks match
+                block_outputs = checkpoint(
+                    self._run_layers, *layer_args, use_reentrant=False
+                )
+            else:
+                block_outputs = self._run_layers(*layer_args)
+            hidden_states, block_hidden_states, block_attentions = block_outputs
+            all_hidden_states = all_hidden_states + block_hidden_states
+            all_attentions = all_attentions + block_attentions
 
         # Add last layer
-        if self.output_hidden_states:
+        if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
         outputs = (hidden_states,)
-        if self.output_hidden_states:
+        if output_hidden_states:
             outputs = outputs + (all_hidden_states,)
         if self.output_attentions:
             outputs = outputs + (all_attentions,)
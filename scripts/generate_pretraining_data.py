@@ -233,7 +233,12 @@ def getNextViewpointViewData(
 
 
 def extract_data(split, dataset_to_use, job_index, total_jobs):
+    """
+    Steps along the paths of `split`. The dialogs / instructions are written
+    once to a table of texts that the steps refer to by `text_id`.
+    """
     sim = SingleBatchSimulator()
+    texts = []
     data = []
 
     dataset = load_datasets([split], dataset_type=dataset_to_use)
@@ -264,6 +269,18 @@ def extract_data(split, dataset_to_use, job_index, total_jobs):
 
         sim.newEpisode(scanId, vId, heading, elevation)
 
+        if dataset_to_use == "NDH":
+            text_ids = [len(texts)]
+            texts.append(
+                {"dialog_history": item["dialog_history"], "target": item["target"]}
+            )
+        elif dataset_to_use in ["R2R", "R4R"]:
+            text_ids = list(range(len(texts), len(texts) + len(item["instructions"])))
+            texts += [{"dialog_history": instr} for instr in item["instructions"]]
+        elif dataset_to_use == "RxR":
+            text_ids = [len(texts)]
+            texts.append({"dialog_history": item["instruction"]})
+
         for i, curr_vId in enumerate(path[:-1]):
 
             next_vId = path[i + 1]
@@ -297,49 +314,60 @@ def extract_data(split, dataset_to_use, job_index, total_jobs):
 
             if dataset_to_use == "NDH":
                 new_item["inst_idx"] = f"ndh_{item['inst_idx']}_{i}"
-                new_item["dialog_history"] = item["dialog_history"]
-                new_item["target"] = item["target"]
+                new_item["text_id"] = text_ids[0]
                 data.append(new_item)
             elif dataset_to_use == "R2R":
-                for instr_no, instr in enumerate(item["instructions"]):
+                for instr_no, text_id in enumerate(text_ids):
                     new_new_item = dict(new_item)
                     new_new_item["inst_idx"] = f"r2r_{item['path_id']}_{i}_{instr_no}"
-                    new_new_item["dialog_history"] = instr
+                    new_new_item["text_id"] = text_id
                     data.append(new_new_item)
             elif dataset_to_use == "R4R":
-                for instr_no, instr in enumerate(item["instructions"]):
+                for instr_no, text_id in enumerate(text_ids):
                     new_new_item = dict(new_item)
                     new_new_item["inst_idx"] = f"r4r_{item['path_id']}_{i}_{instr_no}"
-                    new_new_item["dialog_history"] = instr
+                    new_new_item["text_id"] = text_id
                     data.append(new_new_item)
             elif dataset_to_use == "RxR":
                 new_item["inst_idx"] = f"rxr_{item['instruction_id']}_{i}"
-                new_item["dialog_history"] = item["instruction"]
+                new_item["text_id"] = text_ids[0]
                 data.append(new_item)
 
     with open(
         f"srv/task_data/pretrain_data/{dataset_to_use}_{split}_{job_index}_{total_jobs}.json",
         "w",
     ) as f:
-        json.dump(data, f)
+        json.dump({"texts": texts, "steps": data}, f)
 
 
 def merge_jsons(split, dataset_to_use, total_jobs):
+    final_texts = []
     final_data = []
+    shards = []
 
     for job_index in range(total_jobs):
-        with open(
-            f"srv/task_data/pretrain_data/{dataset_to_use}_{split}_{job_index}_{total_jobs}.json",
-            "r",
-        ) as f:
+        shard_path = f"srv/task_data/pretrain_data/{dataset_to_use}_{split}_{job_index}_{total_jobs}.json"
+        with open(shard_path, "r") as f:
             data = json.load(f)
-            print(f"Loaded data of length {len(data)}")
-            final_data += data
+            shards.append({"path": shard_path, "num_steps": len(data["steps"])})
+            print(
+                f"Loaded data of length {len(data['steps'])} with {len(data['texts'])} texts"
+            )
+            for step in data["steps"]:
+                step["text_id"] += len(final_texts)
+            final_texts += data["texts"]
+            final_data += data["steps"]
 
-    print(f"Final data of length {len(final_data)}")
+    print(f"Final data of length {len(final_data)} with {len(final_texts)} texts")
 
     with open(f"srv/task_data/pretrain_data/{dataset_to_use}_{split}.json", "w") as f:
-        json.dump(final_data, f)
+        json.dump({"texts": final_texts, "steps": final_data}, f)
+
+    # The per-job files are kept as shards for streaming pretraining
+    with open(
+        f"srv/task_data/pretrain_data/{dataset_to_use}_{split}_shards.json", "w"
+    ) as f:
+        json.dump(shards, f)
 
 
 if __name__ == "__main__":
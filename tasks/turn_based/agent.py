@@ -19,6 +19,7 @@ from torch.autograd import Variable
 from torch.optim import Adam
 
 import agent_models
+import utils
 
 
 class BaseAgent(object):
@@ -54,7 +55,7 @@ class BaseAgent(object):
         self.results = {}
         # We rely on env showing the entire batch before repeating anything
         looped = False
-        with torch.no_grad():
+        with torch.no_grad(), utils.autocast(self.args):
             while True:
                 for traj in self.rollout(train=False):
                     if traj["inst_idx"] in self.results:
@@ -144,6 +145,13 @@ class Agent(BaseAgent):
             self.encoder_optimizer,
             self.decoder_optimizer,
         )
+        self.scaler = utils.grad_scaler(args)
+
+        # Dialog encodings of eval-mode passes, bumped whenever the weights change
+        self.encoder_version = 0
+        self.encoder_cache = (
+            utils.EncoderCache() if args.cache_encoder_outputs else None
+        )
 
         # Evaluations
         self.losses = []
@@ -162,6 +170,36 @@ class Agent(BaseAgent):
     def n_outputs():
         return len(Agent.model_actions) - 2  # Model doesn't output start or ignore
 
+    def _encode(self, perm_obs, seq, seq_lengths, seq_mask, segment_ids):
+        """Run the dialog encoder, or serve its outputs from the encoder cache
+        when the encoder is in eval mode and no gradients are needed."""
+        cache = self.encoder_cache
+        cacheable = (
+            cache is not None
+            and not self.encoder.training
+            and not torch.is_grad_enabled()
+        )
+        inst_idxs = [ob["inst_idx"] for ob in perm_obs]
+        # inst_idx is only unique within a split, and val() swaps dataloaders
+        splits = tuple(self.dataloader.splits)
+        cache_keys = [(splits, inst_idx) for inst_idx in inst_idxs]
+        if cacheable:
+            cached = cache.lookup(
+                cache_keys, self.encoder_version, seq_mask.size(1), self.args.device
+            )
+            if cached is not None:
+                return cached
+
+        ctx, h_t, c_t = self.encoder(
+            inputs=seq,
+            lengths=seq_lengths,
+            mask=seq_mask,
+            token_type_ids=segment_ids,
+        )
+        if cacheable:
+            cache.store(cache_keys, seq_lengths, ctx, h_t, c_t)
+        return ctx, h_t, c_t
+
     def _sort_batch(self, obs):
         """Extract instructions from a list of observations and sort by descending
         sequence length (to enable PyTorch packing)."""
@@ -256,10 +294,13 @@ class Agent(BaseAgent):
             return new_batch
         return batch
 
-    def rollout(self, train=True):
+    def rollout(self, train=True, batch=None):
 
-        batch = self._get_batch()
-        batch = self._verify_batch_size(batch)
+        if batch is None:
+            batch = self._get_batch()
+            batch = self._verify_batch_size(batch)
+        else:
+            self.dataloader.batch = batch
 
         obs = np.array(self.dataloader.reset())
 
@@ -270,12 +311,7 @@ class Agent(BaseAgent):
         seq_lengths = torch.tensor(seq_lengths)
         perm_obs = obs[perm_idx]
 
-        ctx, h_t, c_t = self.encoder(
-            inputs=seq,
-            lengths=seq_lengths,
-            mask=seq_mask,
-            token_type_ids=segment_ids,
-        )
+        ctx, h_t, c_t = self._encode(perm_obs, seq, seq_lengths, seq_mask, segment_ids)
         ctx_mask = seq_mask
 
         # Record starting point
@@ -371,7 +407,9 @@ class Agent(BaseAgent):
                         self.non_avg_loss /= self.args.detach_loss_at
 
                         self.loss += self.non_avg_loss
-                        self.loss.backward()
+                        self.scaler.scale(
+                            self.loss / self.args.gradient_accumulation_steps
+                        ).backward()
 
                         self.loss.detach_()
                         self.non_avg_loss = torch.zeros(1).to(self.args.device)
@@ -396,6 +434,7 @@ class Agent(BaseAgent):
             ]  # no cheating by using teacher at test time!
         self.feedback = feedback
         if use_dropout:
+            # The encoder cache only serves eval-mode passes, this one is uncached
             self.encoder.train()
             self.decoder.train()
         else:
@@ -403,6 +442,30 @@ class Agent(BaseAgent):
             self.decoder.eval()
         super(Agent, self).test()
 
+    def check_amp_parity(self):
+        """
+        Compare the loss of a teacher-forced eval rollout on the next training
+        batch in float32 and under --amp, before training starts
+        """
+        if self.args.amp == "off":
+            return
+        batch = self._get_batch()
+
+        def compute_loss():
+            self.rollout(train=False, batch=batch)
+            self.losses.pop()
+            # Outside training the detached chunks are not folded into self.loss
+            return self.non_avg_loss if self.args.detach_loss else self.loss
+
+        feedback = getattr(self, "feedback", None)
+        self.feedback = "teacher"
+        self.encoder.eval()
+        self.decoder.eval()
+        utils.check_amp_parity(self.args, compute_loss)
+        self.encoder.train()
+        self.decoder.train()
+        self.feedback = feedback
+
     def train(self, n_iters, feedback="teacher"):
         """ Train for a given number of iterations """
         assert feedback in self.feedback_options
@@ -416,19 +479,31 @@ class Agent(BaseAgent):
             self.encoder_optimizer.zero_grad()
             self.decoder_optimizer.zero_grad()
 
-            self.rollout()
-
-            if not self.args.detach_loss:
-                if self.args.local_rank not in [-2, -1]:
-                    self.loss /= dist.get_world_size()
-                    dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
-                self.loss.backward()
-
+            accumulation_steps = self.args.gradient_accumulation_steps
+            for micro_step in range(accumulation_steps):
+                # Only the last rollout of the window all-reduces the gradients
+                with utils.no_sync(
+                    (self.encoder, self.decoder), micro_step < accumulation_steps - 1
+                ):
+                    with utils.autocast(self.args):
+                        self.rollout()
+
+                    if not self.args.detach_loss:
+                        if self.args.local_rank not in [-2, -1]:
+                            self.loss /= dist.get_world_size()
+                            dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
+                        self.scaler.scale(self.loss / accumulation_steps).backward()
+
+            # Clip the true gradients, not the fp16 loss-scaled ones
+            self.scaler.unscale_(self.encoder_optimizer)
+            self.scaler.unscale_(self.decoder_optimizer)
             torch.nn.utils.clip_grad_norm(self.encoder.parameters(), 40.0)
             torch.nn.utils.clip_grad_norm(self.decoder.parameters(), 40.0)
 
-            self.encoder_optimizer.step()
-            self.decoder_optimizer.step()
+            self.scaler.step(self.encoder_optimizer)
+            self.scaler.step(self.decoder_optimizer)
+            self.scaler.update()
+            self.encoder_version += 1
 
     def save(self, encoder_path, decoder_path):
         """ Snapshot models """
@@ -447,6 +522,7 @@ class Agent(BaseAgent):
 
     def load(self, encoder_path, decoder_path):
         """ Loads parameters (but not training state) """
+        self.encoder_version += 1
         print("%s %s" % (encoder_path, decoder_path))
         encoder_weights = torch.load(encoder_path)
         decoder_weights = torch.load(decoder_path)
@@ -64,6 +64,8 @@ def load_oscar_weights(
 
     config.img_feature_dim = args.img_feature_dim
     config.hidden_dropout_prob = args.drop_out
+    config.attention_backend = args.attention_backend
+    config.activation_checkpointing = args.activation_checkpointing
     config.classifier = "linear"
     config.loss_type = "CrossEntropy"
     config.cls_hidden_scale = 2
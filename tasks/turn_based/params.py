@@ -170,6 +170,12 @@ parser.add_argument(
     type=int,
     help="Batch size per GPU for training.",
 )
+parser.add_argument(
+    "--gradient_accumulation_steps",
+    default=1,
+    type=int,
+    help="Number of forward/backward passes (rollouts) to accumulate before each optimizer step",
+)
 parser.add_argument(
     "--per_gpu_eval_batch_size",
     default=8,
@@ -241,6 +247,38 @@ parser.add_argument(
     metavar="N",
     help="number of data loading workers (default: 4)",
 )
+parser.add_argument(
+    "--cache_encoder_outputs",
+    action="store_true",
+    help="Reuse the dialog encoder outputs across eval-mode passes over the same episodes "
+    "(the validation loss pass with dropout is not cached)",
+)
+parser.add_argument(
+    "--attention_backend",
+    type=str,
+    default="eager",
+    choices=["eager", "sdpa"],
+    help="BERT self-attention implementation, sdpa uses torch's fused scaled_dot_product_attention",
+)
+parser.add_argument(
+    "--activation_checkpointing",
+    default=0,
+    type=int,
+    help="Recompute BERT activations on backward, checkpointing every k layers (0 disables)",
+)
+parser.add_argument(
+    "--amp",
+    type=str,
+    default="off",
+    choices=["off", "bf16", "fp16"],
+    help="Mixed precision autocast dtype for forward passes (fp16 also enables loss scaling and needs a GPU)",
+)
+parser.add_argument(
+    "--amp_tolerance",
+    type=float,
+    default=0.05,
+    help="Largest relative loss difference between --amp and float32 accepted by the startup parity check",
+)
 parser.add_argument(
     "--local_rank",
     type=int,
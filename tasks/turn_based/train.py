@@ -19,7 +19,7 @@ from agent import Agent
 from data_loader import VLNDataLoader, VLNDataloader_collate_fn, VLNDataset
 from eval import Evaluation
 
-from utils import set_seed
+from utils import check_amp, set_seed
 from utils_data import load_detector_classes, read_tsv_img_features, timeSince
 
 sys.path.insert(0, "/root/mount/Matterport3DSimulator/")
@@ -110,6 +110,8 @@ def train(args, features):
 
     logger.info("Training an LSTM agent with %s feedback" % args.feedback_method)
 
+    agent.check_amp_parity()
+
     data_log = defaultdict(list)
     start = time.time()
 
@@ -194,6 +196,8 @@ def val(args, features, list_iter_no):
 
         config.img_feature_dim = args.img_feature_dim
         config.hidden_dropout_prob = args.drop_out
+        config.attention_backend = args.attention_backend
+        config.activation_checkpointing = args.activation_checkpointing
         config.classifier = "linear"
         config.loss_type = "CrossEntropy"
         config.cls_hidden_scale = 2
@@ -423,8 +427,9 @@ def main():
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        "False",
+        args.amp,
     )
+    check_amp(args)
 
     # Set seed
     set_seed(args.seed, args.n_gpu)
@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import contextlib
+import logging
 import math
 import os
 import random
@@ -14,6 +16,8 @@ import torch
 
 from utils_data import load_datasets
 
+logger = logging.getLogger(__name__)
+
 
 def set_seed(seed, n_gpu):
     random.seed(seed)
@@ -23,6 +27,96 @@ def set_seed(seed, n_gpu):
         torch.cuda.manual_seed_all(seed)
 
 
+def torch_version():
+    """ (major, minor) of the installed torch """
+    return tuple(int(part) for part in re.findall(r"\d+", torch.__version__)[:2])
+
+
+def check_amp(args):
+    """ Validate --amp against the device and torch version of this run """
+    if args.amp == "off":
+        return
+    if args.amp == "fp16" and args.device.type != "cuda":
+        raise ValueError("--amp fp16 needs a CUDA device, use --amp bf16 on CPU")
+    # torch.cuda.amp arrived in 1.6, device-generic torch.autocast and bf16 in 1.10
+    required = (1, 10) if args.amp == "bf16" else (1, 6)
+    if torch_version() < required:
+        raise RuntimeError(
+            f"--amp {args.amp} needs torch {required[0]}.{required[1]} or later, "
+            f"found {torch.__version__}"
+        )
+
+
+class NoAutocast(object):
+    """ Stand-in for the autocast context when --amp is off """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def autocast(args):
+    """ Autocast context for the --amp dtype, a no-op when it is off """
+    if args.amp == "off":
+        return NoAutocast()
+    if not hasattr(torch, "autocast"):
+        # Before torch 1.10 only CUDA float16 autocast exists
+        return torch.cuda.amp.autocast()
+    dtype = torch.bfloat16 if args.amp == "bf16" else torch.float16
+    return torch.autocast(device_type=args.device.type, dtype=dtype)
+
+
+def grad_scaler(args):
+    """ Loss scaler for --amp fp16, a pass-through for the other modes """
+    return torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+
+
+def check_amp_parity(args, compute_loss):
+    """
+    Compare the loss returned by `compute_loss` in float32 and under --amp
+    autocast, without gradients, and stop if the relative difference is
+    larger than --amp_tolerance
+    """
+    if args.amp == "off":
+        return
+    # Both runs draw the same random numbers, e.g. for dropout or sampling
+    devices = range(torch.cuda.device_count()) if args.device.type == "cuda" else []
+    with torch.no_grad():
+        with torch.random.fork_rng(devices=devices):
+            reference = float(compute_loss())
+        with torch.random.fork_rng(devices=devices), autocast(args):
+            mixed = float(compute_loss())
+    difference = abs(mixed - reference) / max(abs(reference), 1e-6)
+    logger.info(
+        "AMP parity: %s loss %.5f, float32 loss %.5f, relative difference %.5f",
+        args.amp,
+        mixed,
+        reference,
+        difference,
+    )
+    if difference > args.amp_tolerance:
+        raise RuntimeError(
+            f"--amp {args.amp} loss differs from float32 by {difference:.5f} "
+            f"(> --amp_tolerance {args.amp_tolerance})"
+        )
+
+
+def no_sync(models, skip_sync):
+    """
+    Suspend the DDP gradient all-reduce of `models` while `skip_sync` is set,
+    so intermediate micro-batches of an accumulation window only add their
+    gradients locally. Models that are not DDP-wrapped are left alone.
+    """
+    contexts = contextlib.ExitStack()
+    if skip_sync:
+        for model in models:
+            if hasattr(model, "no_sync"):
+                contexts.enter_context(model.no_sync())
+    return contexts
+
+
 # padding, unknown word, end of sentence
 base_vocab = ["<PAD>", "<UNK>", "<EOS>", "<NAV>", "<ORA>", "<TAR>"]
 padding_idx = base_vocab.index("<PAD>")
@@ -226,3 +320,41 @@ def length2mask(length, device, size=None):
         > (torch.LongTensor(length) - 1).unsqueeze(1)
     ).to(device)
     return mask
+
+
+class EncoderCache(object):
+    """Dialog encoder outputs of eval-mode passes, keyed by (splits, inst_idx).
+
+    Rows are kept on the host, trimmed to the dialog length, and are only valid
+    for the encoder version they were computed with: a lookup with a new
+    version drops everything. A batch is served from the cache only when every
+    episode in it hits, otherwise the caller re-encodes the whole batch.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.entries = {}
+
+    def lookup(self, keys, version, width, device):
+        if version != self.version:
+            self.version = version
+            self.entries = {}
+        if not all(key in self.entries for key in keys):
+            return None
+
+        rows = [self.entries[key] for key in keys]
+        ctx = rows[0][0].new_zeros(len(rows), width, rows[0][0].size(-1))
+        for i, (row_ctx, _, _) in enumerate(rows):
+            ctx[i, : row_ctx.size(0)] = row_ctx
+        h_t = torch.stack([row[1] for row in rows])
+        c_t = torch.stack([row[2] for row in rows])
+        return (
+            ctx.to(device, non_blocking=True),
+            h_t.to(device, non_blocking=True),
+            c_t.to(device, non_blocking=True),
+        )
+
+    def store(self, keys, lengths, ctx, h_t, c_t):
+        ctx, h_t, c_t = ctx.cpu(), h_t.cpu(), c_t.cpu()
+        for i, (key, length) in enumerate(zip(keys, lengths)):
+            self.entries[key] = (ctx[i, : int(length)].clone(), h_t[i], c_t[i])
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
+import os
 import sys
 from collections import OrderedDict
 
@@ -50,17 +51,11 @@ class BaseAgent(object):
         self.reset_dataloader()
         self.losses = []
         self.results = {}
-        # We rely on env showing the entire batch before repeating anything
-        looped = False
-        with torch.no_grad():
-            while True:
-                for traj in self.rollout(train=False):
-                    if traj["inst_idx"] in self.results:
-                        looped = True
-                    else:
-                        self.results[traj["inst_idx"]] = traj["path"]
-                if looped:
-                    break
+        # Walk the sampler exactly once, the env masks a short final batch
+        with torch.no_grad(), utils.autocast(self.args):
+            for batch in self.data_iter:
+                for traj in self.rollout(train=False, batch=batch):
+                    self.results[traj["inst_idx"]] = traj["path"]
 
 
 class Agent(BaseAgent):
@@ -125,6 +120,16 @@ class Agent(BaseAgent):
         ).to(args.device)
         self.models = (self.encoder, self.decoder)
 
+        if args.freeze_bert:
+            # Only the LSTM encoder and the decoder are trained on top of BERT
+            for param in self.encoder.bert.parameters():
+                param.requires_grad = False
+        # Precomputed outputs of the frozen BERT for the current dataset
+        self.dialog_embeddings = None
+        # TorchScript graphs of export.py, used in place of eval-mode rollouts
+        self.exported_encoder = None
+        self.exported_decoder = None
+
         # Optimizers
         self.encoder_optimizer = Adam(self.encoder.parameters(), lr=args.learning_rate)
         self.decoder_optimizer = Adam(self.decoder.parameters(), lr=args.learning_rate)
@@ -132,6 +137,13 @@ class Agent(BaseAgent):
             self.encoder_optimizer,
             self.decoder_optimizer,
         )
+        self.scaler = utils.grad_scaler(args)
+
+        # Dialog encodings of eval-mode passes, bumped whenever the weights change
+        self.encoder_version = 0
+        self.encoder_cache = (
+            utils.EncoderCache() if args.cache_encoder_outputs else None
+        )
 
         # Evaluations
         self.losses = []
@@ -140,6 +152,15 @@ class Agent(BaseAgent):
         self.episode_len = episode_len
         self.losses = []
 
+        # Reused host buffers for the decoder inputs of every step
+        self.input_buffers = utils.InputFeatureBuffers(
+            batch_size=dataloader.batch_size,
+            views=args.views,
+            feature_size=args.lstm_img_feature_dim + args.angle_feat_size,
+            angle_feat_size=args.angle_feat_size,
+            device=args.device,
+        )
+
     @staticmethod
     def n_inputs():
         return len(Agent.model_actions)
@@ -148,16 +169,62 @@ class Agent(BaseAgent):
     def n_outputs():
         return len(Agent.model_actions) - 2  # Model doesn't output start or ignore
 
+    def _encode(self, perm_obs, seq, seq_lengths, seq_mask, segment_ids):
+        """Run the dialog encoder, or serve its outputs from the encoder cache
+        when the encoder is in eval mode and no gradients are needed."""
+        cache = self.encoder_cache
+        cacheable = (
+            cache is not None
+            and not self.encoder.training
+            and not torch.is_grad_enabled()
+        )
+        inst_idxs = [ob["inst_idx"] for ob in perm_obs]
+        # inst_idx is only unique within a split, and val() swaps dataloaders
+        splits = tuple(self.dataloader.splits)
+        cache_keys = [(splits, inst_idx) for inst_idx in inst_idxs]
+        if cacheable:
+            cached = cache.lookup(
+                cache_keys, self.encoder_version, seq_mask.size(1), self.args.device
+            )
+            if cached is not None:
+                return cached
+
+        if self.exported_encoder is not None and not self.encoder.training:
+            # The graph was traced with the lengths as a host int64 tensor
+            lengths = torch.tensor([int(length) for length in seq_lengths])
+            ctx, h_t, c_t = self.exported_encoder(seq, lengths, seq_mask, segment_ids)
+            if cacheable:
+                cache.store(cache_keys, seq_lengths, ctx, h_t, c_t)
+            return ctx, h_t, c_t
+
+        bert_output = None
+        if self.dialog_embeddings is not None:
+            bert_output = torch.from_numpy(
+                self.dialog_embeddings.batch(inst_idxs, seq_mask.size(1))
+            ).to(self.args.device, non_blocking=True)
+        ctx, h_t, c_t = self.encoder(
+            inputs=seq,
+            lengths=seq_lengths,
+            mask=seq_mask,
+            token_type_ids=segment_ids,
+            bert_output=bert_output,
+        )
+        if cacheable:
+            cache.store(cache_keys, seq_lengths, ctx, h_t, c_t)
+        return ctx, h_t, c_t
+
     def _sort_batch(self, obs):
         """Extract instructions from a list of observations and sort by descending
         sequence length (to enable PyTorch packing)."""
 
-        seq_tensor = np.array([ob["target_dialog_tokens_id"] for ob in obs])
-
-        segment_ids = np.array([ob["target_dialog_segment_ids"] for ob in obs])
+        seqs = [ob["target_dialog_tokens_id"] for ob in obs]
+        seq_lengths = utils.sequence_lengths(seqs, self.pad_token_id)
 
-        seq_lengths = np.argmax(seq_tensor == self.pad_token_id, axis=1)
-        seq_lengths[seq_lengths == 0] = seq_tensor.shape[1]  # Full length
+        # Pad only to the longest dialog of the batch
+        seq_tensor = utils.pad_batch(seqs, seq_lengths, self.pad_token_id)
+        segment_ids = utils.pad_batch(
+            [ob["target_dialog_segment_ids"] for ob in obs], seq_lengths, 0
+        )
 
         seq_tensor = torch.from_numpy(seq_tensor)
 
@@ -169,9 +236,7 @@ class Agent(BaseAgent):
         sorted_tensor = seq_tensor[perm_idx]
 
         sorted_segment_ids = segment_ids[perm_idx]
-        mask = (sorted_tensor == self.pad_token_id)[
-            :, : seq_lengths[0]
-        ]  # seq_lengths[0] is the Maximum length
+        mask = sorted_tensor == self.pad_token_id
 
         return (
             Variable(sorted_tensor, requires_grad=False).long().to(self.args.device),
@@ -183,50 +248,6 @@ class Agent(BaseAgent):
             list(perm_idx),
         )
 
-    def _feature_variable(self, obs):
-        """ Extract precomputed features into variable. """
-        features = np.empty(
-            (
-                len(obs),
-                self.args.views,
-                self.args.lstm_img_feature_dim + self.args.angle_feat_size,
-            ),
-            dtype=np.float32,
-        )
-        for i, ob in enumerate(obs):
-            features[i, :, :] = ob["feature"]  # Image feat
-        return Variable(torch.from_numpy(features), requires_grad=False).to(
-            self.args.device
-        )
-
-    def _candidate_variable(self, obs):
-        candidate_leng = [len(ob["candidate"]) + 1 for ob in obs]  # +1 is for the end
-        candidate_feat = np.zeros(
-            (
-                len(obs),
-                max(candidate_leng),
-                self.args.lstm_img_feature_dim + self.args.angle_feat_size,
-            ),
-            dtype=np.float32,
-        )
-        # Note: The candidate_feat at len(ob['candidate']) is the feature for the END
-        # which is zero in my implementation
-        for i, ob in enumerate(obs):
-            for j, c in enumerate(ob["candidate"]):
-                candidate_feat[i, j, :] = c["feature"]  # Image feat
-        return torch.from_numpy(candidate_feat).to(self.args.device), candidate_leng
-
-    def get_input_feat(self, obs):
-        input_a_t = np.zeros((len(obs), self.args.angle_feat_size), np.float32)
-        for i, ob in enumerate(obs):
-            input_a_t[i] = utils.angle_feature(ob["heading"], ob["elevation"])
-        input_a_t = torch.from_numpy(input_a_t).to(self.args.device)
-
-        f_t = self._feature_variable(obs)  # Image features from obs
-        candidate_feat, candidate_leng = self._candidate_variable(obs)
-
-        return input_a_t, f_t, candidate_feat, candidate_leng
-
     def _teacher_action(self, obs, ended):
         """
         Extract teacher actions into variable.
@@ -263,18 +284,6 @@ class Agent(BaseAgent):
         self.dataloader.batch = batch
         return batch
 
-    def _verify_batch_size(self, batch):
-        batch_size = self.dataloader.batch_size
-
-        if len(batch) != batch_size:
-            remaining_no = batch_size - len(batch)
-            extra_batch = self._get_batch()
-            new_batch = batch + extra_batch[: batch_size - len(batch)]
-            assert batch_size == len(new_batch)
-            self.dataloader.batch = new_batch
-            return new_batch
-        return batch
-
     def make_equiv_action(self, a_t, perm_obs, perm_idx=None, traj=None):
         """
         Interface between Panoramic view and Egocentric view
@@ -321,20 +330,14 @@ class Agent(BaseAgent):
                 take_action(i, idx, select_candidate["idx"])
 
     def get_input_feat(self, obs):
-        input_a_t = np.zeros((len(obs), self.args.angle_feat_size), np.float32)
-        for i, ob in enumerate(obs):
-            input_a_t[i] = utils.angle_feature(ob["heading"], ob["elevation"])
-        input_a_t = torch.from_numpy(input_a_t).to(self.args.device)
-
-        f_t = self._feature_variable(obs)  # Image features from obs
-        candidate_feat, candidate_leng = self._candidate_variable(obs)
+        return self.input_buffers.fill(obs)
 
-        return input_a_t, f_t, candidate_feat, candidate_leng
+    def rollout(self, train=True, batch=None):
 
-    def rollout(self, train=True):
-
-        batch = self._get_batch()
-        batch = self._verify_batch_size(batch)
+        if batch is None:
+            batch = self._get_batch()
+        else:
+            self.dataloader.batch = batch
 
         scan_ids = [item["scan"] for item in batch]
 
@@ -347,12 +350,7 @@ class Agent(BaseAgent):
         seq_lengths = torch.tensor(seq_lengths)
         perm_obs = obs[perm_idx]
 
-        ctx, h_t, c_t = self.encoder(
-            inputs=seq,
-            lengths=seq_lengths,
-            mask=seq_mask,
-            token_type_ids=segment_ids,
-        )
+        ctx, h_t, c_t = self._encode(perm_obs, seq, seq_lengths, seq_mask, segment_ids)
         ctx_mask = seq_mask
 
         # Record starting point
@@ -376,34 +374,54 @@ class Agent(BaseAgent):
 
         h1 = h_t
 
+        # Positions in perm_obs of the episodes the decoder is run on
+        active = np.arange(batch_size)
+
         for t in range(self.episode_len):
+            step_obs = perm_obs[active]
             input_a_t, f_t, candidate_feat, candidate_leng = self.get_input_feat(
-                perm_obs
-            )
-            h_t, c_t, logit, h1 = self.decoder(
-                input_a_t,
-                f_t,
-                candidate_feat,
-                h_t,
-                h1,
-                c_t,
-                ctx,
-                ctx_mask,
+                step_obs
             )
+            if self.exported_decoder is not None and not self.decoder.training:
+                # The exported step already masks the padded candidates
+                h_t, c_t, logit, h1 = self.exported_decoder(
+                    input_a_t,
+                    f_t,
+                    candidate_feat,
+                    torch.tensor(
+                        candidate_leng, dtype=torch.int64, device=self.args.device
+                    ),
+                    h_t,
+                    h1,
+                    c_t,
+                    ctx,
+                    ctx_mask,
+                )
+            else:
+                h_t, c_t, logit, h1 = self.decoder(
+                    input_a_t,
+                    f_t,
+                    candidate_feat,
+                    h_t,
+                    h1,
+                    c_t,
+                    ctx,
+                    ctx_mask,
+                )
 
             # Mask outputs where agent can't move forward
             # Here the logit is [b, max_candidate]
             candidate_mask = utils.length2mask(candidate_leng, self.args.device)
             if self.args.submit:  # Avoding cyclic path
-                for ob_id, ob in enumerate(perm_obs):
-                    visited[ob_id].add(ob["viewpoint"])
+                for ob_id, ob in enumerate(step_obs):
+                    visited[active[ob_id]].add(ob["viewpoint"])
                     for c_id, c in enumerate(ob["candidate"]):
-                        if c["viewpointId"] in visited[ob_id]:
+                        if c["viewpointId"] in visited[active[ob_id]]:
                             candidate_mask[ob_id][c_id] = 1
             logit.masked_fill_(candidate_mask, -float("inf"))
 
             # Supervised training
-            target = self._teacher_action(perm_obs, ended)
+            target = self._teacher_action(step_obs, ended[active])
 
             current_loss = self.criterion(logit, target)
             if self.args.detach_loss:
@@ -431,18 +449,23 @@ class Agent(BaseAgent):
                 if (
                     next_id == (candidate_leng[i] - 1)
                     or next_id == self.args.ignoreid
-                    or ended[i]
+                    or ended[active[i]]
                 ):  # The last action is <end>
                     cpu_a_t[i] = -1  # Change the <end> and ignore action to -1
 
+            # Scatter the actions back to the full batch, episodes which are
+            # not decoded stay put
+            env_a_t = np.full(batch_size, -1, dtype=cpu_a_t.dtype)
+            env_a_t[active] = cpu_a_t
+
             # Make action and get the new state
-            self.make_equiv_action(cpu_a_t, perm_obs, perm_idx, traj)
+            self.make_equiv_action(env_a_t, perm_obs, perm_idx, traj)
             obs = np.array(self.dataloader._get_obs())
             perm_obs = obs[perm_idx]
 
             # Update the finished actions
             # -1 means ended or ignored (already ended)
-            ended[:] = np.logical_or(ended, (cpu_a_t == -1))
+            ended[:] = np.logical_or(ended, (env_a_t == -1))
 
             if self.args.detach_loss and train and self.episode_len >= 30:
                 if (
@@ -458,7 +481,9 @@ class Agent(BaseAgent):
                         self.non_avg_loss /= self.args.detach_loss_at
 
                         self.loss += self.non_avg_loss
-                        self.loss.backward()
+                        self.scaler.scale(
+                            self.loss / self.args.gradient_accumulation_steps
+                        ).backward()
 
                         self.loss.detach_()
                         self.non_avg_loss = torch.zeros(1).to(self.args.device)
@@ -466,6 +491,23 @@ class Agent(BaseAgent):
             # Early exit if all ended
             if ended.all():
                 break
+
+            # Drop the finished episodes from the decoder state
+            if self.args.compact_active_batch:
+                keep = ~ended[active]
+                if not keep.all():
+                    active = active[keep]
+                    keep_idx = torch.from_numpy(np.nonzero(keep)[0]).to(
+                        self.args.device
+                    )
+                    # Sequences are sorted by length, so the first active one
+                    # is the longest left
+                    max_len = int(seq_lengths[active[0]])
+                    h_t = h_t[keep_idx]
+                    c_t = c_t[keep_idx]
+                    h1 = h1[keep_idx]
+                    ctx = ctx[keep_idx, :max_len]
+                    ctx_mask = ctx_mask[keep_idx, :max_len]
         if self.args.detach_loss:
             self.loss = self.loss / (self.episode_len // self.args.detach_loss_at)
         else:
@@ -483,6 +525,7 @@ class Agent(BaseAgent):
             ]  # no cheating by using teacher at test time!
         self.feedback = feedback
         if use_dropout:
+            # The encoder cache only serves eval-mode passes, this one is uncached
             self.encoder.train()
             self.decoder.train()
         else:
@@ -490,6 +533,30 @@ class Agent(BaseAgent):
             self.decoder.eval()
         super(Agent, self).test()
 
+    def check_amp_parity(self):
+        """
+        Compare the loss of a teacher-forced eval rollout on the next training
+        batch in float32 and under --amp, before training starts
+        """
+        if self.args.amp == "off":
+            return
+        batch = self._get_batch()
+
+        def compute_loss():
+            self.rollout(train=False, batch=batch)
+            self.losses.pop()
+            # Outside training the detached chunks are not folded into self.loss
+            return self.non_avg_loss if self.args.detach_loss else self.loss
+
+        feedback = getattr(self, "feedback", None)
+        self.feedback = "teacher"
+        self.encoder.eval()
+        self.decoder.eval()
+        utils.check_amp_parity(self.args, compute_loss)
+        self.encoder.train()
+        self.decoder.train()
+        self.feedback = feedback
+
     def train(self, n_iters, feedback="teacher"):
         """ Train for a given number of iterations """
         assert feedback in self.feedback_options
@@ -503,19 +570,31 @@ class Agent(BaseAgent):
             self.encoder_optimizer.zero_grad()
             self.decoder_optimizer.zero_grad()
 
-            self.rollout()
-
-            if not self.args.detach_loss:
-                if self.args.local_rank not in [-2, -1]:
-                    self.loss /= dist.get_world_size()
-                    dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
-                self.loss.backward()
-
+            accumulation_steps = self.args.gradient_accumulation_steps
+            for micro_step in range(accumulation_steps):
+                # Only the last rollout of the window all-reduces the gradients
+                with utils.no_sync(
+                    (self.encoder, self.decoder), micro_step < accumulation_steps - 1
+                ):
+                    with utils.autocast(self.args):
+                        self.rollout()
+
+                    if not self.args.detach_loss:
+                        if self.args.local_rank not in [-2, -1]:
+                            self.loss /= dist.get_world_size()
+                            dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
+                        self.scaler.scale(self.loss / accumulation_steps).backward()
+
+            # Clip the true gradients, not the fp16 loss-scaled ones
+            self.scaler.unscale_(self.encoder_optimizer)
+            self.scaler.unscale_(self.decoder_optimizer)
             torch.nn.utils.clip_grad_norm(self.encoder.parameters(), 40.0)
             torch.nn.utils.clip_grad_norm(self.decoder.parameters(), 40.0)
 
-            self.encoder_optimizer.step()
-            self.decoder_optimizer.step()
+            self.scaler.step(self.encoder_optimizer)
+            self.scaler.step(self.decoder_optimizer)
+            self.scaler.update()
+            self.encoder_version += 1
 
     def save(self, encoder_path, decoder_path):
         """ Snapshot models """
@@ -532,8 +611,31 @@ class Agent(BaseAgent):
         torch.save(encoder_weights, encoder_path)
         torch.save(decoder_weights, decoder_path)
 
+    def load_exported(self, export_dir):
+        """ Loads the TorchScript encoder and decoder step written by export.py """
+        with open(os.path.join(export_dir, "export.json")) as handle:
+            meta = json.load(handle)
+        if meta["format"] != "torchscript":
+            raise ValueError(
+                f"{export_dir} holds {meta['format']} graphs, not torchscript"
+            )
+        # Traced graphs keep the device of the tensors they created while tracing
+        if torch.device(meta["device"]).type != self.args.device.type:
+            raise ValueError(
+                f"{export_dir} was traced on {meta['device']} "
+                f"and cannot run on {self.args.device}"
+            )
+        self.encoder_version += 1
+        self.exported_encoder = torch.jit.load(
+            os.path.join(export_dir, "encoder.pt"), map_location=self.args.device
+        )
+        self.exported_decoder = torch.jit.load(
+            os.path.join(export_dir, "decoder_step.pt"), map_location=self.args.device
+        )
+
     def load(self, encoder_path, decoder_path):
         """ Loads parameters (but not training state) """
+        self.encoder_version += 1
         print("%s %s" % (encoder_path, decoder_path))
         encoder_weights = torch.load(encoder_path)
         decoder_weights = torch.load(decoder_path)
@@ -189,6 +189,69 @@ class EncoderLSTMOscar(nn.Module):
             # (batch, hidden_size)
 
 
+def gather_appended(prefix_states, new_states, prefix_lengths, lengths, width):
+    """Rows of [prefix_states | new_states] packed to the left: the first
+    prefix_lengths[b] prefix positions followed by the new positions, zero from
+    lengths[b] on, `width` positions in total."""
+    positions = torch.arange(width, device=lengths.device).unsqueeze(0)
+    prefix_lengths = prefix_lengths.unsqueeze(1)
+    index = torch.where(
+        positions < prefix_lengths,
+        positions,
+        positions - prefix_lengths + prefix_states.size(1),
+    )
+    combined = torch.cat((prefix_states, new_states), 1)
+    index = index.clamp(max=max(combined.size(1) - 1, 0))
+    gathered = combined.gather(1, index.unsqueeze(-1).expand(-1, -1, combined.size(-1)))
+    valid = positions < lengths.unsqueeze(1)
+    return gathered * valid.unsqueeze(-1).to(gathered.dtype)
+
+
+def pad_width(states, width, pad_value=0):
+    """ Pad dim 1 (the sequence length) of `states` on the right to `width` """
+    padding = [0, 0] * (states.dim() - 2) + [0, width - states.size(1)]
+    return F.pad(states, padding, value=pad_value)
+
+
+def scatter_rows(states, rows, new_states, pad_value=0):
+    """`states` with its `rows` replaced by `new_states`, out of place, after
+    padding both along the sequence length to the wider of the two."""
+    width = max(states.size(1), new_states.size(1))
+    return pad_width(states, width, pad_value).index_copy(
+        0, rows, pad_width(new_states, width, pad_value).to(states.dtype)
+    )
+
+
+class DialogHistory(object):
+    """Dialog tokens encoded so far, with the input of every BERT layer and the
+    BERT output at each of their positions, left aligned with `lengths` valid
+    positions per row. See OscarEncoder.encode_dialog_incremental."""
+
+    def __init__(self, tokens, lengths, layer_inputs, outputs):
+        self.tokens = tokens
+        self.lengths = lengths
+        self.layer_inputs = layer_inputs
+        self.outputs = outputs
+
+    def select(self, rows):
+        return DialogHistory(
+            self.tokens[rows],
+            self.lengths[rows],
+            [state[rows] for state in self.layer_inputs],
+            self.outputs[rows],
+        )
+
+    def update(self, rows, history):
+        """ Replace `rows` with the rows of `history`, e.g. a re-encoded select() """
+        self.tokens = scatter_rows(self.tokens, rows, history.tokens)
+        self.lengths = self.lengths.index_copy(0, rows, history.lengths)
+        self.layer_inputs = [
+            scatter_rows(state, rows, new_state)
+            for state, new_state in zip(self.layer_inputs, history.layer_inputs)
+        ]
+        self.outputs = scatter_rows(self.outputs, rows, history.outputs)
+
+
 class OscarEncoder(nn.Module):
     """Encodes navigation instructions, returning hidden state context (for
     attention methods) and a decoder initial state."""
@@ -253,6 +316,87 @@ class OscarEncoder(nn.Module):
 
         return h0.to(self.args.device), c0.to(self.args.device)
 
+    def encode_dialog(self, inputs, mask, position_ids=None, token_type_ids=None):
+        """ BERT outputs (batch, seq_len, hidden) of the dialog tokens """
+        outputs = self.bert(
+            inputs,
+            token_type_ids=token_type_ids,
+            attention_mask=~mask,
+            position_ids=position_ids,
+        )
+        return outputs[0]
+
+    def encode_dialog_incremental(self, inputs, mask, token_type_ids, history=None):
+        """BERT outputs (batch, seq_len, hidden) of the dialogs `inputs`, running
+        BERT only over the tokens each row appends to the prefix it shares with
+        the dialog in `history` (the DialogHistory of the previous call, None
+        for the first turn). Appended tokens attend to the cached per-layer
+        states of the prefix, which are not updated with the new turn, so the
+        outputs approximate a full re-encoding. Also returns the DialogHistory
+        for the next call."""
+
+        width = inputs.size(1)
+        lengths = (mask == 0).sum(1)
+        if history is None:
+            prefix = torch.zeros_like(lengths)
+        else:
+            overlap = min(width, history.tokens.size(1))
+            shared = inputs[:, :overlap] == history.tokens[:, :overlap]
+            prefix = shared.long().cumprod(1).sum(1)
+            prefix = torch.min(torch.min(prefix, history.lengths), lengths)
+
+        appended = int((lengths - prefix).max())
+        new_positions = prefix.unsqueeze(1) + torch.arange(
+            appended, device=inputs.device
+        ).unsqueeze(0)
+        new_valid = new_positions < lengths.unsqueeze(1)
+        new_positions = new_positions.clamp(max=width - 1)
+
+        if appended == 0:
+            new_layer_inputs = [state[:, :0] for state in history.layer_inputs]
+            new_outputs = history.outputs[:, :0]
+        else:
+            embedding_output = self.bert.embeddings(
+                inputs.gather(1, new_positions),
+                token_type_ids=token_type_ids.gather(1, new_positions),
+                position_ids=new_positions,
+            )
+            key_mask = new_valid
+            if history is not None:
+                prefix_positions = torch.arange(
+                    history.outputs.size(1), device=inputs.device
+                )
+                prefix_valid = prefix_positions.unsqueeze(0) < prefix.unsqueeze(1)
+                key_mask = torch.cat((prefix_valid, new_valid), 1)
+            extended_mask = key_mask[:, None, None, :].to(embedding_output.dtype)
+            extended_mask = (1.0 - extended_mask) * -10000.0
+
+            encoder_outputs = self.bert.encoder(
+                embedding_output,
+                extended_mask,
+                head_mask=[None] * len(self.bert.encoder.layer),
+                encoder_history_states=(
+                    None if history is None else history.layer_inputs
+                ),
+                output_hidden_states=True,
+            )
+            new_outputs = encoder_outputs[0]
+            new_layer_inputs = encoder_outputs[1][:-1]
+
+        if history is None:
+            prefix_layer_inputs = [state[:, :0] for state in new_layer_inputs]
+            prefix_outputs = new_outputs[:, :0]
+        else:
+            prefix_layer_inputs = history.layer_inputs
+            prefix_outputs = history.outputs
+
+        layer_inputs = [
+            gather_appended(prefix_state, new_state, prefix, lengths, width)
+            for prefix_state, new_state in zip(prefix_layer_inputs, new_layer_inputs)
+        ]
+        outputs = gather_appended(prefix_outputs, new_outputs, prefix, lengths, width)
+        return outputs, DialogHistory(inputs, lengths, layer_inputs, outputs)
+
     def forward(
         self,
         inputs,
@@ -260,21 +404,24 @@ class OscarEncoder(nn.Module):
         mask,
         position_ids=None,
         token_type_ids=None,
+        bert_output=None,
     ):
         """Expects input vocab indices as (batch, seq_len). Also requires a
-        list of lengths for dynamic batching."""
+        list of lengths for dynamic batching. `bert_output` replaces the BERT
+        pass with precomputed outputs of a frozen BERT."""
 
         seq_max_len = mask.size(1)
         att_mask = ~mask
 
-        outputs = self.bert(
-            inputs,
-            token_type_ids=token_type_ids,
-            attention_mask=att_mask,
-            position_ids=position_ids,
-        )
-
-        output = outputs[0]
+        if bert_output is None:
+            output = self.encode_dialog(
+                inputs,
+                mask,
+                position_ids=position_ids,
+                token_type_ids=token_type_ids,
+            )
+        else:
+            output = bert_output
 
         if self.reverse_input:
             reversed_output = torch.zeros(output.size()).to(output.device)
@@ -299,7 +446,10 @@ class OscarEncoder(nn.Module):
         if self.hidden_size * self.num_directions != self.dec_hidden_size:
             c_t = self.encoder_lstm2decoder_ct(c_t)
 
-        ctx, lengths = pad_packed_sequence(enc_h, batch_first=True)
+        # Keep ctx as wide as the (padded) mask
+        ctx, lengths = pad_packed_sequence(
+            enc_h, batch_first=True, total_length=seq_max_len
+        )
 
         ctx = self.drop(ctx)
 
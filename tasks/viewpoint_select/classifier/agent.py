@@ -59,18 +59,11 @@ class BaseAgent(object):
         self.reset_dataloader()
         self.losses = []
         self.results = {}
-        # We rely on env showing the entire batch before repeating anything
-        # print "Testing %s" % self.__class__.__name__
-        looped = False
-        with torch.no_grad():
-            while True:
-                for traj in self.rollout(train=False):
-                    if traj["inst_idx"] in self.results:
-                        looped = True
-                    else:
-                        self.results[traj["inst_idx"]] = traj["path"]
-                if looped:
-                    break
+        # Walk the sampler exactly once, the env masks a short final batch
+        with torch.no_grad(), utils.autocast(self.args):
+            for batch in self.data_iter:
+                for traj in self.rollout(train=False, batch=batch):
+                    self.results[traj["inst_idx"]] = traj["path"]
 
 
 class Agent(BaseAgent):
@@ -152,6 +145,7 @@ class Agent(BaseAgent):
             self.encoder_optimizer,
             self.decoder_optimizer,
         )
+        self.scaler = utils.grad_scaler(args)
 
         # Evaluations
         self.losses = []
@@ -165,6 +159,15 @@ class Agent(BaseAgent):
         self.episode_len = episode_len
         self.losses = []
 
+        # Reused host buffers for the decoder inputs of every step
+        self.input_buffers = utils.InputFeatureBuffers(
+            batch_size=dataloader.batch_size,
+            views=args.views,
+            feature_size=args.lstm_img_feature_dim + args.angle_feat_size,
+            angle_feat_size=args.angle_feat_size,
+            device=args.device,
+        )
+
         self.logs = {"predictions": [], "labels": []}
         self.metrics = {}
 
@@ -182,12 +185,15 @@ class Agent(BaseAgent):
         """Extract instructions from a list of observations and sort by descending
         sequence length (to enable PyTorch packing)."""
 
-        seq_tensor = np.array([ob["target_dialog_tokens_id"] for ob in obs])
-        if not self.args.no_pretrained_model:
-            segment_ids = np.array([ob["target_dialog_segment_ids"] for ob in obs])
+        seqs = [ob["target_dialog_tokens_id"] for ob in obs]
+        seq_lengths = utils.sequence_lengths(seqs, self.pad_token_id)
 
-        seq_lengths = np.argmax(seq_tensor == self.pad_token_id, axis=1)
-        seq_lengths[seq_lengths == 0] = seq_tensor.shape[1]  # Full length
+        # Pad only to the longest dialog of the batch
+        seq_tensor = utils.pad_batch(seqs, seq_lengths, self.pad_token_id)
+        if not self.args.no_pretrained_model:
+            segment_ids = utils.pad_batch(
+                [ob["target_dialog_segment_ids"] for ob in obs], seq_lengths, 0
+            )
 
         seq_tensor = torch.from_numpy(seq_tensor)
         if not self.args.no_pretrained_model:
@@ -199,9 +205,7 @@ class Agent(BaseAgent):
         sorted_tensor = seq_tensor[perm_idx]
         if not self.args.no_pretrained_model:
             sorted_segment_ids = segment_ids[perm_idx]
-        mask = (sorted_tensor == self.pad_token_id)[
-            :, : seq_lengths[0]
-        ]  # seq_lengths[0] is the Maximum length
+        mask = sorted_tensor == self.pad_token_id
 
         return (
             Variable(sorted_tensor, requires_grad=False).long().to(self.args.device),
@@ -215,49 +219,8 @@ class Agent(BaseAgent):
             list(perm_idx),
         )
 
-    def _feature_variable(self, obs):
-        """ Extract precomputed features into variable. """
-        features = np.empty(
-            (
-                len(obs),
-                self.args.views,
-                self.args.lstm_img_feature_dim + self.args.angle_feat_size,
-            ),
-            dtype=np.float32,
-        )
-        for i, ob in enumerate(obs):
-            features[i, :, :] = ob["feature"]  # Image feat
-        return Variable(torch.from_numpy(features), requires_grad=False).to(
-            self.args.device
-        )
-
-    def _candidate_variable(self, obs):
-        candidate_leng = [len(ob["candidate"]) + 1 for ob in obs]  # +1 is for the end
-        candidate_feat = np.zeros(
-            (
-                len(obs),
-                max(candidate_leng),
-                self.args.lstm_img_feature_dim + self.args.angle_feat_size,
-            ),
-            dtype=np.float32,
-        )
-        # Note: The candidate_feat at len(ob['candidate']) is the feature for the END
-        # which is zero in my implementation
-        for i, ob in enumerate(obs):
-            for j, c in enumerate(ob["candidate"]):
-                candidate_feat[i, j, :] = c["feature"]  # Image feat
-        return torch.from_numpy(candidate_feat).to(self.args.device), candidate_leng
-
     def get_input_feat(self, obs):
-        input_a_t = np.zeros((len(obs), self.args.angle_feat_size), np.float32)
-        for i, ob in enumerate(obs):
-            input_a_t[i] = utils.angle_feature(ob["heading"], ob["elevation"])
-        input_a_t = torch.from_numpy(input_a_t).to(self.args.device)
-
-        f_t = self._feature_variable(obs)  # Image features from obs
-        candidate_feat, candidate_leng = self._candidate_variable(obs)
-
-        return input_a_t, f_t, candidate_feat, candidate_leng
+        return self.input_buffers.fill(obs)
 
     def _teacher_action(self, obs, ended):
         """
@@ -295,19 +258,6 @@ class Agent(BaseAgent):
         self.dataloader.batch = batch
         return batch
 
-    def _verify_batch_size(self, batch):
-        batch_size = self.dataloader.batch_size
-
-        if len(batch) != batch_size:
-            # print("Batch length not equal to batch size, padding towards the end!")
-            remaining_no = batch_size - len(batch)
-            extra_batch = self._get_batch()
-            new_batch = batch + extra_batch[: batch_size - len(batch)]
-            assert batch_size == len(new_batch)
-            self.dataloader.batch = new_batch
-            return new_batch
-        return batch
-
     def make_equiv_action(self, a_t, perm_obs, perm_idx=None, traj=None):
         """
         Interface between Panoramic view and Egocentric view
@@ -372,10 +322,51 @@ class Agent(BaseAgent):
             torch.from_numpy(ignore_indices).to(self.args.device),
         )
 
-    def rollout(self, train=True):
+    def _encode_dialog(self, timestep, dialog_history=None, rows=None):
+        """Encode the dialogs at `timestep` of the batch, or of its `rows` only.
+        With --incremental_dialog_encoding BERT only runs over the turns added
+        since `dialog_history`, the state of the whole batch kept across calls."""
+        seq, segment_ids, seq_mask, seq_lengths = self.dataloader.get_language_input(
+            timestep=timestep, pad_token_id=self.pad_token_id, rows=rows
+        )
+        seq_lengths = torch.tensor(seq_lengths)
 
-        batch = self._get_batch()
-        batch = self._verify_batch_size(batch)
+        bert_output = None
+        with torch.no_grad():
+            if self.args.incremental_dialog_encoding:
+                encoder = (
+                    self.encoder.module
+                    if hasattr(self.encoder, "module")
+                    else self.encoder
+                )
+                partial = dialog_history is not None and rows is not None
+                if partial:
+                    row_index = torch.tensor(rows, device=self.args.device)
+                    previous = dialog_history.select(row_index)
+                else:
+                    previous = dialog_history
+                bert_output, history = encoder.encode_dialog_incremental(
+                    seq, seq_mask, segment_ids, previous
+                )
+                if partial:
+                    dialog_history.update(row_index, history)
+                else:
+                    dialog_history = history
+            ctx, h_t, c_t = self.encoder(
+                inputs=seq,
+                lengths=seq_lengths,
+                mask=seq_mask,
+                token_type_ids=segment_ids,
+                bert_output=bert_output,
+            )
+        return ctx, h_t, c_t, seq_mask, dialog_history
+
+    def rollout(self, train=True, batch=None):
+
+        if batch is None:
+            batch = self._get_batch()
+        else:
+            self.dataloader.batch = batch
 
         # scan_ids = [item["scan"] for item in batch]
 
@@ -402,72 +393,33 @@ class Agent(BaseAgent):
         if self.args.detach_loss:
             self.non_avg_loss = torch.zeros(1).to(self.args.device)
 
-        pass_through_encoder = False
-
-        (seq, segment_ids, seq_mask, seq_lengths,) = self.dataloader.get_language_input(
-            timestep=0, pad_token_id=self.pad_token_id
-        )
-
-        # seq, segment_ids, seq_mask, seq_lengths, perm_idx = self._sort_batch(batch)
-        seq_lengths = torch.tensor(seq_lengths)
-        with torch.no_grad():
-            ctx, h_t, c_t = self.encoder(
-                inputs=seq,
-                lengths=seq_lengths,
-                mask=seq_mask,
-                token_type_ids=segment_ids,
-            )
-            ctx_mask = seq_mask
+        ctx, h_t, c_t, ctx_mask, dialog_history = self._encode_dialog(0)
 
         # episode_labels = [[]] * batch_size
         # episode_predictions = [[]] * batch_size
         for t in range(self.episode_len):
 
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
-            pass_through_encoder = False
-            if t != 0:
-                request_batch_idx = []
-                for i, ob in enumerate(batch):
-                    if t in ob["request_locations"]:
-                        request_batch_idx.append(i)
-                        pass_through_encoder = True
-
-                request_batch_idx = torch.LongTensor(request_batch_idx)
-            if pass_through_encoder:
+            request_rows = [
+                i
+                for i, ob in enumerate(batch)
+                if t != 0 and t in ob["request_locations"]
+            ]
+            if request_rows:
+                # Only the episodes whose dialog grew are re-encoded
                 (
-                    seq,
-                    segment_ids,
-                    seq_mask,
-                    seq_lengths,
-                ) = self.dataloader.get_language_input(
-                    timestep=t, pad_token_id=self.pad_token_id
+                    new_ctx,
+                    new_h_t,
+                    new_c_t,
+                    new_ctx_mask,
+                    dialog_history,
+                ) = self._encode_dialog(t, dialog_history, rows=request_rows)
+                rows = torch.tensor(request_rows, device=self.args.device)
+                ctx = agent_models.scatter_rows(ctx, rows, new_ctx)
+                ctx_mask = agent_models.scatter_rows(
+                    ctx_mask, rows, new_ctx_mask, pad_value=1
                 )
-
-                # seq, segment_ids, seq_mask, seq_lengths, perm_idx = self._sort_batch(batch)
-                seq_lengths = torch.tensor(seq_lengths)
-                with torch.no_grad():
-                    new_ctx, new_h_t, new_c_t = self.encoder(
-                        inputs=seq,
-                        lengths=seq_lengths,
-                        mask=seq_mask,
-                        token_type_ids=segment_ids,
-                    )
-                    new_ctx_mask = seq_mask
-
-                    ctx = new_ctx
-                    h_t = new_h_t
-                    c_t = new_c_t
-                    ctx_mask = new_ctx_mask
-
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-
-                # ctx[request_batch_idx] = new_ctx[request_batch_idx]
-                # h_t[request_batch_idx] = new_h_t[request_batch_idx]
-                # c_t[request_batch_idx] = new_c_t[request_batch_idx]
-                # ctx_mask[request_batch_idx] = new_ctx_mask[request_batch_idx]
+                h_t = h_t.index_copy(0, rows, new_h_t.to(h_t.dtype))
+                c_t = c_t.index_copy(0, rows, new_c_t.to(c_t.dtype))
 
             input_a_t, f_t, candidate_feat, candidate_leng = self.get_input_feat(obs)
             h_t, c_t, logit, h1 = self.decoder(
@@ -570,14 +522,13 @@ class Agent(BaseAgent):
                         self.non_avg_loss /= self.args.detach_loss_at
 
                         self.loss += self.non_avg_loss
-                        self.loss.backward()
+                        self.scaler.scale(
+                            self.loss / self.args.gradient_accumulation_steps
+                        ).backward()
 
                         self.loss.detach_()
                         self.non_avg_loss = torch.zeros(1).to(self.args.device)
 
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
             # Early exit if all ended
             if ended.all():
                 break
@@ -609,6 +560,30 @@ class Agent(BaseAgent):
         super(Agent, self).test()
         self._update_metrics(self.logs)
 
+    def check_amp_parity(self):
+        """
+        Compare the loss of a teacher-forced eval rollout on the next training
+        batch in float32 and under --amp, before training starts
+        """
+        if self.args.amp == "off":
+            return
+        batch = self._get_batch()
+
+        def compute_loss():
+            self.rollout(train=False, batch=batch)
+            self.losses.pop()
+            # Outside training the detached chunks are not folded into self.loss
+            return self.non_avg_loss if self.args.detach_loss else self.loss
+
+        feedback = getattr(self, "feedback", None)
+        self.feedback = "teacher"
+        self.encoder.eval()
+        self.decoder.eval()
+        utils.check_amp_parity(self.args, compute_loss)
+        self.encoder.train()
+        self.decoder.train()
+        self.feedback = feedback
+
     def train(self, n_iters, feedback="teacher"):
         """ Train for a given number of iterations """
         assert feedback in self.feedback_options
@@ -626,21 +601,30 @@ class Agent(BaseAgent):
                 self.encoder_optimizer.zero_grad()
             self.decoder_optimizer.zero_grad()
 
-            self.rollout()
+            accumulation_steps = self.args.gradient_accumulation_steps
+            for micro_step in range(accumulation_steps):
+                # Only the last rollout of the window all-reduces the gradients
+                with utils.no_sync(
+                    (self.encoder, self.decoder), micro_step < accumulation_steps - 1
+                ):
+                    with utils.autocast(self.args):
+                        self.rollout()
 
-            if not self.args.detach_loss:
-                if self.args.local_rank not in [-2, -1]:
-                    self.loss /= dist.get_world_size()
-                    dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
-                self.loss.backward()
+                    if not self.args.detach_loss:
+                        if self.args.local_rank not in [-2, -1]:
+                            self.loss /= dist.get_world_size()
+                            dist.all_reduce(self.loss, op=dist.ReduceOp.SUM)
+                        self.scaler.scale(self.loss / accumulation_steps).backward()
 
             # if not self.args.only_finetune_classifier:
             #     torch.nn.utils.clip_grad_norm(self.encoder.parameters(), 40.0)
             # torch.nn.utils.clip_grad_norm(self.decoder.parameters(), 40.0)
 
+            # The encoder runs under no_grad, its optimizer usually has nothing to step
             if not self.args.only_finetune_classifier:
-                self.encoder_optimizer.step()
-            self.decoder_optimizer.step()
+                utils.scaler_step(self.scaler, self.encoder_optimizer)
+            utils.scaler_step(self.scaler, self.decoder_optimizer)
+            self.scaler.update()
 
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -15,6 +15,7 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 from utils_data import (
+    BatchTokenizer,
     load_classifier_data,
     load_datasets,
     load_nav_graphs,
@@ -46,6 +47,7 @@ class EnvBatch:
             self.vfov = feature_store["vfov"]
 
         self.batch_size = batch_size
+        self.num_episodes = batch_size
         self.sim = MatterSim.Simulator()
         self.sim.setRenderingEnabled(False)
         self.sim.setDiscretizedViewingAngles(True)
@@ -58,12 +60,21 @@ class EnvBatch:
         return scanId + "_" + viewpointId
 
     def newEpisodes(self, scanIds, viewpointIds, headings):
-        self.sim.newEpisode(scanIds, viewpointIds, headings, [0] * self.batch_size)
+        # A short batch fills the remaining simulator slots with copies of its
+        # first episode, those slots are masked out of getStates
+        self.num_episodes = len(scanIds)
+        pad = self.batch_size - self.num_episodes
+        self.sim.newEpisode(
+            scanIds + scanIds[:1] * pad,
+            viewpointIds + viewpointIds[:1] * pad,
+            headings + headings[:1] * pad,
+            [0] * self.batch_size,
+        )
 
     def getStates(self):
         """ Get list of states augmented with precomputed image features. rgb field will be empty. """
         feature_states = []
-        for state in self.sim.getState():
+        for state in self.sim.getState()[: self.num_episodes]:
             long_id = self._make_id(state.scanId, state.location.viewpointId)
             if self.features:
                 feature = self.features[long_id]
@@ -138,13 +149,26 @@ class ClassifierDataset(Dataset):
 
         ratios = []
 
-        for item in load_classifier_data(splits):
+        # Every timestep repeats the earlier turns, tokenize each string once
+        batch_tokenizer = BatchTokenizer(tokenizer, num_workers=args.num_workers)
+        classifier_items = load_classifier_data(splits)
+        batch_tokenizer.prefetch(
+            [item["target"] for item in classifier_items]
+            + [
+                turn
+                for item in classifier_items
+                for dialog in item["dialog_history"].values()
+                for turn in dialog
+            ]
+        )
+
+        for item in classifier_items:
             self.scans.append(item["scan"])
 
             new_item = dict(item)
             new_item["inst_idx"] = item["inst_idx"]
 
-            token_target = tokenizer.tokenize(item["target"])
+            token_target = batch_tokenizer.tokenize(item["target"])
             token_target = token_target[:MAX_TARGET_LENGTH]
             new_item["token_target"] = token_target
 
@@ -154,7 +178,7 @@ class ClassifierDataset(Dataset):
             for timestep, dialog in dialog_history.items():
                 token_dialog_history = []
                 for turn in dialog:
-                    token_turn = tokenizer.tokenize(turn)
+                    token_turn = batch_tokenizer.tokenize(turn)
                     token_dialog_history.append(token_turn)
                 if truncate_dialog:
                     # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
@@ -204,11 +228,6 @@ class ClassifierDataset(Dataset):
                 tokens += [tokenizer.sep_token]
                 segment_ids += [sep_token_segment_id]
 
-                tokens += [pad_token_id] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                segment_ids += [pad_token_segment_id] * (
-                    MAX_SEQ_LENGTH - len(segment_ids) - 1
-                )
-
                 tokens_id = tokenizer.convert_tokens_to_ids(tokens)
 
                 # tokens, segment_ids, tokens_id
@@ -255,6 +274,14 @@ class ClassifierDataset(Dataset):
         item = self.data[index]
         return item
 
+    def path_lengths(self):
+        """ Number of viewpoints on the player path (the supervision) of each item. """
+        return [len(item["player_path"]) for item in self.data]
+
+    def item_scans(self):
+        """ Scan of each item, used to group batches by scan. """
+        return [item["scan"] for item in self.data]
+
 
 class ClassifierDataLoader(DataLoader):
     def __init__(
@@ -384,10 +411,12 @@ class ClassifierDataLoader(DataLoader):
                 candidate_new.append(c_new)
             return candidate_new
 
-    def get_language_input(self, timestep, pad_token_id):
+    def get_language_input(self, timestep, pad_token_id, rows=None):
+        """ Dialog inputs at `timestep` of the batch, or of its `rows` only """
+        items = self.batch if rows is None else [self.batch[i] for i in rows]
         seq_tensor = []
         segment_ids = []
-        for item in self.batch:
+        for item in items:
             t = min(timestep, item["max_timestep"])
             try:
                 tokens = item["language"][t]["tokens_id"]
@@ -399,15 +428,13 @@ class ClassifierDataLoader(DataLoader):
             seq_tensor.append(tokens)
             segment_ids.append(segment)
 
-        seq_tensor = np.array(seq_tensor)
-        segment_ids = np.array(segment_ids)
+        seq_lengths = utils.sequence_lengths(seq_tensor, pad_token_id)
 
-        seq_lengths = np.argmax(seq_tensor == pad_token_id, axis=1)
-        seq_lengths[seq_lengths == 0] = seq_tensor.shape[1]  # Full length
+        # Pad only to the longest dialog of the batch
+        seq_tensor = utils.pad_batch(seq_tensor, seq_lengths, pad_token_id)
+        segment_ids = utils.pad_batch(segment_ids, seq_lengths, 0)
 
-        mask = (seq_tensor == pad_token_id)[
-            :, : seq_lengths[0]
-        ]  # seq_lengths[0] is the Maximum length
+        mask = seq_tensor == pad_token_id
 
         seq_tensor = torch.from_numpy(seq_tensor)
         segment_ids = torch.from_numpy(segment_ids)
@@ -10,7 +10,15 @@ import numpy as np
 from torch.utils.data import DataLoader, Dataset
 
 import utils
-from utils_data import load_datasets, load_nav_graphs, truncate_dialogs
+from utils_data import (
+    BatchTokenizer,
+    ItemColumns,
+    get_encoded_cache_path,
+    load_datasets,
+    load_nav_graphs,
+    token_id_dtype,
+    truncate_dialogs,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +45,7 @@ class EnvBatch:
             self.vfov = feature_store["vfov"]
 
         self.batch_size = batch_size
+        self.num_episodes = batch_size
         self.sim = MatterSim.Simulator()
         self.sim.setRenderingEnabled(False)
         self.sim.setDiscretizedViewingAngles(True)
@@ -49,12 +58,21 @@ class EnvBatch:
         return scanId + "_" + viewpointId
 
     def newEpisodes(self, scanIds, viewpointIds, headings):
-        self.sim.newEpisode(scanIds, viewpointIds, headings, [0] * self.batch_size)
+        # A short batch fills the remaining simulator slots with copies of its
+        # first episode, those slots are masked out of getStates
+        self.num_episodes = len(scanIds)
+        pad = self.batch_size - self.num_episodes
+        self.sim.newEpisode(
+            scanIds + scanIds[:1] * pad,
+            viewpointIds + viewpointIds[:1] * pad,
+            headings + headings[:1] * pad,
+            [0] * self.batch_size,
+        )
 
     def getStates(self):
         """ Get list of states augmented with precomputed image features. rgb field will be empty. """
         feature_states = []
-        for state in self.sim.getState():
+        for state in self.sim.getState()[: self.num_episodes]:
             long_id = self._make_id(state.scanId, state.location.viewpointId)
             if self.features:
                 feature = self.features[long_id]
@@ -115,6 +133,91 @@ class VLNDataset(Dataset):
         self.data = []
         self.scans = []
 
+        cache_path = None
+        data = False
+        if args.use_encoded_cache:
+            cache_path = get_encoded_cache_path(
+                tokenizer,
+                "VLN",
+                splits,
+                oscar_setting=args.oscar_setting,
+                tar_back=args.tar_back,
+                truncate_dialog=truncate_dialog,
+                path_type=path_type,
+                add_ndh_data=add_ndh_data,
+                add_r2r_data=add_r2r_data,
+                add_r4r_data=add_r4r_data,
+                add_rxr_data=add_rxr_data,
+            )
+            data = ItemColumns.load(cache_path)
+
+        if data:
+            self.data = data
+            self.scans = self.data.column_values("scan")
+        else:
+            self._encode(
+                tokenizer,
+                splits,
+                truncate_dialog,
+                path_type,
+                add_ndh_data,
+                add_r2r_data,
+                add_r4r_data,
+                add_rxr_data,
+            )
+            # Keep only what the rollout reads, in compact columns
+            self.data = ItemColumns(
+                self.data,
+                sequences={
+                    "target_dialog_tokens_id": token_id_dtype(tokenizer),
+                    "target_dialog_segment_ids": np.int8,
+                },
+                value_sequences=sorted({path_type, "planner_path"}),
+                values=["inst_idx", "scan", "source"],
+                objects=["start_pano"],
+            )
+            if cache_path is not None and args.local_rank in [-2, -1, 0]:
+                self.data.save(cache_path)
+
+        self.scans = set(self.scans)
+        self.splits = splits
+        self.path_type = path_type
+
+        logger.info(
+            "VLNDataset loaded with %d instructions, using splits: %s NDH: %r R2R: %r R4R: %r RxR: %r Supervision: %s"
+            % (
+                len(self.data),
+                ",".join(splits),
+                add_ndh_data,
+                add_r2r_data,
+                add_r4r_data,
+                add_rxr_data,
+                path_type,
+            )
+        )
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        item = self.data[index]
+        return item
+
+    def _encode(
+        self,
+        tokenizer,
+        splits,
+        truncate_dialog,
+        path_type,
+        add_ndh_data,
+        add_r2r_data,
+        add_r4r_data,
+        add_rxr_data,
+    ):
+        """ Tokenize the dialogs and instructions of every source into self.data """
+        args = self.args
+        batch_tokenizer = BatchTokenizer(tokenizer, num_workers=args.num_workers)
+
         use_oscar_settings = args.oscar_setting
 
         TAR_BACK = args.tar_back
@@ -137,20 +240,30 @@ class VLNDataset(Dataset):
         total = 0
         # # TOTAL 768
         if add_ndh_data:
-            for item in load_datasets(splits, dataset_type="NDH"):
+            ndh_items = load_datasets(splits, dataset_type="NDH")
+            batch_tokenizer.prefetch(
+                [item["target"] for item in ndh_items]
+                + [
+                    turn["message"]
+                    for item in ndh_items
+                    for turn in item["dialog_history"]
+                ]
+            )
+            for item in ndh_items:
 
                 self.scans.append(item["scan"])
 
                 new_item = dict(item)
                 new_item["inst_idx"] = item["inst_idx"]
+                new_item["source"] = "NDH"
 
-                token_target = tokenizer.tokenize(item["target"])
+                token_target = batch_tokenizer.tokenize(item["target"])
                 token_target = token_target[:MAX_TARGET_LENGTH]
                 new_item["token_target"] = token_target
 
                 token_dialog_history = []
                 for turn in item["dialog_history"]:
-                    token_turn = tokenizer.tokenize(turn["message"])
+                    token_turn = batch_tokenizer.tokenize(turn["message"])
                     token_dialog_history.append(token_turn)
 
                 if truncate_dialog:
@@ -200,11 +313,6 @@ class VLNDataset(Dataset):
                 tokens += [tokenizer.sep_token]
                 segment_ids += [sep_token_segment_id]
 
-                tokens += [pad_token_id] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                segment_ids += [pad_token_segment_id] * (
-                    MAX_SEQ_LENGTH - len(segment_ids) - 1
-                )
-
                 new_item["target_dialog_tokens"] = tokens
                 new_item["target_dialog_tokens_id"] = tokenizer.convert_tokens_to_ids(
                     tokens
@@ -241,14 +349,19 @@ class VLNDataset(Dataset):
                 f"Planner Paths: {count_planner}({100*count_planner/total}%) Player Paths: {total - count_planner}({100*(total - count_planner)/total}%) Total: {total}"
             )
         if add_r2r_data:
-            for item in load_datasets(splits, dataset_type="R2R"):
+            r2r_items = load_datasets(splits, dataset_type="R2R")
+            batch_tokenizer.prefetch(
+                [instr for item in r2r_items for instr in item["instructions"]]
+            )
+            for item in r2r_items:
                 self.scans.append(item["scan"])
 
                 for j, instr in enumerate(item["instructions"]):
                     new_item = dict(item)
                     new_item["inst_idx"] = "R2R_%s_%d" % (item["path_id"], j)
+                    new_item["source"] = "R2R"
 
-                    token_turn = tokenizer.tokenize(instr)
+                    token_turn = batch_tokenizer.tokenize(instr)
                     token_dialog_history = [token_turn]
 
                     if truncate_dialog:
@@ -285,11 +398,6 @@ class VLNDataset(Dataset):
                     tokens += [tokenizer.sep_token]
                     segment_ids += [sep_token_segment_id]
 
-                    tokens += [pad_token_id] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
-
                     new_item["target_dialog_tokens"] = tokens
                     new_item[
                         "target_dialog_tokens_id"
@@ -310,14 +418,19 @@ class VLNDataset(Dataset):
                     self.data.append(new_item)
 
         if add_r4r_data:
-            for item in load_datasets(splits, dataset_type="R4R"):
+            r4r_items = load_datasets(splits, dataset_type="R4R")
+            batch_tokenizer.prefetch(
+                [instr for item in r4r_items for instr in item["instructions"]]
+            )
+            for item in r4r_items:
                 self.scans.append(item["scan"])
 
                 for j, instr in enumerate(item["instructions"]):
                     new_item = dict(item)
                     new_item["inst_idx"] = "R4R_%s_%d" % (item["path_id"], j)
+                    new_item["source"] = "R4R"
 
-                    token_turn = tokenizer.tokenize(instr)
+                    token_turn = batch_tokenizer.tokenize(instr)
                     token_dialog_history = [token_turn]
 
                     if truncate_dialog:
@@ -354,11 +467,6 @@ class VLNDataset(Dataset):
                     tokens += [tokenizer.sep_token]
                     segment_ids += [sep_token_segment_id]
 
-                    tokens += [pad_token_id] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
-
                     new_item["target_dialog_tokens"] = tokens
                     new_item[
                         "target_dialog_tokens_id"
@@ -379,13 +487,16 @@ class VLNDataset(Dataset):
                     self.data.append(new_item)
 
         if add_rxr_data:
-            for item in load_datasets(splits, dataset_type="RxR"):
+            rxr_items = load_datasets(splits, dataset_type="RxR")
+            batch_tokenizer.prefetch([item["instruction"] for item in rxr_items])
+            for item in rxr_items:
                 self.scans.append(item["scan"])
                 new_item = dict(item)
                 new_item["inst_idx"] = "RxR_%s" % item["instruction_id"]
+                new_item["source"] = "RxR"
                 instr = item["instruction"]
 
-                token_turn = tokenizer.tokenize(instr)
+                token_turn = batch_tokenizer.tokenize(instr)
                 token_dialog_history = [token_turn]
 
                 if truncate_dialog:
@@ -422,11 +533,6 @@ class VLNDataset(Dataset):
                 tokens += [tokenizer.sep_token]
                 segment_ids += [sep_token_segment_id]
 
-                tokens += [pad_token_id] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                segment_ids += [pad_token_segment_id] * (
-                    MAX_SEQ_LENGTH - len(segment_ids) - 1
-                )
-
                 new_item["target_dialog_tokens"] = tokens
                 new_item["target_dialog_tokens_id"] = tokenizer.convert_tokens_to_ids(
                     tokens
@@ -446,29 +552,20 @@ class VLNDataset(Dataset):
 
                 self.data.append(new_item)
 
-        self.scans = set(self.scans)
-        self.splits = splits
-        self.path_type = path_type
+    def path_lengths(self):
+        """ Number of viewpoints on the supervision path of each item. """
+        for path_type in [self.path_type, "planner_path"]:
+            if path_type in self.data:
+                return self.data.lengths(path_type).tolist()
+        return [0] * len(self.data)
 
-        logger.info(
-            "VLNDataset loaded with %d instructions, using splits: %s NDH: %r R2R: %r R4R: %r RxR: %r Supervision: %s"
-            % (
-                len(self.data),
-                ",".join(splits),
-                add_ndh_data,
-                add_r2r_data,
-                add_r4r_data,
-                add_rxr_data,
-                path_type,
-            )
-        )
-
-    def __len__(self):
-        return len(self.data)
+    def item_scans(self):
+        """ Scan of each item, used to group batches by scan. """
+        return self.data.column_values("scan")
 
-    def __getitem__(self, index):
-        item = self.data[index]
-        return item
+    def item_sources(self):
+        """ Source dataset (NDH, R2R, R4R or RxR) of each item, used to mix sources. """
+        return self.data.column_values("source")
 
 
 class VLNDataLoader(DataLoader):
@@ -2,17 +2,28 @@
 # SPDX-License-Identifier: MIT-0
 
 import logging
+import math
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
+from samplers import source_probabilities
 from utils_data import (
+    BatchTokenizer,
+    ItemColumns,
+    ItemColumnsChain,
+    PretrainSteps,
     check_and_load_preprocessed_data,
-    load_datasets,
     load_detector_classes,
+    load_pretraining_data,
+    load_pretraining_shard,
+    load_pretraining_shards,
     save_preprocessed_data,
+    token_id_dtype,
     truncate_dialogs,
 )
 
@@ -43,12 +54,119 @@ def build_viewpoint_loc_embedding(viewIndex):
     return embedding
 
 
+MAX_REGION_LABELS_LENGTH = 180 - 1
+MAX_DIALOG_LEN = 512 - 180 - 4  # including [QUES]s and [ANS]s
+MAX_TARGET_LENGTH = 4 - 2  # [CLS], [TAR], [SEP] after QA and before Action
+
 # pre-compute all the 36 possible paranoram location embeddings
 _static_loc_embeddings = [
     build_viewpoint_loc_embedding(viewIndex) for viewIndex in range(36)
 ]
 
 
+class PretrainCollator(object):
+    """
+    Batch the samples of PretrainDataset and apply MLM/MTP masking to the
+    whole batch at once. The text part is padded only to the longest text of
+    the batch, rounded up to a multiple of 8, and the image positions follow
+    it. With mask_on_device, masking is left to `mask_batch` so that it can
+    run on the training device after the batch has been moved there.
+    """
+
+    def __init__(self, args, tokenizer, mask_on_device=False):
+        self.mlm_probability = args.mlm_probability
+        self.masked_token_prediction = args.masked_token_prediction
+        self.mask_on_device = mask_on_device
+        self.pad_token_id = tokenizer.pad_token_id
+        self.mask_token_id = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+        self.vocab_size = len(tokenizer)
+        self.special_ids = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.special_ids[tokenizer.all_special_ids] = True
+
+    def __call__(self, batch):
+        text_lengths = [len(item["input_ids"]) for item in batch]
+        width = int(math.ceil(max(text_lengths) / 8)) * 8
+
+        def pad_text(key, pad_value):
+            padded = torch.full((len(batch), width), pad_value, dtype=torch.long)
+            for row, (item, length) in enumerate(zip(batch, text_lengths)):
+                padded[row, :length] = item[key]
+            return padded
+
+        output = {"input_ids": pad_text("input_ids", self.pad_token_id)}
+        if self.masked_token_prediction:
+            output["token_classes"] = pad_text("token_classes", -1)
+        output["img_attention_mask"] = torch.stack(
+            [item["img_attention_mask"] for item in batch]
+        )
+        for key in batch[0]:
+            if key not in output:
+                output[key] = default_collate([item[key] for item in batch])
+
+        if self.mask_on_device:
+            return output
+        return self.mask_batch(output)
+
+    def mask_batch(self, batch):
+        """ Masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+
+        inputs = batch.pop("input_ids")
+        device = inputs.device
+        if self.special_ids.device != device:
+            self.special_ids = self.special_ids.to(device)
+
+        # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
+        probability_matrix = torch.full(
+            inputs.shape, self.mlm_probability, device=device
+        ).masked_fill_(self.special_ids[inputs], value=0.0)
+        masked_indices = torch.bernoulli(probability_matrix).bool()
+
+        if self.masked_token_prediction:
+            token_classes = batch.pop("token_classes")
+            token_classes_mask = token_classes != -1
+            masked_indices |= token_classes_mask
+
+        attention_mask = (inputs != self.pad_token_id).long()
+
+        # We only compute loss on masked tokens
+        labels = inputs.masked_fill(~masked_indices, -1)
+        if self.masked_token_prediction:
+            labels.masked_fill_(token_classes_mask, -1)
+
+        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK]),
+        # 10% of the time with a random word, and the rest of the time we keep them unchanged
+        draw = torch.rand(inputs.shape, device=device)
+        indices_replaced = (draw < 0.8) & masked_indices
+        indices_random = (draw >= 0.8) & (draw < 0.9) & masked_indices
+        if self.masked_token_prediction:
+            indices_replaced |= token_classes_mask
+            indices_random &= ~token_classes_mask
+
+        inputs = inputs.masked_fill(indices_replaced, self.mask_token_id)
+        inputs[indices_random] = torch.randint(
+            self.vocab_size,
+            (int(indices_random.sum()),),
+            dtype=inputs.dtype,
+            device=device,
+        )
+
+        img_attention_mask = batch.pop("img_attention_mask")
+        img_labels = torch.full(
+            (inputs.shape[0], batch["img_feats"].shape[1]),
+            -1,
+            dtype=labels.dtype,
+            device=device,
+        )
+        batch["input_ids"] = inputs
+        batch["labels"] = torch.cat((labels, img_labels), dim=1)
+        batch["attention_mask"] = torch.cat(
+            (attention_mask, img_attention_mask.to(attention_mask.dtype)), dim=1
+        )
+        if self.masked_token_prediction:
+            batch["token_labels"] = torch.cat((token_classes, img_labels), dim=1)
+        return batch
+
+
 class PretrainDataset(Dataset):
     def __init__(
         self,
@@ -69,453 +187,183 @@ class PretrainDataset(Dataset):
         assert tokenizer is not None
         assert (add_ndh_data or add_r2r_data or add_r4r_data or add_rxr_data) is True
 
-        self.args = args
-        self.tokenizer = tokenizer
-        self.features_reader = features_reader
-        self.data = []
+        self._init_encoding(args, features_reader, tokenizer, truncate_dialog)
 
-        use_oscar_settings = args.oscar_setting
+        parts = []
+        self.sources = []
+        for dataset_type in self._dataset_types(
+            add_ndh_data, add_r2r_data, add_r4r_data, add_rxr_data
+        ):
+            data = check_and_load_preprocessed_data(
+                splits, version, dataset_type=dataset_type
+            )
+            if data is False:
+                data = self._encode(splits, dataset_type)
+                save_preprocessed_data(data, splits, version, dataset_type=dataset_type)
+            parts.append(data)
+            self.sources.append(dataset_type[len("Pretrain") :])
 
-        TAR_BACK = args.tar_back
+        self.data = ItemColumnsChain(parts)
+        self.splits = splits
 
-        cls_token_segment_id = 0
-        pad_token_segment_id = 0
-        sep_token_segment_id = 0
+        logger.info(
+            "PretrainDataset loaded with %d instructions, using splits: %s NDH: %r R2R: %r R4R: %r RxR: %r version: %s"
+            % (
+                len(self.data),
+                ",".join(splits),
+                add_ndh_data,
+                add_r2r_data,
+                add_r4r_data,
+                add_rxr_data,
+                version,
+            )
+        )
 
-        tar_token_segment_id = 1
-        ques_token_segment_id = 2
-        ans_token_segment_id = 3
+    def item_sources(self):
+        """ Source dataset (NDH, R2R, R4R or RxR) of each item, used to mix sources. """
+        return np.repeat(self.sources, np.diff(self.data.offsets))
 
-        MAX_SEQ_LENGTH = 512
-        MAX_REGION_LABELS_LENGTH = 180 - 1
-        MAX_DIALOG_LEN = 512 - 180 - 4  # including [QUES]s and [ANS]s
-        MAX_TARGET_LENGTH = 4 - 2  # [CLS], [TAR], [SEP] after QA and before Action
+    def _init_encoding(self, args, features_reader, tokenizer, truncate_dialog):
+        self.args = args
+        self.tokenizer = tokenizer
+        self.features_reader = features_reader
+        self.batch_tokenizer = BatchTokenizer(tokenizer, num_workers=args.num_workers)
+        self.truncate_dialog = truncate_dialog
 
         if self.args.masked_token_prediction:
             self.detector_classes = load_detector_classes()
             self.id2class = {i: c for i, c in enumerate(self.detector_classes)}
             self.class2id = {c: i for i, c in enumerate(self.detector_classes)}
 
-        if add_ndh_data:
-            preprocessed_data = check_and_load_preprocessed_data(
-                splits, version, dataset_type="PretrainNDH"
-            )
-            if preprocessed_data is not False:
-                self.data.extend(preprocessed_data)
-            else:
-                ndh_data = []
-                for item in tqdm(
-                    load_datasets(splits, dataset_type="PretrainNDH"),
-                    miniters=1000,
-                    desc="loading PretrainNDH",
-                ):
-
-                    new_item = dict(item)
-                    new_item["inst_idx"] = f"{item['inst_idx']}"
-
-                    token_target = tokenizer.tokenize(item["target"])
-                    token_target = token_target[:MAX_TARGET_LENGTH]
-                    new_item["token_target"] = token_target
-
-                    token_dialog_history = []
-                    for turn in item["dialog_history"]:
-                        token_turn = tokenizer.tokenize(turn["message"])
-                        token_dialog_history.append(token_turn)
-
-                    if truncate_dialog:
-                        # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
-                        token_dialog_history = truncate_dialogs(
-                            token_dialog_history, amount=MAX_DIALOG_LEN, left=True
-                        )
-
-                    new_item["tokens_dialog_history"] = token_dialog_history
-
-                    new_item["region_tokens"] = self._extract_region_labels(
-                        item["scan"], item["viewpoint"], MAX_REGION_LABELS_LENGTH
-                    )
-
-                    tokens = [tokenizer.cls_token]
-                    segment_ids = [cls_token_segment_id]
-
-                    if self.args.masked_token_prediction:
-                        # mtp: masked token prediction
-                        # True if region token else False
-                        mtp_classes = [-1]
-
-                    if not TAR_BACK:
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                        else:
-                            sep_token = tokenizer.tar_token
-
-                        tokens += [sep_token] + token_target
-                        segment_ids += [tar_token_segment_id] * (len(token_target) + 1)
-
-                        if self.args.masked_token_prediction:
-                            mtp_classes += [-1] * (len(token_target) + 1)
-
-                    for i, turn in enumerate(token_dialog_history):
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                            segment_id = sep_token_segment_id
-                        else:
-                            if i % 2 == 0:
-                                sep_token = tokenizer.ques_token
-                                segment_id = ques_token_segment_id
-                            else:
-                                sep_token = tokenizer.ans_token
-                                segment_id = ans_token_segment_id
-
-                        tokens += [sep_token] + turn
-                        segment_ids += [segment_id] * (len(turn) + 1)
-
-                        if self.args.masked_token_prediction:
-                            mtp_classes += [-1] * (len(turn) + 1)
-
-                    if TAR_BACK:
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                        else:
-                            sep_token = tokenizer.tar_token
-
-                        tokens += [sep_token] + token_target
-                        segment_ids += [tar_token_segment_id] * (len(token_target) + 1)
-
-                        if self.args.masked_token_prediction:
-                            mtp_classes += [-1] * (len(token_target) + 1)
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1]
-
-                    tokens += new_item["region_tokens"]
-                    segment_ids += [sep_token_segment_id] * len(
-                        new_item["region_tokens"]
-                    )
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [
-                            self.class2id.get(token, -1)
-                            for token in new_item["region_tokens"]
-                        ]
+    def _dataset_types(self, add_ndh_data, add_r2r_data, add_r4r_data, add_rxr_data):
+        dataset_types = []
+        for dataset_type, add_data in [
+            ("PretrainNDH", add_ndh_data),
+            ("PretrainR2R", add_r2r_data),
+            ("PretrainR4R", add_r4r_data),
+            ("PretrainRxR", add_rxr_data),
+        ]:
+            if not add_data:
+                continue
+            if dataset_type in ["PretrainR4R", "PretrainRxR"]:
+                assert (
+                    self.args.masked_token_prediction is False
+                ), f"Not doing MTP for {dataset_type[len('Pretrain'):]}!"
+            dataset_types.append(dataset_type)
+        return dataset_types
+
+    def _encode(self, splits, dataset_type):
+        """
+        Encode every text (dialog or instruction) and every viewpoint's region
+        labels once, the steps refer to them by id
+        """
+        texts, steps = load_pretraining_data(splits, dataset_type)
+        self.batch_tokenizer.prefetch(
+            [text["target"] for text in texts if "target" in text]
+            + [turn for text in texts for turn in self._text_turns(text)]
+        )
+        encoded_texts = [
+            self._encode_text(text)
+            for text in tqdm(texts, miniters=1000, desc=f"loading {dataset_type}")
+        ]
 
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
+        region_ids, encoded_regions = {}, []
+        for step in steps:
+            key = (step["scan"], step["viewpoint"])
+            if key not in region_ids:
+                region_ids[key] = len(encoded_regions)
+                encoded_regions.append(self._encode_regions(*key))
+            step["region_id"] = region_ids[key]
+
+        sequences = {
+            "target_dialog_tokens_id": token_id_dtype(self.tokenizer),
+            "token_classes": np.int16,
+        }
+        return PretrainSteps(
+            ItemColumns(encoded_texts, sequences=sequences),
+            ItemColumns(encoded_regions, sequences=sequences),
+            ItemColumns(
+                steps,
+                values=["scan", "viewpoint"],
+                numbers={
+                    "text_id": np.int32,
+                    "region_id": np.int32,
+                    "current_view_index": np.int8,
+                    "target_rel_view_index": np.int8,
+                },
+            ),
+        )
 
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1]
+    @staticmethod
+    def _text_turns(text):
+        if isinstance(text["dialog_history"], str):
+            return [text["dialog_history"]]
+        return [turn["message"] for turn in text["dialog_history"]]
 
-                    tokens += [tokenizer.pad_token] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
+    def _encode_text(self, text):
+        """ [CLS] target and dialog turns (or instruction) [SEP] """
+        tokenizer = self.tokenizer
+        use_oscar_settings = self.args.oscar_setting
 
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1] * (MAX_SEQ_LENGTH - len(mtp_classes) - 1)
-
-                    new_item["target_dialog_tokens"] = tokens
-                    new_item[
-                        "target_dialog_tokens_id"
-                    ] = tokenizer.convert_tokens_to_ids(tokens)
-                    new_item["target_dialog_tokens_id"] = torch.LongTensor(
-                        new_item["target_dialog_tokens_id"]
-                    )
-                    new_item["target_dialog_segment_ids"] = segment_ids
-
-                    if self.args.masked_token_prediction:
-                        new_item["token_classes"] = torch.LongTensor(mtp_classes)
-
-                    ndh_data.append(new_item)
-                self.data.extend(ndh_data)
-                save_preprocessed_data(
-                    ndh_data, splits, version, dataset_type="PretrainNDH"
-                )
-        if add_r2r_data:
-            preprocessed_data = check_and_load_preprocessed_data(
-                splits, version, dataset_type="PretrainR2R"
+        token_dialog_history = [
+            self.batch_tokenizer.tokenize(turn) for turn in self._text_turns(text)
+        ]
+        if self.truncate_dialog:
+            # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
+            token_dialog_history = truncate_dialogs(
+                token_dialog_history, amount=MAX_DIALOG_LEN, left=True
             )
-            if preprocessed_data is not False:
-                self.data.extend(preprocessed_data)
-            else:
-                r2r_data = []
-                for item in tqdm(
-                    load_datasets(splits, dataset_type="PretrainR2R"),
-                    miniters=1000,
-                    desc="loading PretrainR2R",
-                ):
-
-                    new_item = dict(item)
-                    new_item["inst_idx"] = f"{item['inst_idx']}"
-
-                    token_turn = tokenizer.tokenize(new_item["dialog_history"])
-                    token_dialog_history = [token_turn]
-
-                    if truncate_dialog:
-                        # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
-                        token_dialog_history = truncate_dialogs(
-                            token_dialog_history, amount=MAX_DIALOG_LEN, left=True
-                        )
-
-                    new_item["tokens_dialog_history"] = token_dialog_history
-
-                    new_item["region_tokens"] = self._extract_region_labels(
-                        item["scan"], item["viewpoint"], MAX_REGION_LABELS_LENGTH
-                    )
-
-                    tokens = [tokenizer.cls_token]
-                    segment_ids = [cls_token_segment_id]
-
-                    if self.args.masked_token_prediction:
-                        # mtp: masked token prediction
-                        # True if region token else False
-                        mtp_classes = [-1]
-
-                    for i, turn in enumerate(token_dialog_history):
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                            segment_id = sep_token_segment_id
-                        else:
-                            if i % 2 == 0:
-                                sep_token = tokenizer.ques_token
-                                segment_id = ques_token_segment_id
-                            else:
-                                sep_token = tokenizer.ans_token
-                                segment_id = ans_token_segment_id
-
-                        tokens += [sep_token] + turn
-                        segment_ids += [segment_id] * (len(turn) + 1)
-
-                        if self.args.masked_token_prediction:
-                            mtp_classes += [-1] * (len(turn) + 1)
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1]
-
-                    tokens += new_item["region_tokens"]
-                    segment_ids += [sep_token_segment_id] * len(
-                        new_item["region_tokens"]
-                    )
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [
-                            self.class2id.get(token, -1)
-                            for token in new_item["region_tokens"]
-                        ]
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1]
 
-                    tokens += [tokenizer.pad_token] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
-
-                    if self.args.masked_token_prediction:
-                        mtp_classes += [-1] * (MAX_SEQ_LENGTH - len(mtp_classes) - 1)
-
-                    new_item["target_dialog_tokens"] = tokens
-                    new_item[
-                        "target_dialog_tokens_id"
-                    ] = tokenizer.convert_tokens_to_ids(tokens)
-                    new_item["target_dialog_tokens_id"] = torch.LongTensor(
-                        new_item["target_dialog_tokens_id"]
-                    )
-                    new_item["target_dialog_segment_ids"] = segment_ids
-
-                    if self.args.masked_token_prediction:
-                        new_item["token_classes"] = torch.LongTensor(mtp_classes)
-
-                    r2r_data.append(new_item)
-                self.data.extend(r2r_data)
-                save_preprocessed_data(
-                    r2r_data, splits, version, dataset_type="PretrainR2R"
-                )
-
-        if add_r4r_data:
-            assert self.args.masked_token_prediction is False, "Not doing MTP for R4R!"
-            preprocessed_data = check_and_load_preprocessed_data(
-                splits, version, dataset_type="PretrainR4R"
-            )
-            if preprocessed_data is not False:
-                self.data.extend(preprocessed_data)
+        token_target = []
+        if "target" in text:
+            token_target = self.batch_tokenizer.tokenize(text["target"])
+            token_target = token_target[:MAX_TARGET_LENGTH]
+            if use_oscar_settings:
+                tar_token = tokenizer.sep_token
             else:
-                r4r_data = []
-                for item in tqdm(
-                    load_datasets(splits, dataset_type="PretrainR4R"),
-                    miniters=1000,
-                    desc="loading PretrainR4R",
-                ):
-
-                    new_item = dict(item)
-                    new_item["inst_idx"] = f"{item['inst_idx']}"
-
-                    token_turn = tokenizer.tokenize(new_item["dialog_history"])
-                    token_dialog_history = [token_turn]
-
-                    if truncate_dialog:
-                        # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
-                        token_dialog_history = truncate_dialogs(
-                            token_dialog_history, amount=MAX_DIALOG_LEN, left=True
-                        )
+                tar_token = tokenizer.tar_token
+            token_target = [tar_token] + token_target
 
-                    new_item["tokens_dialog_history"] = token_dialog_history
+        tokens = [tokenizer.cls_token]
 
-                    new_item["region_tokens"] = self._extract_region_labels(
-                        item["scan"], item["viewpoint"], MAX_REGION_LABELS_LENGTH
-                    )
-
-                    tokens = [tokenizer.cls_token]
-                    segment_ids = [cls_token_segment_id]
-
-                    for i, turn in enumerate(token_dialog_history):
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                            segment_id = sep_token_segment_id
-                        else:
-                            if i % 2 == 0:
-                                sep_token = tokenizer.ques_token
-                                segment_id = ques_token_segment_id
-                            else:
-                                sep_token = tokenizer.ans_token
-                                segment_id = ans_token_segment_id
-
-                        tokens += [sep_token] + turn
-                        segment_ids += [segment_id] * (len(turn) + 1)
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    tokens += new_item["region_tokens"]
-                    segment_ids += [sep_token_segment_id] * len(
-                        new_item["region_tokens"]
-                    )
+        if not self.args.tar_back:
+            tokens += token_target
 
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    tokens += [tokenizer.pad_token] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
-
-                    new_item["target_dialog_tokens"] = tokens
-                    new_item[
-                        "target_dialog_tokens_id"
-                    ] = tokenizer.convert_tokens_to_ids(tokens)
-                    new_item["target_dialog_tokens_id"] = torch.LongTensor(
-                        new_item["target_dialog_tokens_id"]
-                    )
-                    new_item["target_dialog_segment_ids"] = segment_ids
-
-                    r4r_data.append(new_item)
-                self.data.extend(r4r_data)
-                save_preprocessed_data(
-                    r4r_data, splits, version, dataset_type="PretrainR4R"
-                )
-        if add_rxr_data:
-            assert self.args.masked_token_prediction is False, "Not doing MTP for RxR!"
-            preprocessed_data = check_and_load_preprocessed_data(
-                splits, version, dataset_type="PretrainRxR"
-            )
-            if preprocessed_data is not False:
-                self.data.extend(preprocessed_data)
+        for i, turn in enumerate(token_dialog_history):
+            if use_oscar_settings:
+                sep_token = tokenizer.sep_token
+            elif i % 2 == 0:
+                sep_token = tokenizer.ques_token
             else:
-                rxr_data = []
-                for item in tqdm(
-                    load_datasets(splits, dataset_type="PretrainRxR"),
-                    miniters=1000,
-                    desc="loading PretrainRxR",
-                ):
-
-                    new_item = dict(item)
-                    new_item["inst_idx"] = f"{item['inst_idx']}"
-
-                    token_turn = tokenizer.tokenize(new_item["dialog_history"])
-                    token_dialog_history = [token_turn]
-
-                    if truncate_dialog:
-                        # max_seq_length - 4 as accounting for [CLS], [TAR], Target, [SEP]
-                        token_dialog_history = truncate_dialogs(
-                            token_dialog_history, amount=MAX_DIALOG_LEN, left=True
-                        )
-
-                    new_item["tokens_dialog_history"] = token_dialog_history
-
-                    new_item["region_tokens"] = self._extract_region_labels(
-                        item["scan"], item["viewpoint"], MAX_REGION_LABELS_LENGTH
-                    )
-
-                    tokens = [tokenizer.cls_token]
-                    segment_ids = [cls_token_segment_id]
-
-                    for i, turn in enumerate(token_dialog_history):
-                        if use_oscar_settings:
-                            sep_token = tokenizer.sep_token
-                            segment_id = sep_token_segment_id
-                        else:
-                            if i % 2 == 0:
-                                sep_token = tokenizer.ques_token
-                                segment_id = ques_token_segment_id
-                            else:
-                                sep_token = tokenizer.ans_token
-                                segment_id = ans_token_segment_id
-
-                        tokens += [sep_token] + turn
-                        segment_ids += [segment_id] * (len(turn) + 1)
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
-
-                    tokens += new_item["region_tokens"]
-                    segment_ids += [sep_token_segment_id] * len(
-                        new_item["region_tokens"]
-                    )
-
-                    tokens += [tokenizer.sep_token]
-                    segment_ids += [sep_token_segment_id]
+                sep_token = tokenizer.ans_token
+            tokens += [sep_token] + turn
 
-                    tokens += [tokenizer.pad_token] * (MAX_SEQ_LENGTH - len(tokens) - 1)
-                    segment_ids += [pad_token_segment_id] * (
-                        MAX_SEQ_LENGTH - len(segment_ids) - 1
-                    )
-
-                    new_item["target_dialog_tokens"] = tokens
-                    new_item[
-                        "target_dialog_tokens_id"
-                    ] = tokenizer.convert_tokens_to_ids(tokens)
-                    new_item["target_dialog_tokens_id"] = torch.LongTensor(
-                        new_item["target_dialog_tokens_id"]
-                    )
-                    new_item["target_dialog_segment_ids"] = segment_ids
+        if self.args.tar_back:
+            tokens += token_target
 
-                    rxr_data.append(new_item)
-                self.data.extend(rxr_data)
-                save_preprocessed_data(
-                    rxr_data, splits, version, dataset_type="PretrainRxR"
-                )
+        tokens += [tokenizer.sep_token]
 
-        self.splits = splits
+        encoded = {"target_dialog_tokens_id": tokenizer.convert_tokens_to_ids(tokens)}
+        if self.args.masked_token_prediction:
+            encoded["token_classes"] = [-1] * len(tokens)
+        return encoded
 
-        logger.info(
-            "PretrainDataset loaded with %d instructions, using splits: %s NDH: %r R2R: %r R4R: %r RxR: %r version: %s"
-            % (
-                len(self.data),
-                ",".join(splits),
-                add_ndh_data,
-                add_r2r_data,
-                add_r4r_data,
-                add_rxr_data,
-                version,
-            )
+    def _encode_regions(self, scan_id, viewpoint_id):
+        """ Region labels of a viewpoint [SEP] """
+        region_tokens = self._extract_region_labels(
+            scan_id, viewpoint_id, MAX_REGION_LABELS_LENGTH
         )
+        tokens = region_tokens + [self.tokenizer.sep_token]
+
+        encoded = {
+            "target_dialog_tokens_id": self.tokenizer.convert_tokens_to_ids(tokens)
+        }
+        if self.args.masked_token_prediction:
+            # mtp: masked token prediction, the detector class of region tokens
+            encoded["token_classes"] = [
+                self.class2id.get(token, -1) for token in region_tokens
+            ] + [-1]
+        return encoded
 
     def _extract_region_labels(self, scan_id, viewpoint_id, MAX_REGION_LABELS_LENGTH):
         region_labels = []
@@ -529,9 +377,10 @@ class PretrainDataset(Dataset):
                 ]
             region_labels.extend(region_label)
 
-        region_labels = set(region_labels)
+        # Sorted so that the same labels always give the same (memoized) string
+        region_labels = sorted(set(region_labels))
         region_labels = " ".join(region_labels)
-        token_region_labels = self.tokenizer.tokenize(region_labels)
+        token_region_labels = self.batch_tokenizer.tokenize(region_labels)
         token_region_labels = token_region_labels[-MAX_REGION_LABELS_LENGTH:]
         return token_region_labels
 
@@ -540,173 +389,303 @@ class PretrainDataset(Dataset):
 
     def __getitem__(self, index):
         item = self.data[index]
-        output = self._preprocess_item(item)
-        return {
-            key: (torch.tensor(value) if not isinstance(value, torch.Tensor) else value)
-            for key, value in output.items()
-        }
-
-    def _mask_tokens(self, inputs, token_classes):
-
-        """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+        return self._preprocess_item(item)
 
-        labels = inputs.clone()
-
-        # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-        probability_matrix = torch.full(labels.shape, self.args.mlm_probability)
-        special_tokens_mask = [
-            val in self.tokenizer.all_special_ids for val in labels.tolist()
-        ]
-        att_mask = [val == self.tokenizer.pad_token_id for val in labels.tolist()]
-        probability_matrix.masked_fill_(
-            torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0
+    def _extract_img_features(self, scan_id, viewpoint_id, view_index):
+        """
+        Region features of the 36 views with their location embeddings, written
+        into max_img_seq_length buffers. Only the last regions are kept when
+        there are too many, the rest of the buffers is zero padding.
+        """
+        img_features = []
+        for idx in range(36):
+            long_id = f"{scan_id}_{viewpoint_id}_{idx}"
+            if self.args.debug:
+                feature = np.random.rand(5, 2054).astype(np.float32)
+            else:
+                feature = self.features_reader[long_id.encode()][:5]
+            img_features.append(feature)
+        view_indices = np.repeat(
+            np.arange(36), [feature.shape[0] for feature in img_features]
         )
 
-        masked_indices = torch.bernoulli(probability_matrix).type(torch.bool)
-
-        if self.args.masked_token_prediction:
-            token_classes_mask = [val != -1 for val in token_classes.tolist()]
-            token_classes_mask = torch.tensor(token_classes_mask, dtype=torch.bool)
-            masked_indices.masked_fill_(token_classes_mask, value=1.0)
+        num_regions = len(view_indices)
+        # max_img_seq_length 0 keeps every region, without attention on them
+        buffer_length = self.args.max_img_seq_length or num_regions
+        num_kept = min(num_regions, buffer_length)
+        kept = slice(num_regions - num_kept, num_regions)
 
-        attention_mask = torch.full(labels.shape, 1, dtype=torch.bool).masked_fill_(
-            torch.tensor(att_mask, dtype=torch.bool), value=0
+        features = np.zeros(
+            (buffer_length, img_features[0].shape[1]), dtype=img_features[0].dtype
         )
-
-        labels[~masked_indices] = -1  # We only compute loss on masked tokens
-
-        if self.args.masked_token_prediction:
-            labels[token_classes_mask] = -1
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (
-            torch.bernoulli(torch.full(labels.shape, 0.8)).type(torch.bool)
-            & masked_indices
+        features[:num_kept] = np.concatenate(img_features, axis=0)[kept]
+        location_embeddings = np.zeros(
+            (buffer_length, _static_loc_embeddings[view_index].shape[1]),
+            dtype=np.float32,
         )
+        location_embeddings[:num_kept] = _static_loc_embeddings[view_index][
+            view_indices[kept]
+        ]
+        return features, location_embeddings, num_kept
 
-        inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.mask_token
-        )
-        if self.args.masked_token_prediction:
-            indices_replaced = indices_replaced.masked_fill_(
-                token_classes_mask, value=1.0
+    def _preprocess_item(self, item):
+        """ Unmasked sample, masking is applied per batch by PretrainCollator """
+
+        output = {
+            "input_ids": torch.from_numpy(
+                item["target_dialog_tokens_id"].astype(np.int64)
             )
-            inputs[token_classes_mask] = self.tokenizer.convert_tokens_to_ids(
-                self.tokenizer.mask_token
+        }
+        if self.args.masked_token_prediction:
+            output["token_classes"] = torch.from_numpy(
+                item["token_classes"].astype(np.int64)
             )
 
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = (
-            torch.bernoulli(torch.full(labels.shape, 0.5)).type(torch.bool)
-            & masked_indices
-            & ~indices_replaced
+        img_features, location_embeddings, num_regions = self._extract_img_features(
+            item["scan"], item["viewpoint"], item["current_view_index"]
         )
+        target_view_index = item["target_rel_view_index"]
 
-        random_words = torch.randint(
-            len(self.tokenizer), labels.shape, dtype=torch.long
-        )
+        img_attention_mask = torch.zeros(self.args.max_img_seq_length, dtype=torch.long)
+        img_attention_mask[:num_regions] = 1
 
-        inputs[indices_random] = random_words[indices_random]
+        if self.args.no_action_grounding:
+            target_view_index = -1
 
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+        output.update(
+            {
+                "img_attention_mask": img_attention_mask,
+                "img_feats": torch.from_numpy(img_features),
+                "img_location_embeddings": torch.from_numpy(location_embeddings),
+                "next_action": torch.tensor(target_view_index),
+            }
+        )
+        return output
 
-        return inputs, labels, attention_mask
 
-    def _extract_img_features(self, scan_id, viewpoint_id, view_index):
-        img_features = []
-        view_indices = []
-        for idx in range(36):
-            long_id = f"{scan_id}_{viewpoint_id}_{idx}"
-            if self.args.debug:
-                feature = torch.rand(5, 2054)
-            else:
-                feature = self.features_reader[long_id.encode()][:5]
-            img_features.append(feature)
-            view_indices.extend([idx] * feature.shape[0])
-        img_features = np.concatenate(img_features, axis=0)
+class PretrainIterableDataset(PretrainDataset, IterableDataset):
+    """
+    Streams pretraining steps from the shard files written by
+    scripts/generate_pretraining_data.py, encoding them on the fly instead of
+    preprocessing the whole corpus up front. Shards are split across DDP ranks
+    and DataLoader workers, and samples pass through a shuffle buffer. Every
+    rank (and every worker of a rank) yields the same number of full batches.
+
+    With `source_weights` or `source_temperature` each worker streams every
+    source separately and draws from them with the probabilities of
+    samplers.source_probabilities, each source cycling over its own shards.
+    An epoch is then `num_samples` steps, by default the size of the corpus.
+    """
 
-        location_embeddings = []
-        for idx in view_indices:
-            embed = _static_loc_embeddings[view_index][np.newaxis, idx]
-            location_embeddings.append(embed)
-        location_embeddings = np.concatenate(location_embeddings, axis=0)
+    def __init__(
+        self,
+        args,
+        splits=["train"],
+        features_reader=None,
+        tokenizer=None,
+        truncate_dialog=False,
+        add_ndh_data=True,
+        add_r2r_data=False,
+        add_r4r_data=False,
+        add_rxr_data=False,
+        batch_size=1,
+        shuffle_buffer_size=10000,
+        num_samples=None,
+        source_weights=None,
+        source_temperature=None,
+        distributed=False,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+    ):
+        IterableDataset.__init__(self)
 
-        return img_features, location_embeddings
+        assert tokenizer is not None
+        assert (add_ndh_data or add_r2r_data or add_r4r_data or add_rxr_data) is True
 
-    def _preprocess_item(self, item):
+        self._init_encoding(args, features_reader, tokenizer, truncate_dialog)
 
-        if self.args.masked_token_prediction:
-            inputs, labels, attention_mask = self._mask_tokens(
-                item["target_dialog_tokens_id"],
-                item["token_classes"],
+        self.source_shards = {}
+        for dataset_type in self._dataset_types(
+            add_ndh_data, add_r2r_data, add_r4r_data, add_rxr_data
+        ):
+            source = dataset_type[len("Pretrain") :]
+            self.source_shards[source] = load_pretraining_shards(splits, dataset_type)
+        self.shards = [
+            shard for shards in self.source_shards.values() for shard in shards
+        ]
+        self.num_steps = sum(num_steps for _, num_steps in self.shards)
+
+        self.probabilities = None
+        if source_weights is not None or source_temperature is not None:
+            self.probabilities = source_probabilities(
+                {
+                    source: sum(num_steps for _, num_steps in shards)
+                    for source, shards in self.source_shards.items()
+                },
+                weights=source_weights,
+                temperature=source_temperature,
             )
+        if num_samples is None:
+            num_samples = self.num_steps
+
+        if distributed:
+            if num_replicas is None:
+                num_replicas = dist.get_world_size()
+            if rank is None:
+                rank = dist.get_rank()
         else:
-            inputs, labels, attention_mask = self._mask_tokens(
-                item["target_dialog_tokens_id"],
-                None,
-            )
-
-        attention_mask = attention_mask.tolist()
+            num_replicas = 1
+            rank = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = num_samples // (num_replicas * batch_size)
+        self.splits = splits
 
-        img_features, location_embeddings = self._extract_img_features(
-            item["scan"], item["viewpoint"], item["current_view_index"]
+        logger.info(
+            "PretrainIterableDataset streaming %d steps from %d shards, using splits: %s NDH: %r R2R: %r R4R: %r RxR: %r"
+            % (
+                self.num_steps,
+                len(self.shards),
+                ",".join(splits),
+                add_ndh_data,
+                add_r2r_data,
+                add_r4r_data,
+                add_rxr_data,
+            )
         )
-        target_view_index = item["target_rel_view_index"]
 
-        img_features = torch.from_numpy(img_features)
-        location_embeddings = torch.from_numpy(location_embeddings)
+    def __len__(self):
+        return self.num_batches * self.batch_size
 
-        if img_features.shape[0] > self.args.max_img_seq_length:
-            img_features = img_features[
-                -self.args.max_img_seq_length :,
-            ]
-            location_embeddings = location_embeddings[
-                -self.args.max_img_seq_length :,
+    def __getitem__(self, index):
+        raise TypeError("PretrainIterableDataset does not support indexing")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _assignment(self, shards, num_workers, worker_id):
+        """ (shard, first step, step stride) of `shards` read by a worker """
+        if len(shards) == 0:
+            return []
+        num_readers = self.num_replicas * num_workers
+        reader = self.rank * num_workers + worker_id
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(shards))
+        shards = [shards[i] for i in order]
+        # A reader without steps would stop early and leave its rank short of
+        # batches, so whole shards are only handed out if every reader gets some
+        if all(
+            sum(num_steps for _, num_steps in shards[other::num_readers]) > 0
+            for other in range(num_readers)
+        ):
+            return [(path, 0, 1) for path, _ in shards[reader::num_readers]]
+
+        num_steps = sum(num_steps for _, num_steps in shards)
+        if num_steps < num_readers:
+            raise ValueError(
+                f"{num_steps} steps cannot feed {num_readers} readers "
+                f"({self.num_replicas} ranks x {num_workers} workers)"
+            )
+        # Too few shards, stride the steps of all shards across the readers
+        assignment = []
+        offset = 0
+        for path, shard_steps in shards:
+            first = (reader - offset) % num_readers
+            if first < shard_steps:
+                assignment.append((path, first, num_readers))
+            offset += shard_steps
+        return assignment
+
+    def _stream(self, assignment, rng):
+        """ Encoded steps of the assigned shards, cycling through them """
+        while True:
+            streamed = False
+            for path, first, stride in assignment:
+                texts, steps = load_pretraining_shard(path)
+                # Only keep what the current shard needs in memory
+                self.batch_tokenizer.cache.clear()
+                encoded_texts, encoded_regions = {}, {}
+                for index in rng.permutation(np.arange(first, len(steps), stride)):
+                    step = steps[index]
+                    text_id = step["text_id"]
+                    if text_id not in encoded_texts:
+                        encoded_texts[text_id] = self._encode_text(texts[text_id])
+                    region = (step["scan"], step["viewpoint"])
+                    if region not in encoded_regions:
+                        encoded_regions[region] = self._encode_regions(*region)
+
+                    item = {
+                        key: np.concatenate(
+                            (encoded_texts[text_id][key], encoded_regions[region][key])
+                        )
+                        for key in encoded_texts[text_id]
+                    }
+                    for key in [
+                        "scan",
+                        "viewpoint",
+                        "current_view_index",
+                        "target_rel_view_index",
+                    ]:
+                        item[key] = step[key]
+                    streamed = True
+                    yield item
+            if not streamed:
+                return
+
+    def _mix(self, streams, rng):
+        """ Steps drawn from the per-source streams with the source probabilities """
+        sources = [source for source in streams if self.probabilities[source] > 0]
+        while sources:
+            probabilities = np.array([self.probabilities[s] for s in sources])
+            source = sources[
+                rng.choice(len(sources), p=probabilities / probabilities.sum())
             ]
-            if self.args.max_img_seq_length > 0:
-                attention_mask = attention_mask + [1] * img_features.shape[0]
+            try:
+                yield next(streams[source])
+            except StopIteration:
+                sources.remove(source)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            num_workers, worker_id = 1, 0
         else:
-            if self.args.max_img_seq_length > 0:
-                attention_mask = attention_mask + [1] * img_features.shape[0]
-            padding_matrix = torch.zeros(
-                (
-                    self.args.max_img_seq_length - img_features.shape[0],
-                    img_features.shape[1],
-                ),
-                dtype=img_features.dtype,
-            )
-            location_embed_padding_matrix = torch.zeros(
-                (
-                    self.args.max_img_seq_length - img_features.shape[0],
-                    location_embeddings.shape[1],
-                ),
-                dtype=location_embeddings.dtype,
+            num_workers, worker_id = worker_info.num_workers, worker_info.id
+        num_batches = self.num_batches // num_workers
+        if worker_id < self.num_batches % num_workers:
+            num_batches += 1
+        num_samples = num_batches * self.batch_size
+        rng = np.random.RandomState((self.seed, self.epoch, self.rank, worker_id))
+
+        if self.probabilities is None:
+            steps = self._stream(
+                self._assignment(self.shards, num_workers, worker_id), rng
             )
-            img_features = torch.cat((img_features, padding_matrix), dim=0)
-            location_embeddings = torch.cat(
-                (location_embeddings, location_embed_padding_matrix), dim=0
+        else:
+            steps = self._mix(
+                {
+                    source: self._stream(
+                        self._assignment(shards, num_workers, worker_id), rng
+                    )
+                    for source, shards in self.source_shards.items()
+                },
+                rng,
             )
-            if self.args.max_img_seq_length > 0:
-                attention_mask = attention_mask + [0] * padding_matrix.shape[0]
-
-        labels = labels.tolist() + [-1] * img_features.shape[0]
-        labels = torch.LongTensor(labels)
 
-        if self.args.no_action_grounding:
-            target_view_index = -1
-        if self.args.masked_token_prediction:
-            token_labels = item["token_classes"]
-            token_labels = token_labels.tolist() + [-1] * img_features.shape[0]
-            token_labels = torch.LongTensor(token_labels)
-        else:
-            token_labels = None
-        output = {
-            "input_ids": inputs,
-            "labels": labels,
-            "token_labels": token_labels,
-            "attention_mask": attention_mask,
-            "img_feats": img_features,
-            "img_location_embeddings": location_embeddings,
-            "next_action": target_view_index,
-        }
-        return output
+        buffer_size = max(1, min(self.shuffle_buffer_size, num_samples))
+        buffer = []
+        num_yielded = 0
+        for item in steps:
+            if num_yielded == num_samples:
+                return
+            if len(buffer) < buffer_size:
+                buffer.append(item)
+                continue
+            index = rng.randint(buffer_size)
+            yield self._preprocess_item(buffer[index])
+            buffer[index] = item
+            num_yielded += 1
@@ -375,19 +375,26 @@ class PreTrainOscar(BertPreTrainedModel):
         cls_part = outputs[1]
         lang_part = outputs[0]
 
-        prediction_scores = self.mlmhead(lang_part)
-
-        token_loss = 0
+        # Only the labelled positions count towards the losses and accuracies,
+        # so the heads are applied to those positions only
+        masked_positions = labels != -1
+        masked_labels = labels[masked_positions]
+        prediction_scores = self.mlmhead(lang_part[masked_positions])
+
+        token_loss = lang_part.new_zeros(())
+        token_accuracy = lang_part.new_zeros(())
         if token_labels is not None:
-            token_prediction = self.token_head(lang_part)
-            token_loss = self.criterion(
-                token_prediction.view(-1, self.config.detector_classes),
-                token_labels.view(-1),
+            token_positions = token_labels != -1
+            token_targets = token_labels[token_positions]
+            token_prediction = self.token_head(lang_part[token_positions])
+            token_loss = self.criterion(token_prediction, token_targets)
+            token_accuracy = (
+                (torch.argmax(token_prediction, dim=1) == token_targets)
+                .type(torch.float)
+                .mean()
             )
 
-        mask_loss = self.criterion(
-            prediction_scores.view(-1, self.config.vocab_size), labels.view(-1)
-        )
+        mask_loss = self.criterion(prediction_scores, masked_labels)
 
         action_scores = self.next_action(cls_part)
 
@@ -397,18 +404,9 @@ class PreTrainOscar(BertPreTrainedModel):
         loss = mask_loss + next_loss + token_loss
 
         predicted_action = torch.argmax(action_scores, dim=1)
-        predicted_words = torch.argmax(prediction_scores, dim=2)
-        token_prediction = torch.argmax(token_prediction, dim=2)
-
-        predicted_words[labels == -1] = -1
-
-        ignored_words_no = torch.sum(labels == -1)
-        words_left = (labels.shape[0] * labels.shape[1]) - ignored_words_no
-        words_left = words_left.type(torch.float)
+        predicted_words = torch.argmax(prediction_scores, dim=1)
 
-        words_accuracy = (
-            torch.sum(predicted_words == labels) - ignored_words_no
-        ) / words_left
+        words_accuracy = (predicted_words == masked_labels).type(torch.float).mean()
 
         if next_action is not None:
             action_accuracy = (
@@ -418,19 +416,6 @@ class PreTrainOscar(BertPreTrainedModel):
         else:
             action_accuracy = 0
 
-        token_prediction[token_labels == -1] = -1
-
-        ignored_tokens_no = torch.sum(token_labels == -1)
-        tokens_left = (
-            token_prediction.shape[0] * token_prediction.shape[1]
-        ) - ignored_tokens_no
-        tokens_left = tokens_left.type(torch.float)
-
-        token_accuracy = (
-            torch.sum(token_prediction == token_labels).type(torch.float)
-            - ignored_tokens_no
-        ) / tokens_left
-
         return (
             loss,
             mask_loss,
@@ -0,0 +1,319 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import SequentialSampler
+
+from agent import Agent
+from data_loader import VLNDataLoader, VLNDataloader_collate_fn, VLNDataset
+
+from params import args
+from utils import set_seed
+from utils_data import load_detector_classes, read_tsv_img_features
+
+sys.path.insert(0, "/root/mount/Matterport3DSimulator/")
+
+from transformers.pytorch_transformers import (
+    BertConfig,
+    BertTokenizer,
+)
+from model_utils import MODEL_CLASS, special_tokens_dict
+
+logger = logging.getLogger(__name__)
+
+ENCODER_FILE = "encoder"
+DECODER_STEP_FILE = "decoder_step"
+
+
+class EncoderGraph(nn.Module):
+    """ OscarEncoder with positional inputs, as traced for export """
+
+    def __init__(self, encoder):
+        super(EncoderGraph, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, inputs, lengths, mask, token_type_ids):
+        return self.encoder(
+            inputs=inputs, lengths=lengths, mask=mask, token_type_ids=token_type_ids
+        )
+
+
+class DecoderStepGraph(nn.Module):
+    """ One AttnDecoderLSTM step followed by the candidate masking of the rollout """
+
+    def __init__(self, decoder):
+        super(DecoderStepGraph, self).__init__()
+        self.decoder = decoder
+
+    def forward(
+        self, action, feature, cand_feat, cand_lengths, h_0, prev_h1, c_0, ctx, ctx_mask
+    ):
+        h_1, c_1, logit, h_tilde = self.decoder(
+            action, feature, cand_feat, h_0, prev_h1, c_0, ctx, ctx_mask
+        )
+        positions = torch.arange(cand_feat.size(1), device=cand_feat.device)
+        candidate_mask = positions.unsqueeze(0) >= cand_lengths.unsqueeze(1)
+        logit = logit.masked_fill(candidate_mask, -float("inf"))
+        return h_1, c_1, logit, h_tilde
+
+
+def example_inputs(agent, batch):
+    """ Encoder and first decoder step inputs of the rollout for `batch` """
+    agent.dataloader.batch = batch
+    obs = np.array(agent.dataloader.reset())
+    seq, segment_ids, seq_mask, seq_lengths, perm_idx = agent._sort_batch(batch)
+    lengths = torch.tensor([int(length) for length in seq_lengths])
+    encoder_inputs = (seq, lengths, seq_mask, segment_ids)
+    with torch.no_grad():
+        ctx, h_t, c_t = EncoderGraph(agent.encoder)(*encoder_inputs)
+
+    input_a_t, f_t, candidate_feat, candidate_leng = agent.get_input_feat(obs[perm_idx])
+    decoder_inputs = (
+        input_a_t,
+        f_t,
+        candidate_feat,
+        torch.tensor(candidate_leng, dtype=torch.int64, device=agent.args.device),
+        h_t,
+        h_t,
+        c_t,
+        ctx,
+        seq_mask,
+    )
+    return encoder_inputs, decoder_inputs
+
+
+def check_parity(name, eager, exported, inputs, tolerance):
+    """ Largest absolute difference between eager and exported outputs """
+    with torch.no_grad():
+        expected = eager(*inputs)
+        actual = exported(*inputs)
+    difference = 0.0
+    for expected_output, actual_output in zip(expected, actual):
+        actual_output = torch.as_tensor(actual_output)
+        finite = torch.isfinite(expected_output)
+        assert torch.equal(finite, torch.isfinite(actual_output)), name
+        difference = max(
+            difference,
+            (expected_output[finite] - actual_output[finite]).abs().max().item(),
+        )
+    logger.info(f"{name}: max abs difference to eager {difference:.2e}")
+    if difference > tolerance:
+        raise RuntimeError(
+            f"Exported {name} differs from eager by {difference:.2e} "
+            f"(> --export_tolerance {tolerance})"
+        )
+
+
+class OnnxGraph(object):
+    """ onnxruntime session called like the module it was exported from """
+
+    def __init__(self, path, input_names):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path)
+        self.input_names = input_names
+
+    def __call__(self, *inputs):
+        feeds = {
+            name: value.cpu().numpy() for name, value in zip(self.input_names, inputs)
+        }
+        return [torch.from_numpy(output) for output in self.session.run(None, feeds)]
+
+
+def export(agent, batches, export_dir, export_format, tolerance):
+    """
+    Trace the encoder and a decoder step on the first batch, then check the
+    exported graphs against eager mode on every batch (differently shaped
+    batches catch shapes that were frozen while tracing).
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    agent.encoder.eval()
+    agent.decoder.eval()
+    graphs = {
+        ENCODER_FILE: (
+            EncoderGraph(agent.encoder),
+            ["inputs", "lengths", "mask", "token_type_ids"],
+            ["ctx", "h_t", "c_t"],
+        ),
+        DECODER_STEP_FILE: (
+            DecoderStepGraph(agent.decoder),
+            [
+                "action",
+                "feature",
+                "cand_feat",
+                "cand_lengths",
+                "h_0",
+                "prev_h1",
+                "c_0",
+                "ctx",
+                "ctx_mask",
+            ],
+            ["h_1", "c_1", "logit", "h_tilde"],
+        ),
+    }
+    examples = [example_inputs(agent, batch) for batch in batches]
+    with open(os.path.join(export_dir, "export.json"), "w") as handle:
+        json.dump({"format": export_format, "device": str(agent.args.device)}, handle)
+
+    for index, (name, (module, input_names, output_names)) in enumerate(graphs.items()):
+        trace_inputs = examples[0][index]
+        if export_format == "torchscript":
+            path = os.path.join(export_dir, f"{name}.pt")
+            with torch.no_grad():
+                traced = torch.jit.trace(module, trace_inputs, check_trace=False)
+            traced.save(path)
+            exported = torch.jit.load(path)
+        else:
+            path = os.path.join(export_dir, f"{name}.onnx")
+            # Batch and sequence/candidate lengths vary between calls
+            dynamic_axes = {key: {0: "batch"} for key in input_names + output_names}
+            for key in ["inputs", "mask", "token_type_ids", "ctx", "ctx_mask"]:
+                if key in dynamic_axes:
+                    dynamic_axes[key][1] = "seq_len"
+            for key in ["cand_feat", "logit"]:
+                if key in dynamic_axes:
+                    dynamic_axes[key][1] = "candidates"
+            torch.onnx.export(
+                module,
+                trace_inputs,
+                path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=13,
+            )
+            exported = OnnxGraph(path, input_names)
+        logger.info(f"Exported {name} to {path}")
+
+        for example in examples:
+            check_parity(name, module, exported, example[index], tolerance)
+
+
+def main():
+    handlers = [logging.StreamHandler()]
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -    %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+        handlers=handlers,
+    )
+
+    # The exported graphs target CPU inference hosts
+    args.device = torch.device("cpu")
+    args.local_rank = -2
+    args.n_gpu = -1
+    args.amp = "off"
+    set_seed(args.seed, args.n_gpu)
+
+    if args.path_type == "planner_path":
+        args.max_episode_len = 10
+    else:
+        args.max_episode_len = 40
+
+    assert (
+        len(args.eval_iters) == 1 and args.eval_iters[0] != -1
+    ), "export needs exactly one eval_iters checkpoint"
+    iter_no = args.eval_iters[0]
+    root_folder = args.model_name_or_path
+    encoder_path = os.path.join(root_folder, f"checkpoint-{iter_no}", "encoder")
+    decoder_path = os.path.join(root_folder, f"checkpoint-{iter_no}", "decoder")
+    tokenizer_path = os.path.join(root_folder, f"checkpoint-{iter_no}/")
+
+    tmp_root_folder = "srv/oscar_weights/base-vg-labels/ep_107_1192087"
+    config_path = os.path.join(tmp_root_folder, "config.json")
+
+    config = BertConfig.from_pretrained(config_path)
+
+    config.img_feature_dim = args.img_feature_dim
+    config.hidden_dropout_prob = args.drop_out
+    config.attention_backend = args.attention_backend
+    config.activation_checkpointing = args.activation_checkpointing
+    config.classifier = "linear"
+    config.loss_type = "CrossEntropy"
+    config.cls_hidden_scale = 2
+
+    config.action_space = args.action_space
+
+    config.detector_classes = len(load_detector_classes())
+
+    add_new_extra_embeds = not args.oscar_setting
+
+    if add_new_extra_embeds:
+        config.vocab_size = config.vocab_size + 3
+        config.special_vocab_size = config.vocab_size
+        config.type_vocab_size = config.type_vocab_size + 4
+        config.max_position_embeddings = args.max_seq_length
+
+    else:
+        config.special_vocab_size = config.vocab_size
+
+    model_class = MODEL_CLASS["PreTrainOscar"][1]
+    model = model_class(config)
+    bert_encoder = model.bert
+
+    tokenizer = BertTokenizer.from_pretrained(
+        tokenizer_path,
+        do_lower_case=True,
+    )
+    if add_new_extra_embeds:
+        tokenizer.add_special_tokens(special_tokens_dict)
+
+    features = read_tsv_img_features(
+        path=os.path.join(args.img_feat_dir, args.img_feature_file),
+        feature_size=args.lstm_img_feature_dim,
+    )
+
+    dataset = VLNDataset(
+        args=args,
+        splits=["val_seen"],
+        tokenizer=tokenizer,
+        truncate_dialog=True,
+        path_type=args.path_type,
+    )
+    args.eval_batch_size = args.per_gpu_eval_batch_size
+    data_loader = VLNDataLoader(
+        dataset=dataset,
+        splits=["val_seen"],
+        feature_store=features,
+        tokenizer=tokenizer,
+        batch_size=args.eval_batch_size,
+        collate_fn=VLNDataloader_collate_fn,
+        sampler=SequentialSampler(dataset),
+        num_workers=0,
+        drop_last=False,
+    )
+
+    agent = Agent(
+        args=args,
+        tokenizer=tokenizer,
+        dataloader=data_loader,
+        results_path="",
+        bert=bert_encoder,
+        episode_len=args.max_episode_len,
+    )
+    agent.load(encoder_path, decoder_path)
+
+    # The second batch is smaller and has other dialogs and candidates, so the
+    # batch, sequence and candidate dimensions all differ from the trace
+    data_iter = iter(data_loader)
+    first = next(data_iter)
+    second = next(data_iter, first)
+    batches = [first, second[: max(1, len(second) // 2)]]
+
+    export_dir = args.export_dir or os.path.join(
+        root_folder, f"checkpoint-{iter_no}", "exported"
+    )
+    export(agent, batches, export_dir, args.export_format, args.export_tolerance)
+
+    sys.exit()
+
+
+if __name__ == "__main__":
+    main()
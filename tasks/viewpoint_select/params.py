@@ -80,6 +80,12 @@ parser.add_argument(
 )
 
 parser.add_argument("--no_oscar_setting", dest="oscar_setting", action="store_false")
+parser.add_argument(
+    "--no_encoded_cache",
+    dest="use_encoded_cache",
+    action="store_false",
+    help="Always re-tokenize the datasets instead of loading the encoded cache",
+)
 
 parser.add_argument(
     "--only_finetune_classifier",
@@ -216,6 +222,39 @@ parser.add_argument(
     type=int,
     help="Detach loss and compute gradients after X timesteps",
 )
+parser.add_argument(
+    "--compact_active_batch",
+    action="store_true",
+    help="Only run the decoder on episodes that have not ended yet",
+)
+parser.add_argument(
+    "--group_by_path_length",
+    action="store_true",
+    help="Batch together episodes with a similar number of hops",
+)
+parser.add_argument(
+    "--group_by_scan",
+    action="store_true",
+    help="Draw each batch from few scans and give each DDP rank its own scans",
+)
+parser.add_argument(
+    "--source_weights",
+    default=None,
+    type=str,
+    help="Mix the training sources with these weights instead of their sizes, e.g. NDH:1,R2R:0.5,RxR:0.1",
+)
+parser.add_argument(
+    "--source_temperature",
+    default=None,
+    type=float,
+    help="Mix the training sources in proportion to size ** (1 / temperature)",
+)
+parser.add_argument(
+    "--mix_num_samples",
+    default=None,
+    type=int,
+    help="Items per epoch when mixing sources, defaults to the size of the dataset",
+)
 parser.add_argument(
     "--pretrained_fixed",
     action="store_true",
@@ -254,6 +293,12 @@ parser.add_argument(
     type=int,
     help="Batch size per GPU for training.",
 )
+parser.add_argument(
+    "--gradient_accumulation_steps",
+    default=1,
+    type=int,
+    help="Number of forward/backward passes (rollouts) to accumulate before each optimizer step",
+)
 parser.add_argument(
     "--per_gpu_eval_batch_size",
     default=8,
@@ -294,7 +339,7 @@ parser.add_argument(
     "--warmup_steps",
     default=0,
     type=int,
-    help="Linear warmup over warmup_steps iterations.",
+    help="Linear warmup over warmup_steps iterations (micro-batches, divided by --gradient_accumulation_steps for the scheduler).",
 )
 parser.add_argument("--drop_out", default=0.1, type=float, help="Drop out for BERT.")
 parser.add_argument("--dropout", default=0.5, type=float, help="Drop out for BERT.")
@@ -310,6 +355,22 @@ parser.add_argument(
     action="store_true",
     help="Whether to do masked token prediction using token classes or not. Default: Masked LM for tokens",
 )
+parser.add_argument(
+    "--mask_on_device",
+    action="store_true",
+    help="Apply MLM/MTP masking on the training device instead of in the dataloader workers",
+)
+parser.add_argument(
+    "--streaming",
+    action="store_true",
+    help="Stream pretraining steps from shard files instead of preprocessing the whole corpus",
+)
+parser.add_argument(
+    "--shuffle_buffer_size",
+    default=10000,
+    type=int,
+    help="Size of the shuffle buffer of each dataloader worker with --streaming",
+)
 
 
 ## Logging parameters
@@ -343,6 +404,79 @@ parser.add_argument(
     metavar="N",
     help="number of data loading workers (default: 4)",
 )
+parser.add_argument(
+    "--freeze_bert",
+    action="store_true",
+    help="Keep the OSCAR BERT fixed and train the LSTM encoder and decoder on its precomputed outputs",
+)
+parser.add_argument(
+    "--dialog_embeddings_dir",
+    type=str,
+    default=None,
+    help="Where the --freeze_bert dialog embeddings are stored (default: <output_dir>/dialog_embeddings)",
+)
+parser.add_argument(
+    "--incremental_dialog_encoding",
+    action="store_true",
+    help="Classifier rollouts run BERT only over newly added dialog turns, attending to cached states of the earlier ones",
+)
+parser.add_argument(
+    "--cache_encoder_outputs",
+    action="store_true",
+    help="Reuse the dialog encoder outputs across eval-mode passes over the same episodes "
+    "(the validation loss pass with dropout is not cached)",
+)
+parser.add_argument(
+    "--attention_backend",
+    type=str,
+    default="eager",
+    choices=["eager", "sdpa"],
+    help="BERT self-attention implementation, sdpa uses torch's fused scaled_dot_product_attention",
+)
+parser.add_argument(
+    "--activation_checkpointing",
+    default=0,
+    type=int,
+    help="Recompute BERT activations on backward, checkpointing every k layers (0 disables)",
+)
+parser.add_argument(
+    "--export_dir",
+    type=str,
+    default=None,
+    help="Where export.py writes the encoder and decoder step graphs, defaults to <checkpoint>/exported",
+)
+parser.add_argument(
+    "--export_format",
+    type=str,
+    default="torchscript",
+    choices=["torchscript", "onnx"],
+    help="Graph format written by export.py",
+)
+parser.add_argument(
+    "--export_tolerance",
+    type=float,
+    default=1e-4,
+    help="Largest absolute difference to eager outputs accepted by the export parity check",
+)
+parser.add_argument(
+    "--exported_model_dir",
+    type=str,
+    default=None,
+    help="Run evaluation rollouts on the TorchScript graphs written by export.py in this directory",
+)
+parser.add_argument(
+    "--amp",
+    type=str,
+    default="off",
+    choices=["off", "bf16", "fp16"],
+    help="Mixed precision autocast dtype for forward passes (fp16 also enables loss scaling and needs a GPU)",
+)
+parser.add_argument(
+    "--amp_tolerance",
+    type=float,
+    default=0.05,
+    help="Largest relative loss difference between --amp and float32 accepted by the startup parity check",
+)
 parser.add_argument(
     "--local_rank",
     type=int,
@@ -357,4 +491,20 @@ parser.add_argument(
     help="Use this arg for debug purposes",
 )
 
-args = parser.parse_args()
\ No newline at end of file
+args = parser.parse_args()
+
+# Each of these selects a different training sampler, they do not compose
+sampler_flags = [
+    flag
+    for flag, enabled in [
+        ("--group_by_path_length", args.group_by_path_length),
+        ("--group_by_scan", args.group_by_scan),
+        ("--source_weights", args.source_weights is not None),
+        ("--source_temperature", args.source_temperature is not None),
+    ]
+    if enabled
+]
+if len(sampler_flags) > 1:
+    parser.error(
+        f"{' and '.join(sampler_flags)} select different samplers, pass only one"
+    )
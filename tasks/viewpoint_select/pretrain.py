@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: MIT-0
 
 import logging
+import math
 import os
 import sys
 import time
@@ -15,9 +16,21 @@ from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
-from data_loader_pretrain import PretrainDataset
+from data_loader_pretrain import (
+    PretrainCollator,
+    PretrainDataset,
+    PretrainIterableDataset,
+)
 from params import args
-from utils import set_seed
+from samplers import MultiSourceSampler, parse_source_weights
+from utils import (
+    autocast,
+    check_amp,
+    check_amp_parity,
+    grad_scaler,
+    no_sync,
+    set_seed,
+)
 from utils_data import FeaturesReader, timeSince
 
 sys.path.insert(0, "/root/mount/Matterport3DSimulator/")
@@ -57,33 +70,74 @@ def train(args, features_reader):
     if args.masked_token_prediction:
         version = "v2"
 
-    train_dataset = PretrainDataset(
-        args=args,
-        splits=["train"],
-        features_reader=features_reader,
-        tokenizer=tokenizer,
-        truncate_dialog=True,
-        add_ndh_data=args.add_ndh_data,
-        add_r2r_data=args.add_r2r_data,
-        add_r4r_data=args.add_r4r_data,
-        add_rxr_data=args.add_rxr_data,
-        version=version,
+    args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
+    logger.info(
+        "Effective batch size per optimizer step: %d",
+        args.train_batch_size
+        * args.gradient_accumulation_steps
+        * (dist.get_world_size() if args.local_rank not in [-2, -1] else 1),
     )
+    source_weights = None
+    if args.source_weights is not None:
+        source_weights = parse_source_weights(args.source_weights)
+    if args.streaming:
+        train_dataset = PretrainIterableDataset(
+            args=args,
+            splits=["train"],
+            features_reader=features_reader,
+            tokenizer=tokenizer,
+            truncate_dialog=True,
+            add_ndh_data=args.add_ndh_data,
+            add_r2r_data=args.add_r2r_data,
+            add_r4r_data=args.add_r4r_data,
+            add_rxr_data=args.add_rxr_data,
+            batch_size=args.train_batch_size,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            num_samples=args.mix_num_samples,
+            source_weights=source_weights,
+            source_temperature=args.source_temperature,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+        train_sampler = None
+    else:
+        train_dataset = PretrainDataset(
+            args=args,
+            splits=["train"],
+            features_reader=features_reader,
+            tokenizer=tokenizer,
+            truncate_dialog=True,
+            add_ndh_data=args.add_ndh_data,
+            add_r2r_data=args.add_r2r_data,
+            add_r4r_data=args.add_r4r_data,
+            add_rxr_data=args.add_rxr_data,
+            version=version,
+        )
+        if source_weights is not None or args.source_temperature is not None:
+            train_sampler = MultiSourceSampler(
+                train_dataset.item_sources(),
+                num_samples=args.mix_num_samples,
+                weights=source_weights,
+                temperature=args.source_temperature,
+                distributed=args.local_rank not in [-2, -1],
+                seed=args.seed,
+            )
+        else:
+            train_sampler = (
+                RandomSampler(train_dataset)
+                if args.local_rank in [-2, -1]
+                else DistributedSampler(train_dataset)
+            )
 
     tensorboard_dir = os.path.join(args.output_dir, "tensorboard")
     if args.local_rank in [-2, -1, 0]:
         tb_writer = SummaryWriter(logdir=tensorboard_dir, flush_secs=30)
 
-    args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank in [-2, -1]
-        else DistributedSampler(train_dataset)
-    )
-
+    collator = PretrainCollator(args, tokenizer, mask_on_device=args.mask_on_device)
     train_data_loader = DataLoader(
         dataset=train_dataset,
         batch_size=args.train_batch_size,
+        collate_fn=collator,
         sampler=train_sampler,
         num_workers=args.num_workers,
         pin_memory=True,
@@ -129,11 +183,17 @@ def train(args, features_reader):
         optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon
     )
 
+    # The scheduler steps once per optimizer step, while --warmup_steps and
+    # --num_iterations count micro-batches
+    accumulation_steps = args.gradient_accumulation_steps
+    warmup_steps = int(math.ceil(args.warmup_steps / accumulation_steps))
     if args.scheduler == "constant":
-        scheduler = WarmupConstantSchedule(optimizer, warmup_steps=args.warmup_steps)
+        scheduler = WarmupConstantSchedule(optimizer, warmup_steps=warmup_steps)
     elif args.scheduler == "linear":
         scheduler = WarmupLinearSchedule(
-            optimizer, warmup_steps=args.warmup_steps, t_total=args.num_iterations
+            optimizer,
+            warmup_steps=warmup_steps,
+            t_total=int(math.ceil(args.num_iterations / accumulation_steps)),
         )
     else:
         raise ValueError("args.scheduler not found")
@@ -141,30 +201,54 @@ def train(args, features_reader):
     data_log = defaultdict(list)
     start = time.time()
     global_iter = -1
+    scaler = grad_scaler(args)
 
     iters_per_epoch = len(train_data_loader)
     total_iters = args.num_epochs * iters_per_epoch
 
     for epoch_no in range(args.num_epochs):
+        if args.streaming:
+            train_dataset.set_epoch(epoch_no)
 
         for step, batch in enumerate(train_data_loader):
 
             global_iter += 1
             model.train()
-            model.zero_grad()
-            optimizer.zero_grad()
+            if step % accumulation_steps == 0:
+                model.zero_grad()
+                optimizer.zero_grad()
+            # The last window of an epoch is flushed early and may be shorter
+            window_size = min(
+                accumulation_steps,
+                iters_per_epoch - step // accumulation_steps * accumulation_steps,
+            )
+            # Only the last micro-batch of a window all-reduces the gradients
+            accumulating = (step + 1) % accumulation_steps != 0 and (
+                step != iters_per_epoch - 1
+            )
 
-            batch = {key: item.to(args.device) for key, item in batch.items()}
+            batch = {
+                key: item.to(args.device, non_blocking=True)
+                for key, item in batch.items()
+            }
+            if args.mask_on_device:
+                batch = collator.mask_batch(batch)
 
-            (
-                loss,
-                mask_loss,
-                next_loss,
-                token_loss,
-                words_accuracy,
-                action_accuracy,
-                token_accuracy,
-            ) = model(**batch)
+            if global_iter == 0:
+                model.eval()
+                check_amp_parity(args, lambda: model(**batch)[0])
+                model.train()
+
+            with no_sync([model], accumulating), autocast(args):
+                (
+                    loss,
+                    mask_loss,
+                    next_loss,
+                    token_loss,
+                    words_accuracy,
+                    action_accuracy,
+                    token_accuracy,
+                ) = model(**batch)
 
             if args.local_rank not in [-2, -1]:
                 loss /= dist.get_world_size()
@@ -188,9 +272,12 @@ def train(args, features_reader):
                 token_accuracy /= dist.get_world_size()
                 dist.all_reduce(token_accuracy, op=dist.ReduceOp.SUM)
 
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
+            with no_sync([model], accumulating):
+                scaler.scale(loss / window_size).backward()
+            if not accumulating:
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
 
             loss = loss.cpu().detach().item()
             mask_loss = mask_loss.cpu().detach().item()
@@ -421,11 +508,13 @@ def val(args, features_reader, list_iter_no):
 
         val_data_loaders = {}
         args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+        collator = PretrainCollator(args, tokenizer, mask_on_device=args.mask_on_device)
         for split, val_dataset in val_datasets.items():
             val_sampler = SequentialSampler(val_dataset)
             val_data_loader = DataLoader(
                 dataset=val_dataset,
                 batch_size=args.eval_batch_size,
+                collate_fn=collator,
                 sampler=val_sampler,
                 num_workers=args.num_workers,
                 pin_memory=True,
@@ -469,16 +558,22 @@ def val(args, features_reader, list_iter_no):
             for step, batch in tqdm(
                 enumerate(dataloader), desc=f"Evaluating {env_name}"
             ):
-                batch = {key: item.to(args.device) for key, item in batch.items()}
-                (
-                    loss,
-                    mask_loss,
-                    next_loss,
-                    token_loss,
-                    words_accuracy,
-                    action_accuracy,
-                    token_accuracy,
-                ) = model(**batch)
+                batch = {
+                    key: item.to(args.device, non_blocking=True)
+                    for key, item in batch.items()
+                }
+                if args.mask_on_device:
+                    batch = collator.mask_batch(batch)
+                with autocast(args):
+                    (
+                        loss,
+                        mask_loss,
+                        next_loss,
+                        token_loss,
+                        words_accuracy,
+                        action_accuracy,
+                        token_accuracy,
+                    ) = model(**batch)
 
                 if args.local_rank not in [-2, -1]:
                     loss /= dist.get_world_size()
@@ -633,8 +728,9 @@ def main():
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        "False",
+        args.amp,
     )
+    check_amp(args)
 
     # Set seed
     set_seed(args.seed, args.n_gpu)
@@ -0,0 +1,432 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+class PathLengthGroupedSampler(Sampler):
+    """Yields dataset indices so that every consecutive `batch_size` chunk holds
+    episodes with a similar number of hops. A rollout lasts as long as the
+    longest episode of its batch, so grouping cuts the decoder steps spent on
+    episodes that have already ended.
+
+    The indices are meant to be batched by the DataLoader with the same
+    `batch_size`. An incomplete batch is only ever yielded last.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        drop_last=False,
+        distributed=False,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+        bucket_size_multiplier=50,
+    ):
+        if distributed:
+            if num_replicas is None:
+                num_replicas = dist.get_world_size()
+            if rank is None:
+                rank = dist.get_rank()
+        else:
+            num_replicas = 1
+            rank = 0
+
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.epoch = 0
+
+        logger.info(
+            "PathLengthGroupedSampler over %d items, hops min/mean/max: %d/%.2f/%d"
+            % (
+                len(self.lengths),
+                self.lengths.min(),
+                self.lengths.mean(),
+                self.lengths.max(),
+            )
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            indices = rng.permutation(len(self.lengths))
+            # Sort inside large random buckets so batches still vary between epochs
+            buckets = [
+                indices[i : i + self.bucket_size]
+                for i in range(0, len(indices), self.bucket_size)
+            ]
+            indices = np.concatenate(
+                [
+                    bucket[np.argsort(self.lengths[bucket], kind="mergesort")]
+                    for bucket in buckets
+                ]
+            )
+        else:
+            indices = np.argsort(self.lengths, kind="mergesort")
+
+        batches = [
+            indices[i : i + self.batch_size]
+            for i in range(0, len(indices), self.batch_size)
+        ]
+        last = None
+        if len(batches[-1]) < self.batch_size:
+            last = batches.pop()
+
+        if self.shuffle:
+            order = rng.permutation(len(batches))
+            batches = [batches[i] for i in order]
+
+        if last is not None and not self.drop_last:
+            if self.num_replicas > 1:
+                # Every rank has to see full batches of the same size
+                last = np.concatenate(
+                    (last, np.resize(indices, self.batch_size - len(last)))
+                )
+            batches.append(last)
+
+        if self.num_replicas > 1:
+            total = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches += [batches[i % len(batches)] for i in range(total - len(batches))]
+            batches = batches[self.rank : total : self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        for batch in batches:
+            for index in batch:
+                yield int(index)
+
+    def __len__(self):
+        full_batches, remainder = divmod(len(self.lengths), self.batch_size)
+        if self.num_replicas == 1:
+            if self.drop_last:
+                return full_batches * self.batch_size
+            return len(self.lengths)
+        # The short last batch is padded to a full one, then ranks take turns
+        num_batches = full_batches + (1 if remainder and not self.drop_last else 0)
+        return int(math.ceil(num_batches / self.num_replicas)) * self.batch_size
+
+
+class ScanGroupedSampler(Sampler):
+    """Yields dataset indices so that every consecutive `batch_size` chunk is
+    drawn from as few scans as possible. Candidate caches, navigation graphs
+    and image features are all keyed by scan, so this keeps their working set
+    small for each batch.
+
+    In the distributed setting the scans are laid out largest first and cut
+    into one contiguous range of items per rank. Ranks then hold the same
+    number of items give or take one, and only the scans at a cut are shared
+    by two ranks, every other scan is only ever touched by one `rank_scans`.
+    All ranks yield the same number of full batches: with `drop_last` each
+    rank drops its final incomplete batch (fewer than `batch_size` items),
+    otherwise the short ranks repeat batches to keep in lockstep (a rank
+    left without items when there are more ranks than items repeats the
+    first items of the dataset).
+    """
+
+    def __init__(
+        self,
+        scans,
+        batch_size,
+        shuffle=True,
+        drop_last=False,
+        distributed=False,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+    ):
+        if distributed:
+            if num_replicas is None:
+                num_replicas = dist.get_world_size()
+            if rank is None:
+                rank = dist.get_rank()
+        else:
+            num_replicas = 1
+            rank = 0
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        scans = list(scans)
+        scan_to_indices = {}
+        for index, scan in enumerate(scans):
+            scan_to_indices.setdefault(scan, []).append(index)
+
+        # Cut the scan-ordered items into equal ranges, splitting the scans
+        # that straddle a cut, so no rank is left with surplus items to drop
+        ordered = [
+            index
+            for scan in sorted(
+                scan_to_indices, key=lambda s: (-len(scan_to_indices[s]), s)
+            )
+            for index in scan_to_indices[scan]
+        ]
+        bounds = [
+            len(ordered) * replica // num_replicas
+            for replica in range(num_replicas + 1)
+        ]
+        rank_loads = [bounds[i + 1] - bounds[i] for i in range(num_replicas)]
+        self.replica_scans = []
+        for replica in range(num_replicas):
+            replica_scans = []
+            for index in ordered[bounds[replica] : bounds[replica + 1]]:
+                if not replica_scans or replica_scans[-1] != scans[index]:
+                    replica_scans.append(scans[index])
+            self.replica_scans.append(replica_scans)
+
+        self.rank_scans = set(self.replica_scans[rank])
+        rank_indices = {}
+        for index in ordered[bounds[rank] : bounds[rank + 1]]:
+            rank_indices.setdefault(scans[index], []).append(index)
+        self.scan_to_indices = {
+            scan: np.asarray(indices) for scan, indices in rank_indices.items()
+        }
+        self.rank_loads = rank_loads
+        # With more ranks than items, a rank without items pads with these
+        self.padding_indices = np.asarray(ordered[:batch_size])
+
+        if self.drop_last:
+            self.num_batches = min(rank_loads) // batch_size
+        else:
+            self.num_batches = int(math.ceil(max(rank_loads) / batch_size))
+
+        logger.info(
+            "ScanGroupedSampler rank %d: %d scans, %d items, %d batches"
+            % (rank, len(self.rank_scans), rank_loads[rank], self.num_batches)
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        scans = sorted(self.scan_to_indices)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if not scans:
+            indices = self.padding_indices
+        elif self.shuffle:
+            scans = [scans[i] for i in rng.permutation(len(scans))]
+            indices = np.concatenate(
+                [rng.permutation(self.scan_to_indices[scan]) for scan in scans]
+            )
+        else:
+            indices = np.concatenate([self.scan_to_indices[scan] for scan in scans])
+
+        # Consecutive chunks of the scan-ordered indices span at most a couple of scans
+        batches = [
+            indices[i : i + self.batch_size]
+            for i in range(0, len(indices), self.batch_size)
+        ]
+        last = None
+        if len(batches[-1]) < self.batch_size:
+            last = batches.pop()
+
+        if self.shuffle:
+            order = rng.permutation(len(batches))
+            batches = [batches[i] for i in order]
+
+        if last is not None and not self.drop_last:
+            if self.num_replicas > 1:
+                # Every rank has to see full batches of the same size
+                last = np.concatenate(
+                    (last, np.resize(indices, self.batch_size - len(last)))
+                )
+            batches.append(last)
+
+        # Ranks own different numbers of items, repeat batches to stay in lockstep
+        batches = batches[: self.num_batches]
+        for i in range(self.num_batches - len(batches)):
+            batches.append(batches[i % len(batches)])
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        for batch in batches:
+            for index in batch:
+                yield int(index)
+
+    def __len__(self):
+        if self.drop_last or self.num_replicas > 1:
+            return self.num_batches * self.batch_size
+        return self.rank_loads[self.rank]
+
+
+def parse_source_weights(spec):
+    """ "NDH:1,RxR:0.2" -> {"NDH": 1.0, "RxR": 0.2} """
+    weights = {}
+    for entry in spec.split(","):
+        source, weight = entry.split(":")
+        weights[source.strip()] = float(weight)
+    return weights
+
+
+def source_probabilities(source_sizes, weights=None, temperature=None):
+    """Sampling probability of each source, proportional to `weights` when
+    given, otherwise to size ** (1 / temperature). A temperature of 1 keeps
+    the natural mix of the sources, larger temperatures flatten it towards
+    uniform. Empty sources are never sampled.
+    """
+    sources = sorted(source_sizes)
+    sizes = np.array([source_sizes[source] for source in sources], dtype=np.float64)
+    if weights is not None:
+        unknown = set(weights) - set(sources)
+        if unknown:
+            raise ValueError(f"Weights given for unknown sources: {sorted(unknown)}")
+        probabilities = np.array([weights.get(source, 0.0) for source in sources])
+    else:
+        probabilities = sizes ** (1.0 / (temperature or 1.0))
+    probabilities[sizes == 0] = 0.0
+    if probabilities.sum() <= 0:
+        raise ValueError("No source has a positive sampling weight")
+    return dict(zip(sources, probabilities / probabilities.sum()))
+
+
+class MultiSourceSampler(Sampler):
+    """Yields dataset indices drawn from several sources (NDH, R2R, R4R, RxR)
+    with per-source probabilities instead of in proportion to their sizes.
+
+    Each source is walked through its own shuffled order and starts a new
+    epoch of its own when exhausted, `source_epochs` counts them. An epoch
+    of the sampler is `num_samples` draws, by default the size of the
+    dataset. All ranks draw the same sequence and keep every
+    `num_replicas`-th index.
+    """
+
+    def __init__(
+        self,
+        sources,
+        num_samples=None,
+        weights=None,
+        temperature=None,
+        distributed=False,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+    ):
+        if distributed:
+            if num_replicas is None:
+                num_replicas = dist.get_world_size()
+            if rank is None:
+                rank = dist.get_rank()
+        else:
+            num_replicas = 1
+            rank = 0
+
+        sources = np.asarray(sources)
+        self.source_indices = {
+            source: np.flatnonzero(sources == source) for source in np.unique(sources)
+        }
+        self.probabilities = source_probabilities(
+            {source: len(indices) for source, indices in self.source_indices.items()},
+            weights=weights,
+            temperature=temperature,
+        )
+        if num_samples is None:
+            num_samples = len(sources)
+        self.num_samples = int(math.ceil(num_samples / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.source_epochs = {source: 0 for source in self.source_indices}
+        self.cursors = {source: 0 for source in self.source_indices}
+        self.orders = {}
+
+        for source, indices in self.source_indices.items():
+            logger.info(
+                "MultiSourceSampler %s: %d items, probability %.3f, %.2f source epochs per epoch"
+                % (
+                    source,
+                    len(indices),
+                    self.probabilities[source],
+                    self.probabilities[source] * self.total_size / len(indices),
+                )
+            )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _order(self, source):
+        epoch = self.source_epochs[source]
+        if source not in self.orders or self.orders[source][0] != epoch:
+            code = sorted(self.source_indices).index(source)
+            rng = np.random.RandomState((self.seed, code, epoch))
+            self.orders[source] = (epoch, rng.permutation(self.source_indices[source]))
+        return self.orders[source][1]
+
+    def _take(self, source, count):
+        """ The next `count` indices of `source`, starting new source epochs as needed """
+        taken = []
+        while count > 0:
+            order = self._order(source)
+            chunk = order[self.cursors[source] : self.cursors[source] + count]
+            taken.append(chunk)
+            count -= len(chunk)
+            self.cursors[source] += len(chunk)
+            if self.cursors[source] == len(order):
+                self.cursors[source] = 0
+                self.source_epochs[source] += 1
+        return np.concatenate(taken) if taken else np.zeros(0, dtype=np.int64)
+
+    def source_progress(self):
+        """ Fractional number of epochs done over each source """
+        return {
+            source: self.source_epochs[source]
+            + self.cursors[source] / len(self.source_indices[source])
+            for source in self.source_indices
+        }
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        sources = sorted(self.probabilities)
+        choices = rng.choice(
+            len(sources),
+            size=self.total_size,
+            p=[self.probabilities[source] for source in sources],
+        )
+        indices = np.empty(self.total_size, dtype=np.int64)
+        for code, source in enumerate(sources):
+            positions = np.flatnonzero(choices == code)
+            indices[positions] = self._take(source, len(positions))
+
+        logger.info(
+            "MultiSourceSampler source epochs: "
+            + ", ".join(
+                "%s %.2f" % (source, progress)
+                for source, progress in self.source_progress().items()
+            )
+        )
+        for index in indices[self.rank : self.total_size : self.num_replicas]:
+            yield int(index)
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,11 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+# The task modules import each other by flat name, as when run from
+# tasks/viewpoint_select, and oscar/transformers from the repository root
+TASK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TASK_DIR)))
+sys.path.insert(0, TASK_DIR)
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import utils  # noqa: E402
+
+
+class RecordingScaler(object):
+    def __init__(self):
+        self.stepped = []
+
+    def step(self, optimizer):
+        self.stepped.append(optimizer)
+
+
+def test_scaler_step_skips_optimizers_without_gradients():
+    used, unused = torch.nn.Linear(2, 1), torch.nn.Linear(2, 1)
+    used_optimizer = torch.optim.Adam(used.parameters())
+    unused_optimizer = torch.optim.Adam(unused.parameters())
+    with torch.no_grad():
+        unused(torch.ones(1, 2))
+    used(torch.ones(1, 2)).sum().backward()
+
+    scaler = RecordingScaler()
+    utils.scaler_step(scaler, unused_optimizer)
+    utils.scaler_step(scaler, used_optimizer)
+    assert scaler.stepped == [used_optimizer]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="fp16 GradScaler needs CUDA")
+def test_classifier_fp16_train_step_with_frozen_encoder(monkeypatch):
+    pytest.importorskip("sklearn")
+    from classifier.agent import Agent
+
+    device = torch.device("cuda")
+    args = Namespace(
+        amp="fp16",
+        device=device,
+        local_rank=-1,
+        gradient_accumulation_steps=1,
+        detach_loss=False,
+        only_finetune_classifier=False,
+    )
+    # Only train() is exercised: the rollout is replaced by one that, like the
+    # real one, runs the encoder under no_grad and the decoder with gradients
+    agent = Agent.__new__(Agent)
+    agent.args = args
+    agent.encoder = torch.nn.Linear(4, 4).to(device)
+    agent.decoder = torch.nn.Linear(4, 1).to(device)
+    agent.encoder_optimizer = torch.optim.Adam(agent.encoder.parameters())
+    agent.decoder_optimizer = torch.optim.Adam(agent.decoder.parameters())
+    agent.scaler = utils.grad_scaler(args)
+    encoder_weight = agent.encoder.weight.detach().clone()
+    decoder_weight = agent.decoder.weight.detach().clone()
+
+    def rollout():
+        inputs = torch.randn(8, 4, device=device)
+        with torch.no_grad():
+            ctx = agent.encoder(inputs)
+        agent.loss = agent.decoder(ctx).float().pow(2).mean()
+
+    monkeypatch.setattr(agent, "rollout", rollout, raising=False)
+    monkeypatch.setattr(agent, "_update_metrics", lambda logs: None, raising=False)
+    agent.train(1)
+
+    assert torch.equal(agent.encoder.weight, encoder_weight)
+    assert not torch.equal(agent.decoder.weight, decoder_weight)
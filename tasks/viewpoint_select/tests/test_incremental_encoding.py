@@ -0,0 +1,146 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from agent_models import OscarEncoder, gather_appended  # noqa: E402
+
+
+def reference_gather_appended(
+    prefix_states, new_states, prefix_lengths, lengths, width
+):
+    rows = []
+    for b in range(prefix_states.size(0)):
+        prefix, length = int(prefix_lengths[b]), int(lengths[b])
+        row = torch.cat((prefix_states[b, :prefix], new_states[b, : length - prefix]))
+        padding = row.new_zeros(width - length, row.size(1))
+        rows.append(torch.cat((row, padding)))
+    return torch.stack(rows)
+
+
+def test_gather_appended_packs_prefix_and_new_positions():
+    torch.manual_seed(0)
+    prefix_states = torch.randn(4, 6, 3)
+    new_states = torch.randn(4, 5, 3)
+    prefix_lengths = torch.tensor([0, 6, 2, 3])
+    lengths = torch.tensor([5, 6, 7, 3])
+    for width in [7, 9]:
+        assert torch.equal(
+            gather_appended(prefix_states, new_states, prefix_lengths, lengths, width),
+            reference_gather_appended(
+                prefix_states, new_states, prefix_lengths, lengths, width
+            ),
+        )
+
+
+def test_gather_appended_without_new_positions():
+    prefix_states = torch.randn(2, 4, 3)
+    lengths = torch.tensor([4, 1])
+    gathered = gather_appended(prefix_states, prefix_states[:, :0], lengths, lengths, 4)
+    assert torch.equal(gathered[0], prefix_states[0])
+    assert torch.equal(gathered[1, :1], prefix_states[1, :1])
+    assert (gathered[1, 1:] == 0).all()
+
+
+def make_encoder(num_hidden_layers):
+    pytorch_transformers = pytest.importorskip("transformers.pytorch_transformers")
+    from encoder import BertImgModelwithLocationEmbeds
+
+    config = pytorch_transformers.BertConfig(
+        vocab_size_or_config_json_file=50,
+        hidden_size=16,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=32,
+        type_vocab_size=4,
+    )
+    config.img_feature_dim = 8
+    config.img_feature_type = "faster_r-cnn"
+    torch.manual_seed(0)
+    encoder = OscarEncoder(
+        Namespace(device=torch.device("cpu")),
+        BertImgModelwithLocationEmbeds(config),
+        hidden_size=8,
+        decoder_hidden_size=8,
+        dropout_ratio=0.0,
+    )
+    return encoder.eval()
+
+
+def dialog_batch(lengths, width, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(1, 50, (len(lengths), width), generator=generator)
+    segments = torch.randint(0, 4, (len(lengths), width), generator=generator)
+    mask = torch.arange(width).unsqueeze(0) >= torch.tensor(lengths).unsqueeze(1)
+    return tokens.masked_fill(mask, 0), segments.masked_fill(mask, 0), mask
+
+
+def appended_turn(tokens, segments, mask, lengths, width, seed=1):
+    """ Extend the dialogs to `lengths`, keeping the tokens they already have """
+    new_tokens, new_segments, new_mask = dialog_batch(lengths, width, seed)
+    old_width = tokens.size(1)
+    keep = ~mask
+    new_tokens[:, :old_width][keep] = tokens[keep]
+    new_segments[:, :old_width][keep] = segments[keep]
+    return new_tokens, new_segments, new_mask
+
+
+def assert_close_on(actual, expected, mask):
+    valid = ~mask
+    assert torch.allclose(actual[valid], expected[valid], atol=1e-5)
+    assert (actual[mask] == 0).all()
+
+
+def test_first_turn_matches_full_encoding():
+    encoder = make_encoder(num_hidden_layers=2)
+    tokens, segments, mask = dialog_batch([5, 9, 2], 9)
+    with torch.no_grad():
+        outputs, history = encoder.encode_dialog_incremental(tokens, mask, segments)
+        expected = encoder.encode_dialog(tokens, mask, token_type_ids=segments)
+    assert_close_on(outputs, expected, mask)
+    assert history.lengths.tolist() == [5, 9, 2]
+
+
+def test_appended_turns_match_full_encoding_of_the_new_tokens():
+    # With a single layer the cached prefix states are the embeddings, which do
+    # not depend on the other tokens, so the appended tokens are exact. The
+    # prefix positions keep their outputs from the previous turn.
+    encoder = make_encoder(num_hidden_layers=1)
+    tokens, segments, mask = dialog_batch([5, 9, 2], 9)
+    # Row 1 is unchanged, row 2 has its last token edited
+    new_tokens, new_segments, new_mask = appended_turn(
+        tokens, segments, mask, [8, 9, 6], 12
+    )
+    new_tokens[2, 1] = (tokens[2, 1] % 49) + 1
+    with torch.no_grad():
+        previous, history = encoder.encode_dialog_incremental(tokens, mask, segments)
+        outputs, history = encoder.encode_dialog_incremental(
+            new_tokens, new_mask, new_segments, history
+        )
+        expected = encoder.encode_dialog(
+            new_tokens, new_mask, token_type_ids=new_segments
+        )
+
+    prefix = torch.tensor([5, 9, 1])
+    positions = torch.arange(12).unsqueeze(0)
+    appended = (positions >= prefix.unsqueeze(1)) & ~new_mask
+    assert torch.allclose(outputs[appended], expected[appended], atol=1e-5)
+    assert (outputs[new_mask] == 0).all()
+    for row, length in enumerate(prefix.tolist()):
+        assert torch.equal(outputs[row, :length], previous[row, :length])
+    assert torch.equal(history.tokens, new_tokens)
+    assert history.outputs is outputs
+
+
+def test_repeated_turn_reuses_the_cache():
+    encoder = make_encoder(num_hidden_layers=2)
+    tokens, segments, mask = dialog_batch([5, 9, 2], 9)
+    with torch.no_grad():
+        previous, history = encoder.encode_dialog_incremental(tokens, mask, segments)
+        outputs, _ = encoder.encode_dialog_incremental(tokens, mask, segments, history)
+    assert torch.equal(outputs, previous)
@@ -0,0 +1,175 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from utils_data import (
+    ITEM_COLUMNS_VERSION,
+    ItemColumns,
+    ItemColumnsChain,
+    PretrainSteps,
+)
+
+
+def make_items():
+    return [
+        {
+            "inst_idx": "7_0",
+            "scan": "17DRP5sb8fy",
+            "target_dialog_tokens_id": np.array([101, 5, 6, 102]),
+            "target_dialog_segment_ids": [0, 0, 1, 1],
+            "planner_path": ["a", "b", "c"],
+            "start_pano": {"heading": 0.5, "elevation": 0.0},
+            "current_view_index": 3,
+        },
+        {
+            "inst_idx": "8_1",
+            "scan": "17DRP5sb8fy",
+            "target_dialog_tokens_id": np.array([101, 102]),
+            "target_dialog_segment_ids": [0, 1],
+            "planner_path": ["c"],
+            "start_pano": {"heading": 1.5, "elevation": -0.5},
+            "current_view_index": 35,
+        },
+        {
+            "inst_idx": "9_2",
+            "scan": "1LXtFkjw3qL",
+            "target_dialog_tokens_id": np.array([], dtype=np.int64),
+            "target_dialog_segment_ids": [],
+            "planner_path": ["b", "a"],
+            "start_pano": {"heading": 0.0, "elevation": 0.5},
+            "current_view_index": 0,
+        },
+    ]
+
+
+def make_columns(items):
+    return ItemColumns(
+        items,
+        sequences={
+            "target_dialog_tokens_id": np.uint16,
+            "target_dialog_segment_ids": np.int8,
+        },
+        value_sequences=["planner_path"],
+        values=["inst_idx", "scan"],
+        numbers={"current_view_index": np.int8},
+        objects=["start_pano"],
+    )
+
+
+def assert_same_item(actual, expected):
+    assert set(actual) == set(expected)
+    for key, value in expected.items():
+        if key.startswith("target_dialog"):
+            assert list(actual[key]) == list(value), key
+        else:
+            assert actual[key] == value, key
+
+
+def test_items_match_the_original_dicts():
+    items = make_items()
+    data = make_columns(items)
+    assert len(data) == len(items)
+    for index, item in enumerate(items):
+        assert_same_item(data[index], item)
+    assert data[1]["target_dialog_tokens_id"].dtype == np.uint16
+    assert isinstance(data[0]["current_view_index"], int)
+    assert list(data.lengths("target_dialog_tokens_id")) == [4, 2, 0]
+    assert data.column_values("scan") == [item["scan"] for item in items]
+
+
+def test_undeclared_and_missing_keys():
+    items = make_items()
+    data = ItemColumns(items, values=["scan", "viewpoint"])
+    assert data.keys() == ["scan"]
+    assert "viewpoint" not in data
+    assert set(data[0]) == {"scan"}
+
+    del items[1]["scan"]
+    with pytest.raises(ValueError):
+        ItemColumns(items, values=["scan"])
+
+
+def test_chain_indexes_across_parts():
+    items = make_items()
+    chain = ItemColumnsChain([make_columns(items[:2]), make_columns(items[2:])])
+    assert len(chain) == 3
+    for index, item in enumerate(items):
+        assert_same_item(chain[index], item)
+    assert_same_item(chain[-1], items[-1])
+    with pytest.raises(IndexError):
+        chain[3]
+
+
+def test_save_load_round_trip(tmp_path):
+    items = make_items()
+    path = str(tmp_path / "cache" / "train")
+    make_columns(items).save(path)
+    data = ItemColumns.load(path)
+    assert len(data) == len(items)
+    assert isinstance(data.columns["target_dialog_tokens_id"], np.memmap)
+    for index, item in enumerate(items):
+        assert_same_item(data[index], item)
+    assert data[0]["target_dialog_tokens_id"].dtype == np.uint16
+    assert not any(
+        name.endswith(".tmp") for name in os.listdir(str(tmp_path / "cache"))
+    )
+
+
+def test_load_misses(tmp_path):
+    path = str(tmp_path / "train")
+    assert ItemColumns.load(path) is False
+
+    make_columns(make_items()).save(path)
+    meta_path = os.path.join(path, "meta.json")
+    with open(meta_path) as handle:
+        meta = json.load(handle)
+    meta["version"] = ITEM_COLUMNS_VERSION - 1
+    with open(meta_path, "w") as handle:
+        json.dump(meta, handle)
+    assert ItemColumns.load(path) is False
+
+    # A stale store is replaced by the next save
+    items = make_items()[:1]
+    make_columns(items).save(path)
+    data = ItemColumns.load(path)
+    assert len(data) == 1
+    assert_same_item(data[0], items[0])
+    assert sorted(os.listdir(str(tmp_path))) == ["train"]
+
+
+def test_pretrain_steps_round_trip(tmp_path):
+    sequences = {"input_ids": np.uint16, "token_classes": np.int16}
+    texts = [
+        {"input_ids": [101, 5, 6], "token_classes": [-1, -1, -1]},
+        {"input_ids": [101, 7], "token_classes": [-1, -1]},
+    ]
+    regions = [{"input_ids": [102, 40], "token_classes": [-1, 3]}]
+    steps = [
+        {"scan": "s", "viewpoint": "v0", "text_id": 1, "region_id": 0},
+        {"scan": "s", "viewpoint": "v1", "text_id": 0, "region_id": 0},
+    ]
+    numbers = {"text_id": np.int32, "region_id": np.int32}
+    path = str(tmp_path / "steps")
+    PretrainSteps(
+        ItemColumns(texts, sequences=sequences),
+        ItemColumns(regions, sequences=sequences),
+        ItemColumns(steps, values=["scan", "viewpoint"], numbers=numbers),
+    ).save(path)
+    data = PretrainSteps.load(path)
+    assert len(data) == 2
+    item = data[0]
+    assert set(item) == {"scan", "viewpoint", "input_ids", "token_classes"}
+    assert item["viewpoint"] == "v0"
+    assert list(item["input_ids"]) == [101, 7, 102, 40]
+    assert list(item["token_classes"]) == [-1, -1, -1, 3]
+    assert list(data[1]["input_ids"]) == [101, 5, 6, 102, 40]
+
+    # steps is saved last, a partial store is a miss
+    shutil.rmtree(os.path.join(path, "steps"))
+    assert PretrainSteps.load(path) is False
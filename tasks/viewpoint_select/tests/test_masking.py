@@ -0,0 +1,186 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from data_loader_pretrain import PretrainCollator  # noqa: E402
+
+PAD, CLS, SEP, MASK = 0, 101, 102, 103
+VOCAB_SIZE = 1000
+
+
+class FakeTokenizer(object):
+    pad_token_id = PAD
+    mask_token = "[MASK]"
+    all_special_ids = [PAD, CLS, SEP, MASK]
+
+    def convert_tokens_to_ids(self, token):
+        assert token == self.mask_token
+        return MASK
+
+    def __len__(self):
+        return VOCAB_SIZE
+
+
+def reference_mask_tokens(args, tokenizer, inputs, token_classes):
+    """ PretrainDataset._mask_tokens before masking moved to PretrainCollator """
+
+    labels = inputs.clone()
+
+    probability_matrix = torch.full(labels.shape, args.mlm_probability)
+    special_tokens_mask = [val in tokenizer.all_special_ids for val in labels.tolist()]
+    att_mask = [val == tokenizer.pad_token_id for val in labels.tolist()]
+    probability_matrix.masked_fill_(
+        torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0
+    )
+
+    masked_indices = torch.bernoulli(probability_matrix).type(torch.bool)
+
+    if args.masked_token_prediction:
+        token_classes_mask = [val != -1 for val in token_classes.tolist()]
+        token_classes_mask = torch.tensor(token_classes_mask, dtype=torch.bool)
+        masked_indices.masked_fill_(token_classes_mask, value=1.0)
+
+    attention_mask = torch.full(labels.shape, 1, dtype=torch.bool).masked_fill_(
+        torch.tensor(att_mask, dtype=torch.bool), value=0
+    )
+
+    labels[~masked_indices] = -1
+
+    if args.masked_token_prediction:
+        labels[token_classes_mask] = -1
+
+    indices_replaced = (
+        torch.bernoulli(torch.full(labels.shape, 0.8)).type(torch.bool) & masked_indices
+    )
+
+    inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+    if args.masked_token_prediction:
+        indices_replaced = indices_replaced.masked_fill_(token_classes_mask, value=1.0)
+        inputs[token_classes_mask] = tokenizer.convert_tokens_to_ids(
+            tokenizer.mask_token
+        )
+
+    indices_random = (
+        torch.bernoulli(torch.full(labels.shape, 0.5)).type(torch.bool)
+        & masked_indices
+        & ~indices_replaced
+    )
+
+    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
+
+    inputs[indices_random] = random_words[indices_random]
+
+    return inputs, labels, attention_mask
+
+
+def make_items(lengths, img_positions=6, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    items = []
+    for length in lengths:
+        input_ids = torch.randint(200, VOCAB_SIZE, (length,), generator=generator)
+        input_ids[0], input_ids[-1] = CLS, SEP
+        token_classes = torch.full((length,), -1, dtype=torch.long)
+        token_classes[1 : length - 1 : 3] = 7
+        items.append(
+            {
+                "input_ids": input_ids,
+                "token_classes": token_classes,
+                "img_attention_mask": torch.ones(img_positions, dtype=torch.long),
+                "img_feats": torch.zeros(img_positions, 4),
+            }
+        )
+    return items
+
+
+def run_both(items, mlm_probability, masked_token_prediction):
+    args = Namespace(
+        mlm_probability=mlm_probability,
+        masked_token_prediction=masked_token_prediction,
+    )
+    tokenizer = FakeTokenizer()
+    batch = PretrainCollator(args, tokenizer)(items)
+    width = batch["input_ids"].shape[1]
+    reference = []
+    for row in range(len(items)):
+        padded = torch.full((width,), PAD, dtype=torch.long)
+        classes = torch.full((width,), -1, dtype=torch.long)
+        length = len(items[row]["input_ids"])
+        padded[:length] = items[row]["input_ids"]
+        classes[:length] = items[row]["token_classes"]
+        reference.append(
+            reference_mask_tokens(
+                args,
+                tokenizer,
+                padded,
+                classes if masked_token_prediction else None,
+            )
+        )
+    return batch, reference, width
+
+
+def test_padding_and_image_positions():
+    items = make_items([5, 11, 9])
+    batch, reference, width = run_both(items, 0.15, True)
+    assert width == 16
+    assert batch["labels"].shape == (3, width + 6)
+    assert batch["attention_mask"].shape == (3, width + 6)
+    assert (batch["labels"][:, width:] == -1).all()
+    assert (batch["token_labels"][:, width:] == -1).all()
+    assert (batch["attention_mask"][:, width:] == 1).all()
+    for row, (_, _, attention_mask) in enumerate(reference):
+        assert torch.equal(batch["attention_mask"][row, :width], attention_mask.long())
+
+
+def test_forced_token_classes_match_reference():
+    # Without random masking only the token class positions are masked, which
+    # is deterministic in both implementations
+    items = make_items([5, 11, 9])
+    batch, reference, width = run_both(items, 0.0, True)
+    for row, (inputs, labels, _) in enumerate(reference):
+        assert torch.equal(batch["input_ids"][row], inputs)
+        assert torch.equal(batch["labels"][row, :width], labels)
+        classes = torch.full((width,), -1, dtype=torch.long)
+        classes[: len(items[row]["token_classes"])] = items[row]["token_classes"]
+        assert torch.equal(batch["token_labels"][row, :width], classes)
+
+
+def test_special_tokens_are_never_masked():
+    items = make_items([30] * 8)
+    batch, _, width = run_both(items, 1.0, False)
+    original = torch.full((8, width), PAD, dtype=torch.long)
+    for row, item in enumerate(items):
+        original[row, : len(item["input_ids"])] = item["input_ids"]
+    special = (original == PAD) | (original == CLS) | (original == SEP)
+    assert torch.equal(batch["input_ids"][special], original[special])
+    assert (batch["labels"][:, :width][special] == -1).all()
+    # Every other token is masked at probability 1 and keeps its label
+    assert torch.equal(batch["labels"][:, :width][~special], original[~special])
+
+
+def test_replacement_rates_match_reference():
+    torch.manual_seed(0)
+    items = make_items([120] * 64, seed=1)
+    batch, reference, width = run_both(items, 1.0, False)
+    original = torch.full((64, width), PAD, dtype=torch.long)
+    for row, item in enumerate(items):
+        original[row, : len(item["input_ids"])] = item["input_ids"]
+    masked = batch["labels"][:, :width] != -1
+    reference_inputs = torch.stack([inputs for inputs, _, _ in reference])
+    reference_masked = torch.stack([labels != -1 for _, labels, _ in reference])
+    assert torch.equal(masked, reference_masked)
+
+    def rates(inputs):
+        replaced = (inputs[masked] == MASK).float().mean().item()
+        unchanged = (inputs[masked] == original[masked]).float().mean().item()
+        return replaced, unchanged, 1.0 - replaced - unchanged
+
+    # 80% [MASK], 10% unchanged and 10% random words (a random word equals the
+    # original one with probability 1 / VOCAB_SIZE)
+    for actual, expected in zip(rates(batch["input_ids"]), rates(reference_inputs)):
+        assert actual == pytest.approx(expected, abs=0.02)
+    assert rates(batch["input_ids"])[0] == pytest.approx(0.8, abs=0.02)
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import itertools
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from samplers import PathLengthGroupedSampler, ScanGroupedSampler
+
+
+def path_lengths(size, seed=0):
+    return np.random.RandomState(seed).randint(1, 12, size=size)
+
+
+def scan_names(size, seed=0):
+    # A few large scans and a long tail of small ones
+    rng = np.random.RandomState(seed)
+    weights = 1.0 / np.arange(1, 31)
+    return [f"scan{i}" for i in rng.choice(30, size=size, p=weights / weights.sum())]
+
+
+def replica_samplers(sampler_class, data, num_replicas, **kwargs):
+    return [
+        sampler_class(
+            data,
+            distributed=num_replicas > 1,
+            num_replicas=num_replicas,
+            rank=rank,
+            **kwargs,
+        )
+        for rank in range(num_replicas)
+    ]
+
+
+@pytest.mark.parametrize(
+    "size, batch_size, num_replicas, shuffle, drop_last",
+    list(
+        itertools.product(
+            [1, 7, 64, 203], [1, 4, 16], [1, 2, 3], [True, False], [True, False]
+        )
+    ),
+)
+def test_path_length_partition(size, batch_size, num_replicas, shuffle, drop_last):
+    lengths = path_lengths(size)
+    samplers = replica_samplers(
+        PathLengthGroupedSampler,
+        lengths,
+        num_replicas,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+    )
+    ranks = [list(sampler) for sampler in samplers]
+    for sampler, indices in zip(samplers, ranks):
+        assert len(indices) == len(sampler)
+    # Ranks stay in lockstep with full batches
+    assert len(set(len(indices) for indices in ranks)) == 1
+    if num_replicas > 1:
+        assert len(ranks[0]) % batch_size == 0
+
+    counts = Counter(itertools.chain.from_iterable(ranks))
+    if drop_last:
+        # Only the short last batch is dropped
+        assert len(counts) == size - size % batch_size
+    else:
+        assert sorted(counts) == list(range(size))
+    if num_replicas == 1:
+        assert max(counts.values(), default=1) == 1
+    else:
+        # Repeats only pad the batches to a multiple of the ranks
+        assert sum(counts.values()) - len(counts) < batch_size * num_replicas
+
+
+def test_path_length_batches_are_grouped():
+    lengths = path_lengths(1000)
+    batch_size = 10
+    sampler = PathLengthGroupedSampler(lengths, batch_size, bucket_size_multiplier=20)
+    indices = np.array(list(sampler))
+    spreads = np.ptp(lengths[indices].reshape(-1, batch_size), axis=1)
+    random_spreads = np.ptp(lengths.reshape(-1, batch_size), axis=1)
+    assert spreads.mean() < random_spreads.mean() / 2
+
+    sampler = PathLengthGroupedSampler(lengths, batch_size, shuffle=False)
+    assert list(lengths[list(sampler)]) == sorted(lengths)
+
+
+def test_path_length_epochs():
+    lengths = path_lengths(100)
+    sampler = PathLengthGroupedSampler(lengths, 8)
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    sampler.set_epoch(0)
+    assert list(sampler) == first
+
+
+@pytest.mark.parametrize(
+    "size, batch_size, num_replicas, shuffle, drop_last",
+    list(
+        itertools.product(
+            [1, 7, 64, 203], [1, 4, 16], [1, 2, 3], [True, False], [True, False]
+        )
+    ),
+)
+def test_scan_grouped_partition(size, batch_size, num_replicas, shuffle, drop_last):
+    scans = scan_names(size)
+    samplers = replica_samplers(
+        ScanGroupedSampler,
+        scans,
+        num_replicas,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+    )
+    # The ranks own disjoint sets of items that cover the dataset
+    owned = [
+        (
+            np.concatenate(list(sampler.scan_to_indices.values())).tolist()
+            if sampler.scan_to_indices
+            else []
+        )
+        for sampler in samplers
+    ]
+    assert sorted(itertools.chain.from_iterable(owned)) == list(range(size))
+    assert max(len(items) for items in owned) - min(len(items) for items in owned) <= 1
+
+    ranks = [list(sampler) for sampler in samplers]
+    for sampler, items, indices in zip(samplers, owned, ranks):
+        assert len(indices) == len(sampler)
+        if items:
+            assert set(indices) <= set(items)
+        assert {scans[index] for index in items} == sampler.rank_scans
+    assert len(set(len(indices) for indices in ranks)) == 1
+
+    seen = set(itertools.chain.from_iterable(ranks))
+    if drop_last:
+        # Each rank drops less than a batch
+        assert size - len(seen) < num_replicas * batch_size
+        for indices in ranks:
+            assert len(indices) == len(set(indices))
+    else:
+        assert seen == set(range(size))
+
+
+def test_scan_grouped_ranks_share_only_the_cut_scans():
+    scans = scan_names(500)
+    samplers = replica_samplers(ScanGroupedSampler, scans, 4, batch_size=8)
+    shared = Counter(
+        itertools.chain.from_iterable(sampler.rank_scans for sampler in samplers)
+    )
+    assert len(shared) == len(set(scans))
+    assert sum(count - 1 for count in shared.values()) <= 3
+
+
+def test_scan_grouped_batches_span_few_scans():
+    scans = scan_names(1000)
+    batch_size = 8
+    sampler = ScanGroupedSampler(scans, batch_size)
+    indices = list(sampler)
+    batches = [indices[i : i + batch_size] for i in range(0, len(indices), batch_size)]
+    assert max(len({scans[index] for index in batch}) for batch in batches) <= 3
+    assert sorted(indices) == list(range(1000))
@@ -0,0 +1,43 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from utils_data import BatchTokenizer
+
+
+class WhitespaceTokenizer(object):
+    def __init__(self):
+        self.calls = 0
+
+    def tokenize(self, text):
+        self.calls += 1
+        return text.lower().split()
+
+
+def make_texts():
+    return [f"Go past the {i % 37} chairs and TURN left {i % 11}" for i in range(500)]
+
+
+def test_pool_matches_serial_tokenization():
+    texts = make_texts()
+    serial = BatchTokenizer(WhitespaceTokenizer())
+    pooled = BatchTokenizer(WhitespaceTokenizer(), num_workers=3, min_parallel_size=10)
+    serial.prefetch(texts)
+    pooled.prefetch(texts)
+    assert pooled.cache == serial.cache
+    tokenizer = WhitespaceTokenizer()
+    for text in texts:
+        assert pooled.tokenize(text) == tokenizer.tokenize(text)
+
+
+def test_each_distinct_text_is_tokenized_once():
+    texts = make_texts()
+    tokenizer = WhitespaceTokenizer()
+    batch_tokenizer = BatchTokenizer(tokenizer)
+    batch_tokenizer.prefetch(texts)
+    assert tokenizer.calls == len(set(texts))
+    batch_tokenizer.prefetch(texts)
+    for text in texts:
+        batch_tokenizer.tokenize(text)
+    assert tokenizer.calls == len(set(texts))
+    assert batch_tokenizer.tokenize("An unseen text") == ["an", "unseen", "text"]
+    assert tokenizer.calls == len(set(texts)) + 1
@@ -19,7 +19,13 @@ from data_loader import VLNDataLoader, VLNDataloader_collate_fn, VLNDataset
 from eval import Evaluation
 
 from params import args
-from utils import set_seed
+from samplers import (
+    MultiSourceSampler,
+    PathLengthGroupedSampler,
+    ScanGroupedSampler,
+    parse_source_weights,
+)
+from utils import check_amp, load_dialog_embeddings, set_seed
 from utils_data import load_detector_classes, read_tsv_img_features, timeSince
 
 sys.path.insert(0, "/root/mount/Matterport3DSimulator/")
@@ -63,11 +69,43 @@ def train(args, features):
         tb_writer = SummaryWriter(logdir=tensorboard_dir, flush_secs=30)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank in [-2, -1]
-        else DistributedSampler(train_dataset)
-    )
+    if args.group_by_path_length:
+        train_sampler = PathLengthGroupedSampler(
+            train_dataset.path_lengths(),
+            batch_size=args.train_batch_size,
+            shuffle=True,
+            drop_last=True,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+    elif args.group_by_scan:
+        train_sampler = ScanGroupedSampler(
+            train_dataset.item_scans(),
+            batch_size=args.train_batch_size,
+            shuffle=True,
+            drop_last=True,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+    elif args.source_weights is not None or args.source_temperature is not None:
+        train_sampler = MultiSourceSampler(
+            train_dataset.item_sources(),
+            num_samples=args.mix_num_samples,
+            weights=(
+                parse_source_weights(args.source_weights)
+                if args.source_weights is not None
+                else None
+            ),
+            temperature=args.source_temperature,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+    else:
+        train_sampler = (
+            RandomSampler(train_dataset)
+            if args.local_rank in [-2, -1]
+            else DistributedSampler(train_dataset)
+        )
 
     train_data_loader = VLNDataLoader(
         dataset=train_dataset,
@@ -91,6 +129,14 @@ def train(args, features):
         episode_len=args.max_episode_len,
     )
 
+    if args.freeze_bert:
+        agent.dialog_embeddings = load_dialog_embeddings(
+            os.path.join(args.dialog_embeddings_dir, "train"),
+            train_dataset,
+            agent.encoder,
+            args,
+        )
+
     if args.n_gpu > 1:
         agent.encoder = torch.nn.DataParallel(agent.encoder)
         agent.decoder = torch.nn.DataParallel(agent.decoder)
@@ -111,6 +157,8 @@ def train(args, features):
 
     logger.info("Training an LSTM agent with %s feedback" % args.feedback_method)
 
+    agent.check_amp_parity()
+
     data_log = defaultdict(list)
     start = time.time()
 
@@ -195,6 +243,8 @@ def val(args, features, list_iter_no):
 
         config.img_feature_dim = args.img_feature_dim
         config.hidden_dropout_prob = args.drop_out
+        config.attention_backend = args.attention_backend
+        config.activation_checkpointing = args.activation_checkpointing
         config.classifier = "linear"
         config.loss_type = "CrossEntropy"
         config.cls_hidden_scale = 2
@@ -252,7 +302,20 @@ def val(args, features, list_iter_no):
         val_data_loaders = {}
         args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
         for split, val_dataset in val_datasets.items():
-            val_sampler = SequentialSampler(val_dataset)
+            if args.group_by_path_length:
+                val_sampler = PathLengthGroupedSampler(
+                    val_dataset.path_lengths(),
+                    batch_size=args.eval_batch_size,
+                    shuffle=False,
+                )
+            elif args.group_by_scan:
+                val_sampler = ScanGroupedSampler(
+                    val_dataset.item_scans(),
+                    batch_size=args.eval_batch_size,
+                    shuffle=False,
+                )
+            else:
+                val_sampler = SequentialSampler(val_dataset)
             val_data_loader = VLNDataLoader(
                 dataset=val_dataset,
                 splits=[split],
@@ -278,6 +341,19 @@ def val(args, features, list_iter_no):
         )
 
         agent.load(encoder_path, decoder_path)
+        if args.exported_model_dir is not None:
+            agent.load_exported(args.exported_model_dir)
+
+        dialog_embeddings = {}
+        if args.freeze_bert:
+            # Reused across checkpoints as long as BERT stayed frozen
+            for split, val_dataset in val_datasets.items():
+                dialog_embeddings[split] = load_dialog_embeddings(
+                    os.path.join(args.dialog_embeddings_dir, split),
+                    val_dataset,
+                    agent.encoder,
+                    args,
+                )
 
         if args.n_gpu > 1:
             agent.encoder = torch.nn.DataParallel(agent.encoder)
@@ -310,6 +386,7 @@ def val(args, features, list_iter_no):
             start = time.time()
             agent.dataloader = dataloader
             agent.data_iter = iter(agent.dataloader)
+            agent.dialog_embeddings = dialog_embeddings.get(env_name)
 
             agent.results_path = os.path.join(
                 args.output_dir, "predictions", f"{env_name}-{iter_no}.json"
@@ -381,6 +458,8 @@ def test_submission(args, features, list_iter_no):
 
         config.img_feature_dim = args.img_feature_dim
         config.hidden_dropout_prob = args.drop_out
+        config.attention_backend = args.attention_backend
+        config.activation_checkpointing = args.activation_checkpointing
         config.classifier = "linear"
         config.loss_type = "CrossEntropy"
         config.cls_hidden_scale = 2
@@ -447,6 +526,8 @@ def test_submission(args, features, list_iter_no):
         )
 
         agent.load(encoder_path, decoder_path)
+        if args.exported_model_dir is not None:
+            agent.load_exported(args.exported_model_dir)
 
         if args.n_gpu > 1:
             agent.encoder = torch.nn.DataParallel(agent.encoder)
@@ -547,6 +628,8 @@ def main():
         torch.distributed.init_process_group(backend="nccl")
         args.n_gpu = 1
     args.device = device
+    if args.dialog_embeddings_dir is None:
+        args.dialog_embeddings_dir = os.path.join(args.output_dir, "dialog_embeddings")
 
     if args.path_type == "planner_path":
         args.max_episode_len = 10
@@ -559,8 +642,9 @@ def main():
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        "False",
+        args.amp,
     )
+    check_amp(args)
 
     # Set seed
     set_seed(args.seed, args.n_gpu)
@@ -572,6 +656,15 @@ def main():
         feature_size=args.lstm_img_feature_dim,
     )
 
+    if args.exported_model_dir is not None:
+        assert (
+            args.eval_only or args.test_only
+        ), "--exported_model_dir is only used by --eval_only and --test_only"
+        # The exported graphs stand for a single checkpoint
+        assert (
+            len(args.eval_iters) == 1
+        ), "--exported_model_dir evaluates exactly one eval_iters checkpoint"
+
     if args.test_only:
         assert (
             len(args.eval_iters) != 0 and args.eval_iters != -1
@@ -23,7 +23,8 @@ from classifier.data_loader import (
 )
 from eval import Evaluation
 from params import args
-from utils import set_seed
+from samplers import PathLengthGroupedSampler, ScanGroupedSampler
+from utils import check_amp, set_seed
 from utils_data import load_detector_classes, read_tsv_img_features, timeSince
 
 sys.path.insert(0, "/root/mount/Matterport3DSimulator/")
@@ -53,6 +54,8 @@ def train(args, features):
 
     config.img_feature_dim = args.img_feature_dim
     config.hidden_dropout_prob = args.drop_out
+    config.attention_backend = args.attention_backend
+    config.activation_checkpointing = args.activation_checkpointing
     config.classifier = "linear"
     config.loss_type = "CrossEntropy"
     config.cls_hidden_scale = 2
@@ -98,11 +101,30 @@ def train(args, features):
         tb_writer = SummaryWriter(logdir=tensorboard_dir, flush_secs=30)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank in [-2, -1]
-        else DistributedSampler(train_dataset)
-    )
+    if args.group_by_path_length:
+        train_sampler = PathLengthGroupedSampler(
+            train_dataset.path_lengths(),
+            batch_size=args.train_batch_size,
+            shuffle=True,
+            drop_last=True,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+    elif args.group_by_scan:
+        train_sampler = ScanGroupedSampler(
+            train_dataset.item_scans(),
+            batch_size=args.train_batch_size,
+            shuffle=True,
+            drop_last=True,
+            distributed=args.local_rank not in [-2, -1],
+            seed=args.seed,
+        )
+    else:
+        train_sampler = (
+            RandomSampler(train_dataset)
+            if args.local_rank in [-2, -1]
+            else DistributedSampler(train_dataset)
+        )
 
     train_data_loader = ClassifierDataLoader(
         dataset=train_dataset,
@@ -148,6 +170,8 @@ def train(args, features):
 
     logger.info("Training an Classifier agent with %s feedback" % args.feedback_method)
 
+    agent.check_amp_parity()
+
     data_log = defaultdict(list)
     start = time.time()
 
@@ -240,6 +264,8 @@ def val(args, features, list_iter_no):
 
         config.img_feature_dim = args.img_feature_dim
         config.hidden_dropout_prob = args.drop_out
+        config.attention_backend = args.attention_backend
+        config.activation_checkpointing = args.activation_checkpointing
         config.classifier = "linear"
         config.loss_type = "CrossEntropy"
         config.cls_hidden_scale = 2
@@ -295,7 +321,20 @@ def val(args, features, list_iter_no):
         val_data_loaders = {}
         args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
         for split, val_dataset in val_datasets.items():
-            val_sampler = SequentialSampler(val_dataset)
+            if args.group_by_path_length:
+                val_sampler = PathLengthGroupedSampler(
+                    val_dataset.path_lengths(),
+                    batch_size=args.eval_batch_size,
+                    shuffle=False,
+                )
+            elif args.group_by_scan:
+                val_sampler = ScanGroupedSampler(
+                    val_dataset.item_scans(),
+                    batch_size=args.eval_batch_size,
+                    shuffle=False,
+                )
+            else:
+                val_sampler = SequentialSampler(val_dataset)
             val_data_loader = ClassifierDataLoader(
                 dataset=val_dataset,
                 splits=["val_seen"],
@@ -306,7 +345,7 @@ def val(args, features, list_iter_no):
                 sampler=val_sampler,
                 num_workers=args.num_workers,
                 pin_memory=True,
-                drop_last=True,
+                drop_last=False,
             )
             evaluation = Evaluation([split], path_type=args.path_type)
             val_data_loaders[split] = (val_data_loader, evaluation)
@@ -408,6 +447,8 @@ def test_submission(args, features, list_iter_no):
 
         config.img_feature_dim = args.img_feature_dim
         config.hidden_dropout_prob = args.drop_out
+        config.attention_backend = args.attention_backend
+        config.activation_checkpointing = args.activation_checkpointing
         config.classifier = "linear"
         config.loss_type = "CrossEntropy"
         config.cls_hidden_scale = 2
@@ -587,8 +628,9 @@ def main():
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        "False",
+        args.amp,
     )
+    check_amp(args)
 
     # Set seed
     set_seed(args.seed, args.n_gpu)
@@ -1,7 +1,9 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import contextlib
 import copy
+import hashlib
 import logging
 import math
 import os
@@ -16,7 +18,7 @@ import torch
 import torch.distributions as D
 import torch.nn.functional as F
 
-from utils_data import load_datasets
+from utils_data import DialogEmbeddings, load_datasets
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +31,110 @@ def set_seed(seed, n_gpu):
         torch.cuda.manual_seed_all(seed)
 
 
+def torch_version():
+    """ (major, minor) of the installed torch """
+    return tuple(int(part) for part in re.findall(r"\d+", torch.__version__)[:2])
+
+
+def check_amp(args):
+    """ Validate --amp against the device and torch version of this run """
+    if args.amp == "off":
+        return
+    if args.amp == "fp16" and args.device.type != "cuda":
+        raise ValueError("--amp fp16 needs a CUDA device, use --amp bf16 on CPU")
+    # torch.cuda.amp arrived in 1.6, device-generic torch.autocast and bf16 in 1.10
+    required = (1, 10) if args.amp == "bf16" else (1, 6)
+    if torch_version() < required:
+        raise RuntimeError(
+            f"--amp {args.amp} needs torch {required[0]}.{required[1]} or later, "
+            f"found {torch.__version__}"
+        )
+
+
+class NoAutocast(object):
+    """ Stand-in for the autocast context when --amp is off """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def autocast(args):
+    """ Autocast context for the --amp dtype, a no-op when it is off """
+    if args.amp == "off":
+        return NoAutocast()
+    if not hasattr(torch, "autocast"):
+        # Before torch 1.10 only CUDA float16 autocast exists
+        return torch.cuda.amp.autocast()
+    dtype = torch.bfloat16 if args.amp == "bf16" else torch.float16
+    return torch.autocast(device_type=args.device.type, dtype=dtype)
+
+
+def grad_scaler(args):
+    """ Loss scaler for --amp fp16, a pass-through for the other modes """
+    return torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+
+
+def scaler_step(scaler, optimizer):
+    """
+    `scaler.step(optimizer)`, skipped when none of its parameters has a
+    gradient (e.g. a model only run under no_grad). A plain optimizer step
+    leaves those untouched, but GradScaler asserts that it saw gradients.
+    """
+    if any(
+        param.grad is not None
+        for group in optimizer.param_groups
+        for param in group["params"]
+    ):
+        scaler.step(optimizer)
+
+
+def check_amp_parity(args, compute_loss):
+    """
+    Compare the loss returned by `compute_loss` in float32 and under --amp
+    autocast, without gradients, and stop if the relative difference is
+    larger than --amp_tolerance
+    """
+    if args.amp == "off":
+        return
+    # Both runs draw the same random numbers, e.g. for dropout or sampling
+    devices = range(torch.cuda.device_count()) if args.device.type == "cuda" else []
+    with torch.no_grad():
+        with torch.random.fork_rng(devices=devices):
+            reference = float(compute_loss())
+        with torch.random.fork_rng(devices=devices), autocast(args):
+            mixed = float(compute_loss())
+    difference = abs(mixed - reference) / max(abs(reference), 1e-6)
+    logger.info(
+        "AMP parity: %s loss %.5f, float32 loss %.5f, relative difference %.5f",
+        args.amp,
+        mixed,
+        reference,
+        difference,
+    )
+    if difference > args.amp_tolerance:
+        raise RuntimeError(
+            f"--amp {args.amp} loss differs from float32 by {difference:.5f} "
+            f"(> --amp_tolerance {args.amp_tolerance})"
+        )
+
+
+def no_sync(models, skip_sync):
+    """
+    Suspend the DDP gradient all-reduce of `models` while `skip_sync` is set,
+    so intermediate micro-batches of an accumulation window only add their
+    gradients locally. Models that are not DDP-wrapped are left alone.
+    """
+    contexts = contextlib.ExitStack()
+    if skip_sync:
+        for model in models:
+            if hasattr(model, "no_sync"):
+                contexts.enter_context(model.no_sync())
+    return contexts
+
+
 # padding, unknown word, end of sentence
 base_vocab = ["<PAD>", "<UNK>", "<EOS>", "<NAV>", "<ORA>", "<TAR>"]
 padding_idx = base_vocab.index("<PAD>")
@@ -347,6 +453,234 @@ def length2mask(length, device, size=None):
     return mask
 
 
+def sequence_lengths(sequences, pad_token_id):
+    """ Length of each sequence up to its first pad token. """
+    lengths = []
+    for seq in sequences:
+        pads = np.flatnonzero(np.asarray(seq) == pad_token_id)
+        lengths.append(int(pads[0]) if len(pads) > 0 else len(seq))
+    return np.array(lengths, dtype=np.int64)
+
+
+def pad_batch(sequences, lengths, pad_value, multiple=8):
+    """Stack the first `lengths` entries of each sequence, padded to the batch
+    maximum rounded up to a multiple of `multiple`."""
+    width = int(math.ceil(max(lengths) / multiple)) * multiple
+    batch = np.full((len(sequences), width), pad_value, dtype=np.int64)
+    for i, (seq, length) in enumerate(zip(sequences, lengths)):
+        batch[i, :length] = seq[:length]
+    return batch
+
+
+class InputFeatureBuffers(object):
+    """Host buffers for the per-step decoder inputs of a rollout.
+
+    Angle, view and candidate features are gathered into max-size arrays which
+    are reused across steps. On CUDA the arrays are pinned and sent to the
+    device with non_blocking copies. Candidates live in a flat buffer viewed
+    as a contiguous [batch, max_candidates] block each step, as a strided
+    slice of a pinned buffer would be staged through pageable memory. The
+    device tensors are fresh every step as the decoder keeps them around for
+    the backward pass.
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        views,
+        feature_size,
+        angle_feat_size,
+        device,
+        max_candidates=16,
+    ):
+        self.device = torch.device(device)
+        self.pin = self.device.type == "cuda"
+        self.views = views
+        self.feature_size = feature_size
+        self.angle_feat_size = angle_feat_size
+        self.copy_done = None
+        self._allocate(batch_size, max_candidates)
+
+    def _host(self, *shape):
+        buffer = torch.zeros(shape, dtype=torch.float32)
+        return buffer.pin_memory() if self.pin else buffer
+
+    def _allocate(self, batch_size, max_candidates):
+        self.batch_size = batch_size
+        self.max_candidates = max_candidates
+        self.angle = self._host(batch_size, self.angle_feat_size)
+        self.feature = self._host(batch_size, self.views, self.feature_size)
+        self.candidate = self._host(batch_size * max_candidates * self.feature_size)
+        # NumPy views share memory with the (pinned) tensors
+        self.angle_np = self.angle.numpy()
+        self.feature_np = self.feature.numpy()
+        self.candidate_np = self.candidate.numpy()
+
+    def _to_device(self, host):
+        if self.pin:
+            return host.to(self.device, non_blocking=True)
+        # The host buffer is refilled next step, so hand out a copy
+        return host.clone()
+
+    def fill(self, obs):
+        """ Return input_a_t, f_t, candidate_feat and candidate_leng for obs. """
+        if self.copy_done is not None:
+            # The previous copies must have finished before refilling
+            self.copy_done.synchronize()
+            self.copy_done = None
+
+        batch_size = len(obs)
+        num_candidates = np.array([len(ob["candidate"]) for ob in obs])
+        candidate_leng = (num_candidates + 1).tolist()  # +1 is for the end
+        max_leng = max(candidate_leng)
+        if batch_size > self.batch_size or max_leng > self.max_candidates:
+            self._allocate(
+                max(batch_size, self.batch_size),
+                max(max_leng, 2 * self.max_candidates),
+            )
+
+        # Same values as angle_feature, for the whole batch at once
+        headings = np.array([ob["heading"] for ob in obs])
+        elevations = np.array([ob["elevation"] for ob in obs])
+        self.angle_np[:batch_size] = np.stack(
+            [
+                np.sin(headings),
+                np.cos(headings),
+                np.sin(elevations),
+                np.cos(elevations),
+            ],
+            axis=1,
+        )
+        self.feature_np[:batch_size] = [ob["feature"] for ob in obs]
+
+        # The candidate feature at len(ob["candidate"]) is the zero END feature
+        shape = (batch_size, max_leng, self.feature_size)
+        size = batch_size * max_leng * self.feature_size
+        candidate = self.candidate_np[:size].reshape(shape)
+        candidate.fill(0)
+        if num_candidates.sum() > 0:
+            rows = np.repeat(np.arange(batch_size), num_candidates)
+            starts = np.repeat(
+                np.cumsum(num_candidates) - num_candidates, num_candidates
+            )
+            candidate[rows, np.arange(len(rows)) - starts] = [
+                c["feature"] for ob in obs for c in ob["candidate"]
+            ]
+
+        input_a_t = self._to_device(self.angle[:batch_size])
+        f_t = self._to_device(self.feature[:batch_size])
+        candidate_feat = self._to_device(self.candidate[:size].view(shape))
+        if self.pin:
+            self.copy_done = torch.cuda.Event()
+            self.copy_done.record()
+
+        return input_a_t, f_t, candidate_feat, candidate_leng
+
+
+class EncoderCache(object):
+    """Dialog encoder outputs of eval-mode passes, keyed by (splits, inst_idx).
+
+    Rows are kept on the host, trimmed to the dialog length, and are only valid
+    for the encoder version they were computed with: a lookup with a new
+    version drops everything. A batch is served from the cache only when every
+    episode in it hits, otherwise the caller re-encodes the whole batch.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.entries = {}
+
+    def lookup(self, keys, version, width, device):
+        if version != self.version:
+            self.version = version
+            self.entries = {}
+        if not all(key in self.entries for key in keys):
+            return None
+
+        rows = [self.entries[key] for key in keys]
+        ctx = rows[0][0].new_zeros(len(rows), width, rows[0][0].size(-1))
+        for i, (row_ctx, _, _) in enumerate(rows):
+            ctx[i, : row_ctx.size(0)] = row_ctx
+        h_t = torch.stack([row[1] for row in rows])
+        c_t = torch.stack([row[2] for row in rows])
+        return (
+            ctx.to(device, non_blocking=True),
+            h_t.to(device, non_blocking=True),
+            c_t.to(device, non_blocking=True),
+        )
+
+    def store(self, keys, lengths, ctx, h_t, c_t):
+        ctx, h_t, c_t = ctx.cpu(), h_t.cpu(), c_t.cpu()
+        for i, (key, length) in enumerate(zip(keys, lengths)):
+            self.entries[key] = (ctx[i, : int(length)].clone(), h_t[i], c_t[i])
+
+
+def bert_fingerprint(bert):
+    """ Digest of the BERT weights, identifies stores of its outputs """
+    digest = hashlib.sha1()
+    for name, tensor in bert.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def load_dialog_embeddings(path, dataset, encoder, args, batch_size=64, pad_token_id=0):
+    """
+    BERT outputs of every dialog of `dataset` for a frozen-BERT `encoder`
+    (an unwrapped OscarEncoder), computed once in eval mode and saved to
+    `path` as a float16 DialogEmbeddings store. A store computed from the
+    same BERT weights is reused, e.g. across checkpoints of one run.
+    """
+    fingerprint = bert_fingerprint(encoder.bert)
+    if args.local_rank in [-2, -1, 0] and not DialogEmbeddings.load(path, fingerprint):
+        items = [dataset[i] for i in range(len(dataset))]
+        lengths = sequence_lengths(
+            [item["target_dialog_tokens_id"] for item in items], pad_token_id
+        )
+
+        def chunks():
+            training = encoder.training
+            encoder.eval()
+            with torch.no_grad(), autocast(args):
+                for start in range(0, len(items), batch_size):
+                    batch = items[start : start + batch_size]
+                    batch_lengths = lengths[start : start + batch_size]
+                    seq = torch.from_numpy(
+                        pad_batch(
+                            [item["target_dialog_tokens_id"] for item in batch],
+                            batch_lengths,
+                            pad_token_id,
+                        )
+                    ).to(args.device)
+                    segment_ids = torch.from_numpy(
+                        pad_batch(
+                            [item["target_dialog_segment_ids"] for item in batch],
+                            batch_lengths,
+                            0,
+                        )
+                    ).to(args.device)
+                    output = encoder.encode_dialog(
+                        seq, (seq == pad_token_id).byte(), token_type_ids=segment_ids
+                    )
+                    output = output.float().cpu().numpy()
+                    yield np.concatenate(
+                        [row[:length] for row, length in zip(output, batch_lengths)]
+                    )
+            encoder.train(training)
+
+        DialogEmbeddings.write(
+            path,
+            [item["inst_idx"] for item in items],
+            lengths,
+            chunks(),
+            encoder.bert.config.hidden_size,
+            fingerprint,
+        )
+    if args.local_rank not in [-2, -1]:
+        torch.distributed.barrier()
+    return DialogEmbeddings.load(path, fingerprint)
+
+
 def copy_dialog_history(obs):
     new_obs = []
     for ob in obs:
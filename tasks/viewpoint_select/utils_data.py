@@ -3,12 +3,15 @@
 
 import base64
 import csv
+import hashlib
 import json
 import logging
 import math
+import multiprocessing
 import os
 import pickle
 import re
+import shutil
 import sys
 import time
 from itertools import chain
@@ -105,6 +108,73 @@ def load_datasets(splits, dataset_type="NDH"):
     return data
 
 
+def load_pretraining_data(splits, dataset_type="PretrainNDH"):
+    """
+    Texts (NDH dialogs or instructions) and the pretraining steps referring to
+    them by `text_id`. Files written with the text repeated in every step are
+    deduplicated on load.
+    """
+    texts = []
+    steps = []
+
+    data_root = get_data_root(dataset_type)
+    for split in splits:
+        assert split in ["train", "val_seen", "val_unseen", "test"]
+        split_texts, split_steps = load_pretraining_shard(data_root + "%s.json" % split)
+        for step in split_steps:
+            step["text_id"] += len(texts)
+        texts += split_texts
+        steps += split_steps
+    return texts, steps
+
+
+def load_pretraining_shard(path):
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = deduplicate_pretraining_texts(data)
+    return data["texts"], data["steps"]
+
+
+def load_pretraining_shards(splits, dataset_type="PretrainNDH"):
+    """
+    (path, number of steps) of the pretraining shard files of `splits`, read
+    from the shard index written by generate_pretraining_data.py. A split
+    without an index is streamed from its merged file as a single shard.
+    """
+    shards = []
+
+    data_root = get_data_root(dataset_type)
+    for split in splits:
+        assert split in ["train", "val_seen", "val_unseen", "test"]
+        index_path = data_root + "%s_shards.json" % split
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                shards += [
+                    (shard["path"], shard["num_steps"]) for shard in json.load(f)
+                ]
+        else:
+            path = data_root + "%s.json" % split
+            logger.warning(f"No shard index {index_path}, counting the steps of {path}")
+            shards.append((path, len(load_pretraining_shard(path)[1])))
+    return shards
+
+
+def deduplicate_pretraining_texts(items):
+    text_ids = {}
+    texts = []
+    for item in items:
+        text = {
+            key: item.pop(key) for key in ["dialog_history", "target"] if key in item
+        }
+        key = json.dumps(text, sort_keys=True)
+        if key not in text_ids:
+            text_ids[key] = len(texts)
+            texts.append(text)
+        item["text_id"] = text_ids[key]
+    return {"texts": texts, "steps": items}
+
+
 def load_classifier_data(splits):
     data = []
     raw_data = []
@@ -238,50 +308,453 @@ def load_gameplay_data(splits):
     return data
 
 
-def save_preprocessed_data(data, splits, version, dataset_type="NDH"):
+def get_preprocessed_data_path(splits, version, dataset_type="NDH"):
     data_root = get_data_root(dataset_type)
     combined_split = "_".join(splits)
-    path = f"{data_root}{combined_split}_preprocessed_{version}.pickle"
-    logger.info(f"Saving preprocessed data to {path}")
-    with open(path, "wb") as handle:
-        pickle.dump(data, handle, protocol=-1)
+    return f"{data_root}{combined_split}_preprocessed_{version}"
+
+
+def save_preprocessed_data(data, splits, version, dataset_type="NDH"):
+    path = get_preprocessed_data_path(splits, version, dataset_type)
+    data.save(f"{path}.steps")
 
 
 def check_and_load_preprocessed_data(splits, version, dataset_type="NDH"):
-    if dataset_type == "NDH":
-        data_root = "srv/task_data/NDH/data/"
-    elif dataset_type == "R2R":
-        data_root = "srv/task_data/R2R/data/R2R_"
-    elif dataset_type == "R4R":
-        data_root = "srv/task_data/R4R/data/R4R_"
-    elif dataset_type == "RxR":
-        data_root = "srv/task_data/RxR/data/RxR_"
-    elif dataset_type == "PretrainNDH":
-        data_root = "srv/task_data/pretrain_data/NDH_"
-    elif dataset_type == "PretrainR2R":
-        data_root = "srv/task_data/pretrain_data/R2R_"
-    elif dataset_type == "PretrainR4R":
-        data_root = "srv/task_data/pretrain_data/R4R_"
-    elif dataset_type == "PretrainRxR":
-        data_root = "srv/task_data/pretrain_data/RxR_"
-    else:
-        raise NotImplementedError
+    """ Load a preprocessed cache as memory-mapped PretrainSteps """
+    path = get_preprocessed_data_path(splits, version, dataset_type)
+    return PretrainSteps.load(f"{path}.steps")
+
 
+ENCODED_CACHE_ROOT = "srv/task_data/encoded_cache/"
+ENCODED_CACHE_VERSION = 5
+
+
+def get_encoded_cache_path(tokenizer, name, splits, **settings):
+    """ Path of an encoded dataset cache, keyed by tokenizer vocabulary and encoding settings """
+    vocab = sorted(tokenizer.vocab.items(), key=lambda kv: kv[1])
+    added = sorted(tokenizer.added_tokens_encoder.items(), key=lambda kv: kv[1])
+    key = json.dumps(
+        [ENCODED_CACHE_VERSION, vocab, added, sorted(settings.items())]
+    ).encode("utf-8")
+    digest = hashlib.sha1(key).hexdigest()[:16]
     combined_split = "_".join(splits)
-    path = f"{data_root}{combined_split}_preprocessed_{version}.pickle"
-    if os.path.exists(path) and os.path.isfile(path):
-        logger.info(f"Loading preprocessed data from {path}")
+    return f"{ENCODED_CACHE_ROOT}{name}_{combined_split}_{digest}.columns"
+
+
+def token_id_dtype(tokenizer):
+    """ Smallest integer dtype holding every token id of `tokenizer` """
+    return np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max else np.int32
+
+
+ITEM_COLUMNS_VERSION = 2
+
+
+def replace_dir(tmp_path, path):
+    """
+    Move the completed directory `tmp_path` to `path`. A stale store already
+    at `path` (e.g. from an older version) is moved aside and deleted, as
+    os.replace cannot overwrite a non-empty directory. If another process
+    publishes `path` in between, its copy is kept and `tmp_path` dropped.
+    """
+    stale_path = None
+    if os.path.isdir(path):
+        stale_path = f"{path}.{os.getpid()}.stale"
+        try:
+            os.replace(path, stale_path)
+        except OSError:
+            # Another process moved it aside first
+            stale_path = None
+    try:
+        os.replace(tmp_path, path)
+    except OSError as error:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            raise
+        logger.warning(f"Keeping {path} saved concurrently by another process: {error}")
+    finally:
+        if stale_path is not None:
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+
+class ItemColumns(object):
+    """
+    Columnar storage for a list of dataset items (dicts). Only the declared
+    fields are kept, each one must be present in all items or in none.
+    Saved as a directory of .npy files plus a meta.json schema, and loaded
+    memory-mapped so that rows are read lazily and pages are shared by
+    dataloader workers.
+
+    sequences: key -> dtype of integer sequences, stored flat with offsets
+    value_sequences: keys of sequences of ids (e.g. viewpoint paths), interned
+        and stored flat with offsets
+    values: keys of ids such as scans and viewpoints, interned to int32 codes
+    numbers: key -> dtype of numeric scalars
+    objects: keys of small nested fields kept as Python objects
+    """
+
+    def __init__(
+        self,
+        items=(),
+        sequences=None,
+        value_sequences=(),
+        values=(),
+        numbers=None,
+        objects=(),
+    ):
+        self.sequences = dict(sequences or {})
+        self.value_sequences = list(value_sequences)
+        self.values = list(values)
+        self.numbers = dict(numbers or {})
+        self.objects = list(objects)
+        self.vocab = []
+        self.size = len(items)
+        self.columns = {}
+
+        vocab_index = {}
+
+        def intern(value):
+            code = vocab_index.get(value)
+            if code is None:
+                code = vocab_index[value] = len(self.vocab)
+                self.vocab.append(value)
+            return code
+
+        for key in self.declared_keys():
+            present = sum(key in item for item in items)
+            if present == 0:
+                continue
+            if present != len(items):
+                raise ValueError(f"{key} is only present in some of the items")
+            rows = [item[key] for item in items]
+            if key in self.sequences or key in self.value_sequences:
+                rows = [row.tolist() if hasattr(row, "tolist") else row for row in rows]
+                lengths = [len(row) for row in rows]
+                flat = chain.from_iterable(rows)
+                if key in self.sequences:
+                    dtype = self.sequences[key]
+                else:
+                    flat, dtype = (intern(value) for value in flat), np.int32
+                self.columns[key] = np.fromiter(flat, dtype=dtype, count=sum(lengths))
+                self.columns[f"{key}_offsets"] = np.concatenate(
+                    ([0], np.cumsum(lengths, dtype=np.int64))
+                )
+            elif key in self.values:
+                self.columns[key] = np.array(
+                    [intern(row) for row in rows], dtype=np.int32
+                )
+            elif key in self.numbers:
+                self.columns[key] = np.array(rows, dtype=self.numbers[key])
+            else:
+                self.columns[key] = rows
+
+    def declared_keys(self):
+        return (
+            list(self.sequences)
+            + self.value_sequences
+            + self.values
+            + list(self.numbers)
+            + self.objects
+        )
+
+    def keys(self):
+        return [key for key in self.declared_keys() if key in self.columns]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __len__(self):
+        return self.size
+
+    def _span(self, key, index):
+        offsets = self.columns[f"{key}_offsets"]
+        return self.columns[key][offsets[index] : offsets[index + 1]]
+
+    def __getitem__(self, index):
+        item = {}
+        for key in self.keys():
+            if key in self.sequences:
+                item[key] = self._span(key, index)
+            elif key in self.value_sequences:
+                item[key] = [self.vocab[code] for code in self._span(key, index)]
+            elif key in self.values:
+                item[key] = self.vocab[self.columns[key][index]]
+            elif key in self.numbers:
+                item[key] = self.columns[key][index].item()
+            else:
+                item[key] = self.columns[key][index]
+        return item
+
+    def lengths(self, key):
+        """ Length of the `key` sequence of every item """
+        return np.diff(self.columns[f"{key}_offsets"])
+
+    def column_values(self, key):
+        """ Decoded `key` id of every item """
+        return [self.vocab[code] for code in self.columns[key]]
+
+    def _spec(self):
+        return {
+            "sequences": {k: np.dtype(v).str for k, v in self.sequences.items()},
+            "value_sequences": self.value_sequences,
+            "values": self.values,
+            "numbers": {k: np.dtype(v).str for k, v in self.numbers.items()},
+            "objects": self.objects,
+        }
+
+    def save(self, path):
+        meta = {
+            "format": "item_columns",
+            "version": ITEM_COLUMNS_VERSION,
+            "spec": self._spec(),
+            "size": self.size,
+            "vocab": self.vocab,
+            "arrays": {
+                key: [value.dtype.str, list(value.shape)]
+                for key, value in self.columns.items()
+                if key not in self.objects
+            },
+            "objects": {key: self.columns[key] for key in self.objects if key in self},
+        }
+
+        logger.info(f"Saving {self.size} items to {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so that concurrent ranks never read a partial cache
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for key in meta["arrays"]:
+            np.save(os.path.join(tmp_path, f"{key}.npy"), self.columns[key])
+        with open(os.path.join(tmp_path, "meta.json"), "w") as handle:
+            json.dump(meta, handle)
+        replace_dir(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        meta_path = os.path.join(path, "meta.json")
+        if not (os.path.exists(meta_path) and os.path.isfile(meta_path)):
+            return False
         t_s = time.time()
-        with open(path, "rb") as handle:
-            data = pickle.load(handle)
-        t_e = time.time()
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        if meta.get("format") != "item_columns" or (
+            meta.get("version") != ITEM_COLUMNS_VERSION
+        ):
+            logger.warning(
+                f"Ignoring {path}, stored with version {meta.get('version')} "
+                f"instead of {ITEM_COLUMNS_VERSION}"
+            )
+            return False
+        spec = meta["spec"]
+        spec["sequences"] = {k: np.dtype(v) for k, v in spec["sequences"].items()}
+        spec["numbers"] = {k: np.dtype(v) for k, v in spec["numbers"].items()}
+        data = cls(**spec)
+        data.size = meta["size"]
+        data.vocab = meta["vocab"]
+        for key, (dtype, shape) in meta["arrays"].items():
+            column = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+            assert column.dtype.str == dtype and list(column.shape) == shape, key
+            data.columns[key] = column
+        data.columns.update(meta["objects"])
         logger.info(
-            "Loaded Image Features from {} in time: {:0.2f} mins".format(
-                path, (t_e - t_s) / 60.0
+            "Loaded {} items from {} in time: {:0.2f} secs".format(
+                data.size, path, time.time() - t_s
             )
         )
         return data
-    return False
+
+
+class ItemColumnsChain(object):
+    """ Several ItemColumns indexed as one dataset, without copying them """
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.offsets = np.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        part = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return self.parts[part][index - self.offsets[part]]
+
+
+class PretrainSteps(object):
+    """
+    Pretraining steps stored by reference: the token sequence of a step is the
+    encoded text it refers to followed by the encoded region labels of its
+    viewpoint, so each text and each viewpoint is stored only once.
+    """
+
+    tables = ["texts", "regions", "steps"]
+
+    def __init__(self, texts, regions, steps):
+        self.texts = texts
+        self.regions = regions
+        self.steps = steps
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        item = self.steps[index]
+        text = self.texts[item.pop("text_id")]
+        region = self.regions[item.pop("region_id")]
+        for key in text:
+            item[key] = np.concatenate((text[key], region[key]))
+        return item
+
+    def save(self, path):
+        # steps last, load() only succeeds once every table is complete
+        for name in self.tables:
+            getattr(self, name).save(os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path):
+        tables = [ItemColumns.load(os.path.join(path, name)) for name in cls.tables]
+        if any(table is False for table in tables):
+            return False
+        return cls(*tables)
+
+
+DIALOG_EMBEDDINGS_VERSION = 1
+
+
+class DialogEmbeddings(object):
+    """
+    Frozen BERT outputs for the dialogs of a dataset: one float16 (tokens,
+    hidden) array holding the unpadded rows of every dialog back to back,
+    with per-dialog offsets, loaded memory-mapped and looked up by inst_idx.
+    `fingerprint` identifies the BERT weights the rows were computed with.
+    """
+
+    def __init__(self, inst_idxs, offsets, embeddings, fingerprint):
+        self.inst_idxs = list(inst_idxs)
+        self.index = {inst_idx: i for i, inst_idx in enumerate(self.inst_idxs)}
+        self.offsets = offsets
+        self.embeddings = embeddings
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.inst_idxs)
+
+    def batch(self, inst_idxs, width):
+        """ float32 (batch, width, hidden) array of the dialogs, zero padded """
+        batch = np.zeros(
+            (len(inst_idxs), width, self.embeddings.shape[1]), dtype=np.float32
+        )
+        for i, inst_idx in enumerate(inst_idxs):
+            row = self.index[inst_idx]
+            span = self.embeddings[self.offsets[row] : self.offsets[row + 1]]
+            batch[i, : len(span)] = span
+        return batch
+
+    @classmethod
+    def write(cls, path, inst_idxs, lengths, chunks, hidden_size, fingerprint):
+        """
+        Save the dialogs `inst_idxs` of `lengths` tokens each. `chunks` yields
+        their (tokens, hidden) rows in order, in pieces of any size, which are
+        written straight into the memory-mapped array.
+        """
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        logger.info(f"Saving {len(inst_idxs)} dialog embeddings to {path}")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(tmp_path, "embeddings.npy"),
+            mode="w+",
+            dtype=np.float16,
+            shape=(int(offsets[-1]), hidden_size),
+        )
+        position = 0
+        for chunk in chunks:
+            embeddings[position : position + len(chunk)] = chunk
+            position += len(chunk)
+        assert position == offsets[-1], (position, offsets[-1])
+        embeddings.flush()
+        del embeddings
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        meta = {
+            "format": "dialog_embeddings",
+            "version": DIALOG_EMBEDDINGS_VERSION,
+            "fingerprint": fingerprint,
+            "inst_idx": list(inst_idxs),
+        }
+        with open(os.path.join(tmp_path, "meta.json"), "w") as handle:
+            json.dump(meta, handle)
+        # A stale store computed from other weights is replaced
+        replace_dir(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        meta_path = os.path.join(path, "meta.json")
+        if not (os.path.exists(meta_path) and os.path.isfile(meta_path)):
+            return False
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        if (
+            meta.get("format") != "dialog_embeddings"
+            or meta.get("version") != DIALOG_EMBEDDINGS_VERSION
+            or meta.get("fingerprint") != fingerprint
+        ):
+            logger.warning(f"Ignoring {path}, computed with other BERT weights")
+            return False
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        logger.info(f"Loaded {len(meta['inst_idx'])} dialog embeddings from {path}")
+        return cls(meta["inst_idx"], offsets, embeddings, fingerprint)
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_worker(text):
+    return _worker_tokenizer.tokenize(text)
+
+
+class BatchTokenizer(object):
+    """
+    Memoizing wrapper around `tokenizer.tokenize`. `prefetch` tokenizes the
+    distinct unseen strings across a process pool (the tokenizer is handed to
+    each worker once) and keeps the results in order. The returned token
+    lists are shared between callers and must not be modified in place.
+    """
+
+    def __init__(self, tokenizer, num_workers=0, min_parallel_size=1000):
+        self.tokenizer = tokenizer
+        self.num_workers = num_workers
+        self.min_parallel_size = min_parallel_size
+        self.cache = {}
+
+    def prefetch(self, texts):
+        texts = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        if len(texts) == 0:
+            return
+        if self.num_workers > 1 and len(texts) >= self.min_parallel_size:
+            chunksize = max(1, len(texts) // (self.num_workers * 16))
+            with multiprocessing.Pool(
+                self.num_workers,
+                initializer=_init_tokenize_worker,
+                initargs=(self.tokenizer,),
+            ) as pool:
+                tokenized = pool.map(_tokenize_worker, texts, chunksize=chunksize)
+        else:
+            tokenized = [self.tokenizer.tokenize(text) for text in texts]
+        self.cache.update(zip(texts, tokenized))
+
+    def tokenize(self, text):
+        tokens = self.cache.get(text)
+        if tokens is None:
+            tokens = self.tokenizer.tokenize(text)
+            self.cache[text] = tokens
+        return tokens
 
 
 def truncate_dialogs(sentences, amount, left=True):